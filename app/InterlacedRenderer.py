@@ -3,6 +3,8 @@ from app.ntsc import Ntsc
 
 
 class InterlacedRenderer(DefaultRenderer):
+    apply_main_effect_yuv = None
+
     @staticmethod
     def apply_main_effect(nt: Ntsc, frame1, frame2=None):
         raise NotImplementedError()
@@ -1,7 +1,7 @@
 import json
 from pathlib import Path
 from random import randint
-from typing import Tuple, Union, List, Dict
+from typing import Tuple, Union, List, Dict, Optional
 import requests
 import cv2
 import numpy
@@ -11,10 +11,12 @@ from numpy import ndarray
 
 from app.InterlacedRenderer import InterlacedRenderer
 from app.config_dialog import ConfigDialog
+from app.decoder import probe_video
 from app.logs import logger
 from app.Renderer import DefaultRenderer
-from app.funcs import resize_to_height, pick_save_file, trim_to_4width, set_ui_element
-from app.ntsc import random_ntsc, Ntsc
+from app.funcs import resize_to_height, pick_save_file, set_ui_element
+from app.tiled import IMAGE_SUFFIXES, TILED_MIN_HEIGHT, render_bands, render_image_file
+from app.ntsc import random_ntsc, set_parameters, settings_copy, Ntsc
 from ui import mainWindow
 from ui.DoubleSlider import DoubleSlider
 
@@ -34,14 +36,20 @@ class NtscApp(QtWidgets.QMainWindow, mainWindow.Ui_MainWindow):
         self.loss_less_mode: bool = False
         self.__video_output_suffix = ".mp4"  # or .mkv for FFV1
         self.ProcessAudio: bool = False
+        # in point and the frame after the out point of the video render, None for the start/end of the video
+        self.render_range: Tuple[Optional[int], Optional[int]] = (None, None)
         self.nt_controls = {}
         self.nt: Ntsc = None
+        # previews while a render is paused, self.nt is the render thread's then
+        self.preview_nt: Optional[Ntsc] = None
         self.pro_mode_elements = []
         # Это здесь нужно для доступа к переменным, методам
         # и т.д. в файле design.py
         super().__init__()
         self.supported_video_type = ['.mp4', '.mkv', '.avi', '.webm', '.mpg', '.gif']
-        self.supported_image_type = ['.png', '.jpg', '.jpeg', '.webp']
+        self.supported_image_type = list(IMAGE_SUFFIXES)
+        # the opened image file, None for videos and images from an url
+        self.image_path: Optional[Path] = None
         self.setupUi(self)  # Это нужно для инициализации нашего дизайна
         self.strings = {
             "_composite_preemphasis": self.tr("Composite preemphasis"),
@@ -74,6 +82,12 @@ class NtscApp(QtWidgets.QMainWindow, mainWindow.Ui_MainWindow):
             "_vhs_svideo_out": self.tr("VHS svideo out"),
             "_output_ntsc": self.tr("NTSC output"),
             "_black_line_cut": self.tr("Cut 2% black line"),
+            "_native_4fsc": self.tr("Native 4fsc sampling"),
+            "_chroma_subsample": self.tr("Half width chroma"),
+            "_draft_quality": self.tr("Draft quality"),
+            "_noise_bank": self.tr("Pre-generated noise"),
+            "_monochrome": self.tr("Black and white source"),
+            "_fixed_point": self.tr("Fixed-point filters"),
         }
         self.add_slider("_composite_preemphasis", 0, 10, float)
         self.add_slider("_vhs_out_sharpen", 1, 5)
@@ -107,6 +121,12 @@ class NtscApp(QtWidgets.QMainWindow, mainWindow.Ui_MainWindow):
         self.add_checkbox("_vhs_svideo_out", (5, 2), pro=True)
         self.add_checkbox("_output_ntsc", (6, 1), pro=True)
         self.add_checkbox("_black_line_cut", (1, 2), pro=False)
+        self.add_checkbox("_native_4fsc", (6, 2), pro=True)
+        self.add_checkbox("_chroma_subsample", (7, 1), pro=True)
+        self.add_checkbox("_draft_quality", (7, 2), pro=True)
+        self.add_checkbox("_noise_bank", (8, 1), pro=True)
+        self.add_checkbox("_monochrome", (8, 2), pro=True)
+        self.add_checkbox("_fixed_point", (9, 1), pro=True)
 
         self.renderHeightBox.valueChanged.connect(
             lambda: self.set_current_frames(*self.get_current_video_frames())
@@ -124,6 +144,13 @@ class NtscApp(QtWidgets.QMainWindow, mainWindow.Ui_MainWindow):
         self.refreshFrameButton.clicked.connect(self.nt_update_preview)
         self.openImageUrlButton.clicked.connect(self.open_image_by_url)
         self.exportImportConfigButton.clicked.connect(self.export_import_config)
+        self.add_range_buttons()
+        self.fullResolutionCheckbox = QCheckBox(self.tr("Full resolution"))
+        self.fullResolutionCheckbox.setToolTip(
+            self.tr("Save the image at its own resolution, rendered in bands through the disk"))
+        self.horizontalLayout.insertWidget(
+            self.horizontalLayout.indexOf(self.saveImageButton) + 1, self.fullResolutionCheckbox)
+        self.fullResolutionCheckbox.hide()
 
         # TEMP HIDE WHILE FFPROBE ISSUE ISNT FIX
         # self.ProcessAudioCheckBox.hide()
@@ -143,6 +170,43 @@ class NtscApp(QtWidgets.QMainWindow, mainWindow.Ui_MainWindow):
 
         self.add_builtin_templates()
 
+    def add_range_buttons(self):
+        self.setInButton = QPushButton()
+        self.setInButton.setToolTip(self.tr("Render from the frame on the track"))
+        self.setInButton.clicked.connect(lambda: self.set_render_range(self.videoTrackSlider.value(), None))
+        self.setOutButton = QPushButton()
+        self.setOutButton.setToolTip(self.tr("Render up to the frame on the track"))
+        self.setOutButton.clicked.connect(lambda: self.set_render_range(None, self.videoTrackSlider.value() + 1))
+        self.clearRangeButton = QPushButton("×")
+        self.clearRangeButton.setToolTip(self.tr("Render the whole video"))
+        self.clearRangeButton.setMaximumSize(QtCore.QSize(27, 28))
+        self.clearRangeButton.clicked.connect(self.clear_render_range)
+        position = self.positionControlLayout.indexOf(self.livePreviewCheckbox)
+        for offset, button in enumerate((self.setInButton, self.setOutButton, self.clearRangeButton)):
+            self.positionControlLayout.insertWidget(position + offset, button)
+        self.clear_render_range()
+
+    def set_render_range(self, in_frame: Optional[int], out_frame: Optional[int]):
+        """
+        Moves the in or the out point, None keeps it. The other point is dropped when they would cross
+        """
+        current_in, current_out = self.render_range
+        if in_frame is not None:
+            current_in = in_frame
+            if current_out is not None and current_out <= in_frame:
+                current_out = None
+        if out_frame is not None:
+            current_out = out_frame
+            if current_in is not None and current_in >= out_frame:
+                current_in = None
+        self.render_range = (current_in, current_out)
+        self.setInButton.setText(self.tr("In") + ('' if current_in is None else f' {current_in}'))
+        self.setOutButton.setText(self.tr("Out") + ('' if current_out is None else f' {current_out - 1}'))
+
+    def clear_render_range(self):
+        self.render_range = (None, None)
+        self.set_render_range(None, None)
+
     def add_builtin_templates(self):
 
         try:
@@ -420,9 +484,6 @@ class NtscApp(QtWidgets.QMainWindow, mainWindow.Ui_MainWindow):
         except ZeroDivisionError:
             self.update_status("ZeroDivisionError :DDDDDD")
 
-        if frame.shape[1] % 4 != 0:
-            frame = trim_to_4width(frame)
-
         return frame
 
     def set_current_frames(self, frame1: ndarray, frame2=None):
@@ -448,6 +509,7 @@ class NtscApp(QtWidgets.QMainWindow, mainWindow.Ui_MainWindow):
             cap = cv2.VideoCapture(url)
             if cap.isOpened():
                 ret, img = cap.read()
+                self.image_path = None
                 self.set_image_mode()
                 self.open_image(img)
             else:
@@ -462,10 +524,12 @@ class NtscApp(QtWidgets.QMainWindow, mainWindow.Ui_MainWindow):
             return None
         file_suffix = path.suffix.lower()
         if file_suffix in self.supported_video_type:
+            self.image_path = None
             self.set_video_mode()
             self.open_video(path)
         elif file_suffix in self.supported_image_type:
             img = cv2.imdecode(numpy.fromfile(path, dtype=numpy.uint8), cv2.IMREAD_COLOR)
+            self.image_path = path
             self.set_image_mode()
             self.open_image(img)
         else:
@@ -478,6 +542,7 @@ class NtscApp(QtWidgets.QMainWindow, mainWindow.Ui_MainWindow):
         self.stopRenderButton.show()
         self.livePreviewCheckbox.show()
         self.renderVideoButton.show()
+        self.fullResolutionCheckbox.hide()
 
     def set_image_mode(self):
         self.videoTrackSlider.blockSignals(True)
@@ -486,12 +551,15 @@ class NtscApp(QtWidgets.QMainWindow, mainWindow.Ui_MainWindow):
         self.stopRenderButton.hide()
         self.livePreviewCheckbox.hide()
         self.renderVideoButton.hide()
+        self.fullResolutionCheckbox.setChecked(False)
+        self.fullResolutionCheckbox.setVisible(self.image_path is not None)
 
     def set_render_heigth(self, height):
         if height > 600:
             self.renderHeightBox.setValue(600)
             self.update_status(
-                self.tr('The image resolution is large. For the best effect, the output height is set to 600'))
+                self.tr('The image resolution is large. For the best effect, the output height is set to 600, '
+                        '"Full resolution" saves it at its own'))
         else:
             self.renderHeightBox.setValue(height // 120 * 120)
 
@@ -518,9 +586,7 @@ class NtscApp(QtWidgets.QMainWindow, mainWindow.Ui_MainWindow):
         return values
 
     def nt_set_config(self, values: List[Dict[str, Union[int, float]]]):
-        for parameter_name, value in values.items():
-            setattr(self.nt, parameter_name, value)
-
+        set_parameters(self.nt, values)
         self.sync_nt_to_sliders()
 
     def open_video(self, path: Path):
@@ -537,6 +603,10 @@ class NtscApp(QtWidgets.QMainWindow, mainWindow.Ui_MainWindow):
             "path": path,
             "suffix": path.suffix.lower(),
         }
+        probe = probe_video(path)
+        if probe is not None:
+            # cv2 estimates the frame count from the container header
+            self.input_video["frames_count"] = probe["frames_count"] or self.input_video["frames_count"]
         logger.debug(f"selfinput: {self.input_video}")
         self.orig_wh = (int(self.input_video["width"]), int(self.input_video["height"]))
         self.set_render_heigth(self.input_video["height"])
@@ -547,23 +617,46 @@ class NtscApp(QtWidgets.QMainWindow, mainWindow.Ui_MainWindow):
             lambda: self.set_current_frames(*self.get_current_video_frames())
         )
         self.progressBar.setMaximum(self.input_video["frames_count"])
+        self.clear_render_range()
 
     def render_image(self):
         target_file = pick_save_file(self, title='Save frame as', suffix='.png')
         if target_file is None or not isinstance(self.current_frame, ndarray):
             return None
+        if self.fullResolutionCheckbox.isChecked() and self.image_path is not None:
+            self.render_image_file(target_file)
+            return None
         render_h = self.renderHeightBox.value()
         crop_wh = resize_to_height(self.orig_wh, render_h)
         image = cv2.resize(self.current_frame, crop_wh)
-        if image.shape[1] % 4 != 0:
-            image = trim_to_4width(image)
-        image = self.videoRenderer.apply_main_effect(self.nt, frame1=image)
+        if image.shape[0] >= TILED_MIN_HEIGHT:
+            tiled = numpy.empty_like(image)
+            render_bands(self.nt, image, tiled)
+            image = tiled
+        else:
+            image = self.videoRenderer.apply_main_effect(self.nt, frame1=image)
         is_success, im_buf_arr = cv2.imencode(".png", image)
         if not is_success:
             self.update_status("Error while saving (!is_success)")
             return None
         im_buf_arr.tofile(target_file)
 
+    def render_image_file(self, target_file: Path):
+        """
+        Renders the opened image file at its own resolution into target_file, band by band through the disk
+        """
+        def progress(done: int, total: int):
+            self.update_status(self.tr('Rendering the image: band {done} of {total}').format(done=done, total=total))
+            QtWidgets.QApplication.processEvents()
+
+        try:
+            render_image_file(self.nt, self.image_path, target_file, progress=progress)
+        except Exception as e:
+            logger.exception(e)
+            self.update_status(self.tr('Error while saving: {error}').format(error=e))
+            return
+        self.update_status(self.tr('Saved {path}').format(path=target_file))
+
     def render_video(self):
         if self.input_video['suffix'] == ".gif":
             suffix = self.input_video['suffix']
@@ -578,11 +671,16 @@ class NtscApp(QtWidgets.QMainWindow, mainWindow.Ui_MainWindow):
             "input_video": self.input_video,
             "input_heigth": self.renderHeightBox.value(),
             "upscale_2x": self.NearestUpScale.isChecked(),
+            "in_frame": self.render_range[0],
+            "out_frame": self.render_range[1],
         }
         self.setup_renderer()
         self.toggle_main_effect()
         self.lossless_exporting()
         self.audio_filtering()
+        self.progressBar.setMaximum(
+            (self.render_range[1] or self.input_video["frames_count"]) - (self.render_range[0] or 0)
+        )
         self.progressBar.setValue(1)
         self.videoRenderer.render_data = render_data
         self.thread.start()
@@ -603,7 +701,11 @@ class NtscApp(QtWidgets.QMainWindow, mainWindow.Ui_MainWindow):
             self.render_preview(self.current_frame)
             return None
 
-        ntsc_out_image = self.videoRenderer.apply_main_effect(self.nt, self.current_frame, self.next_frame)
+        nt = self.nt
+        if self.isRenderActive:
+            # pause takes effect between frames, the render thread may still be drawing from self.nt's generator
+            nt = self.preview_nt = settings_copy(self.nt, self.preview_nt)
+        ntsc_out_image = self.videoRenderer.apply_main_effect(nt, self.current_frame, self.next_frame)
 
         if self.compareMode:
             ntsc_out_image = numpy.concatenate(
@@ -1,18 +1,27 @@
 import abc
+import tempfile
 import time
 import os
 from collections import defaultdict
-from typing import Tuple, TypedDict
+from pathlib import Path
+from typing import List, Optional, Tuple, TypedDict
 
 import cv2
 from PyQt5 import QtCore
 import ffmpeg
-from imutils.video import FileVideoStream
 from numpy import ndarray
 
+from app.audio import AudioChain, AudioStream, pcm_pipes_supported
+from app.decoder import YUV_PIX_FMT, open_video_stream
+from app.checkpoint import Checkpoint, PieceWriter, config_hash
+from app.fanout import render_targets
+from app.encoder import FFmpegConcat, FFmpegJob, FFmpegVideoWriter, mux, video_args
 from app.logs import logger
-from app.funcs import resize_to_height, trim_to_4width, expand_to_4width
-from app.ntsc import Ntsc
+from app.frame_queue import DEFAULT_QUEUE_BUDGET, MIN_QUEUE_FRAMES, QueuedWriter, frame_bytes, queue_frames
+from app.funcs import resize_to_height
+from app.ntsc import Ntsc, effect_parameters, resize_planar, yuv2bgr
+from app.rng_prefetch import PrefetchRandom
+from app.segments import PIECE_SUFFIX, Segment, SegmentJob, SegmentPool, keyframes, plan_segments
 
 
 class Config(TypedDict):
@@ -21,6 +30,10 @@ class Config(TypedDict):
     container_wh: Tuple[int, int]
     upscale_2x: bool
     lossless: bool
+    yuv_pipeline: bool
+
+    decode_queue_bytes: int
+    encode_queue_bytes: int
 
     next_frame_context: bool
 
@@ -31,6 +44,8 @@ class Config(TypedDict):
 
 
 class AbstractRenderer(QtCore.QObject):
+    # effect on planar YUV frames, renderers without one render through BGR
+    apply_main_effect_yuv = None
 
     @staticmethod
     @abc.abstractmethod
@@ -49,6 +64,7 @@ class DefaultRenderer(AbstractRenderer):
     sendStatus = QtCore.pyqtSignal(str)
     increment_progress = QtCore.pyqtSignal()
     render_data = {}
+    lossless = False
     current_frame_index = 0
     cap = None
     buffer: dict[int, ndarray] = defaultdict(lambda: None)
@@ -63,6 +79,18 @@ class DefaultRenderer(AbstractRenderer):
         frame[1:-1:2] = frame[0:-2:2] / 2 + frame[2::2] / 2
         return frame
 
+    @staticmethod
+    def apply_main_effect_yuv(nt: Ntsc, frame1, frame2=None):
+        """
+        apply_main_effect on planar YUV frames (see Ntsc.composite_layer_yuv)
+        """
+        if frame2 is None:
+            frame2 = frame1
+
+        frame = nt.composite_layer_yuv(frame1, frame2, field=0, fieldno=1)
+        frame[:, 1:-1:2] = frame[:, 0:-2:2] / 2 + frame[:, 2::2] / 2
+        return frame
+
     def update_buffer(self):
         buf = self.buffer
         current_index = self.current_frame_index
@@ -74,25 +102,23 @@ class DefaultRenderer(AbstractRenderer):
         next_frame = self.cap.read()
 
         if current_index > 0:
-            del buf[current_index-1]
+            self.cap.release(buf.pop(current_index-1, None))
         buf[current_index] = current_frame
         buf[current_index+1] = next_frame
 
     def prepare_frame(self, frame):
-        orig_wh = self.config.get("orig_wh")
         render_wh = self.config.get("render_wh")
+        yuv = self.config.get("yuv_pipeline")
 
-        if orig_wh != render_wh:
+        # frames normally arrive scaled by the decoder
+        frame_wh = (frame.shape[2], frame.shape[1]) if yuv else (frame.shape[1], frame.shape[0])
+        if frame_wh != tuple(render_wh):
             try:
-                frame = cv2.resize(frame, render_wh)
+                frame = resize_planar(frame, render_wh) if yuv else cv2.resize(frame, render_wh)
             except Exception as e:
                 logger.exception(e)
                 raise e
 
-        #  crash workaround
-        if render_wh[0] % 4 != 0:
-            frame = expand_to_4width(frame)
-
         return frame
 
     def produce_frame(self):
@@ -101,8 +127,7 @@ class DefaultRenderer(AbstractRenderer):
             self.sendStatus.emit(f'Render stopped. ret(debug):')
             return False
 
-        render_wh = self.config.get("render_wh")
-        upscale_2x = self.config.get("upscale_2x")
+        yuv = self.config.get("yuv_pipeline")
 
         self.increment_progress.emit()
 
@@ -117,23 +142,18 @@ class DefaultRenderer(AbstractRenderer):
             frame2 = None
 
         if self.mainEffect:
-            frame = self.apply_main_effect(
+            apply_main_effect = self.apply_main_effect_yuv if yuv else self.apply_main_effect
+            frame = apply_main_effect(
                 nt=self.render_data.get("nt"),
                 frame1=frame1,
                 frame2=frame2,
             )
         else:
-            frame = frame1
-
-        frame = frame[:, 0:render_wh[0]]
+            frame = frame1.copy()  # frame1 goes back to the decoder's buffer pool while the writer still queues it
 
         if self.current_frame_index % 10 == 0 or self.liveView:
             self.frameMoved.emit(self.current_frame_index)
-            self.newFrame.emit(frame)
-
-        if upscale_2x:
-            container_wh = self.config.get("container_wh")
-            frame = cv2.resize(frame, dsize=container_wh, interpolation=cv2.INTER_NEAREST)
+            self.newFrame.emit(yuv2bgr(frame) if yuv else frame)
 
         return frame
 
@@ -152,14 +172,25 @@ class DefaultRenderer(AbstractRenderer):
                 render_wh[1] * 2,
             )
 
+        # the queues get half of the budget each, but always room for a few frames of the chosen size.
+        # Frames go to the encoder in the render size, it does the upscale
+        budget = self.render_data.get("queue_budget", DEFAULT_QUEUE_BUDGET)
+        decode_queue_bytes = encode_queue_bytes = max(budget // 2, frame_bytes(render_wh) * MIN_QUEUE_FRAMES)
+        logger.debug(f'Queue budget: {queue_frames(decode_queue_bytes, render_wh)} frames each way')
+
         self.config = Config(
             upscale_2x=upscale_2x,
             container_wh=container_wh,
             render_wh=render_wh,
             orig_wh=orig_wh,
 
-            lossless=False,
+            decode_queue_bytes=decode_queue_bytes,
+            encode_queue_bytes=encode_queue_bytes,
+
+            lossless=self.lossless,
             next_frame_context=True,
+            # decode to planar YUV and stay there until the encoder, skipping the BGR round trip
+            yuv_pipeline=self.render_data.get("yuv_pipeline", True) and self.apply_main_effect_yuv is not None,
 
             audio_process=False,
             audio_sat_beforevol=4.5,
@@ -171,151 +202,356 @@ class DefaultRenderer(AbstractRenderer):
     def run(self):
         self.set_up()
         self.running = True
+        if self.render_data.get("targets"):
+            # one decode feeding several effect variants and outputs
+            render_targets(self, self.render_data["targets"])
+            return
 
-        suffix = '.mkv'
-
-        tmp_output = self.render_data['target_file'].parent / f'tmp_{self.render_data["target_file"].stem}{suffix}'
-
-        fourccs = [
-            cv2.VideoWriter_fourcc(*'mp4v'),  # doesn't work on mac os
-            cv2.VideoWriter_fourcc(*'H264')
-        ]
-
-        if self.config.get("lossless"):
-            fourcc_choice = cv2.VideoWriter_fourcc(*'FFV1')
-        else:
-            fourcc_choice = fourccs.pop(0)
-
-        video = cv2.VideoWriter()
-
-        open_result = False
-        while not open_result:
-            open_result = video.open(
-                filename=str(tmp_output.resolve()),
-                fourcc=fourcc_choice,
-                fps=self.render_data["input_video"]["orig_fps"],
-                frameSize=self.config.get("container_wh"),
-            )
-            logger.debug(f'Output video open result: {open_result}')
-
-        logger.debug(f'Input video: {str(self.render_data["input_video"]["path"].resolve())}')
-        logger.debug(f'Temp output: {str(tmp_output.resolve())}')
-        logger.debug(f'Output video: {str(self.render_data["target_file"].resolve())}')
-        #logger.debug(f'Process audio: {self.process_audio}')
-
-        self.current_frame_index = -1
-        self.renderStateChanged.emit(True)
-        self.cap = FileVideoStream(
-            path=str(self.render_data["input_video"]["path"]),
-            queue_size=322
-        ).start()
-
-        while self.cap.more():
-            if self.pause:
-                self.sendStatus.emit(f"{status_string} [P]")
-                time.sleep(0.3)
-                continue
-
-            self.current_frame_index += 1
-            self.update_buffer()
-            frame = self.produce_frame()
-
-            status_string = '[CV2] Render progress: {current_frame_index}/{total}'.format(
-                current_frame_index=self.current_frame_index,
-                total=self.render_data["input_video"]["frames_count"],
-            )
-            if frame is False:
-                logger.info(f"Video end or render error {status_string}")
-                break
-
-            self.sendStatus.emit(status_string)
-            video.write(frame)
-
-        video.release()
-
-        orig_path = str(self.render_data["input_video"]["path"].resolve())
+        orig_path = self.render_data["input_video"]["path"].resolve()
         orig_suffix = self.render_data["input_video"]["suffix"]
         target_suffix = self.render_data["target_file"].suffix
-        result_path = str(self.render_data["target_file"].resolve())
-
-        # FIXME beautify file render and audio detection
-
-        #self.sendStatus.emit(f'[FFMPEG] Copying audio to {result_path}')
-
-        orig = ffmpeg.input(orig_path)
-
-        final_audio = orig.audio
-
-        if(self.audio_process == True):
-            self.sendStatus.emit(f'[FFMPEG] Preparing audio filtering')
-
-            #tmp_audio = self.render_data['target_file'].parent / f'tmp_audio_{self.render_data["target_file"].stem}.wav'
-            tmp_audio = f"{self.render_data['target_file'].parent}/tmp_audio_{self.render_data['target_file'].stem}.wav"
-
-            aud_ff_probe = ffmpeg.probe(orig_path)
-
-            #aud_ff_video_stream = next((stream for stream in aud_ff_probe['streams'] if stream['codec_type'] == 'video'), None)
-            #aud_ff_duration = aud_ff_video_stream['duration']
-            aud_ff_duration = aud_ff_probe["format"]["duration"]
+        result_path = self.render_data["target_file"].resolve()
+
+        logger.debug(f'Input video: {orig_path}')
+        logger.debug(f'Output video: {result_path}')
+
+        in_frame, out_frame = self.frame_range()
+        audio_start = in_frame / self.render_data["input_video"]["orig_fps"]
+
+        # temporary files of the render live here and go away with it, also when it fails
+        with tempfile.TemporaryDirectory(prefix='ntscqt-', dir=self.render_data.get("scratch_dir")) as scratch:
+            scratch = Path(scratch)
+            logger.debug(f'Scratch directory: {scratch}')
+
+            # the degraded audio is streamed into the encoder next to the frames. Where the encoder cannot
+            # inherit the pipe the ffmpeg chain renders it alongside the video and it is muxed in at the end
+            audio_stream = audio_job = None
+            if self.audio_process and pcm_pipes_supported():
+                audio_stream = AudioStream(orig_path, AudioChain(
+                    saturation=self.audio_sat_beforevol,
+                    lowpass=self.audio_lowpass,
+                    noise_volume=self.audio_noise_volume,
+                ), start=audio_start)
+                if not audio_stream.open():
+                    audio_stream = None
+            elif self.audio_process:
+                audio_job = self.start_audio_filter(orig_path, scratch)
+
+            output_args = dict(
+                path=scratch / f'video{target_suffix}' if audio_job else result_path,
+                scratch_dir=scratch,
+                audio=None if audio_job else orig_path,
+                # matroska takes any audio codec
+                copy_audio=target_suffix in (orig_suffix, '.mkv'),
+                audio_stream=audio_stream,
+                audio_start=audio_start,
+            )
+            checkpoint = None
+            finished = False
+            try:
+                if target_suffix == '.gif':
+                    # GIFs cannot be joined without reencoding, they render in one go without checkpoints
+                    encoder = self.video_writer(**output_args)
+                    self.sendStatus.emit(f'[FFMPEG] Encoding to {result_path}')
+                    self.render_frames(encoder, in_frame, out_frame)
+                else:
+                    checkpoint = self.open_checkpoint()
+                    self.render_pieces(checkpoint, scratch)
+                    if self.running and not checkpoint.complete():
+                        raise RuntimeError(f'Frames are missing in {checkpoint.directory} after the render')
+                    # a stopped render still gets the frames done from the in point, as far as they go
+                    pieces = checkpoint.chain(in_frame)[0]
+                    if not pieces:
+                        self.renderStateChanged.emit(False)
+                        self.sendStatus.emit('Render stopped')
+                        return
+                    encoder = FFmpegConcat(pieces=[piece.path for piece in pieces], **output_args)
+                    self.sendStatus.emit(f'[FFMPEG] Joining {len(pieces)} pieces into {result_path}')
+                    encoder.run()
+                finished = True
+            finally:
+                if not finished and audio_stream:
+                    audio_stream.stop()
+                if not finished and audio_job:
+                    audio_job.abort()
+
+            if audio_job:
+                self.sendStatus.emit(f'[FFMPEG] Waiting for audio filtering')
+                audio = audio_job.wait()
+                self.sendStatus.emit(f'[FFMPEG] Muxing audio into {result_path}')
+                mux(encoder.path, audio, result_path, audio_start=audio_start)
 
-            aud_ff_audio_stream = next((stream for stream in aud_ff_probe['streams'] if stream['codec_type'] == 'audio'), None)
-            aud_ff_srate = aud_ff_audio_stream['sample_rate']
-            aud_ff_clayout = aud_ff_audio_stream['channel_layout']
+        self.renderStateChanged.emit(False)
+        if checkpoint is not None and not self.running:
+            self.sendStatus.emit(
+                f'Render stopped at frame {checkpoint.chain(in_frame)[1]}, '
+                f'render again with the same settings to resume'
+            )
+            return
+        if checkpoint is not None:
+            checkpoint.remove()
+        self.sendStatus.emit('[DONE] Render done')
 
-            aud_ff_noise = ffmpeg.input(f'aevalsrc=-2+random(0):sample_rate={aud_ff_srate}:channel_layout=mono',f="lavfi",t=aud_ff_duration)
-            aud_ff_noise = ffmpeg.filter((aud_ff_noise, aud_ff_noise), 'join', inputs=2, channel_layout='stereo')
-            aud_ff_noise = aud_ff_noise.filter('volume', self.audio_noise_volume)
+    def frame_range(self) -> Tuple[int, Optional[int]]:
+        """
+        First frame and the frame after the last one to render, render_data["in_frame"] and ["out_frame"].
+        The whole video when they are not set, the out point None renders to the end
+        """
+        in_frame = max(0, self.render_data.get("in_frame") or 0)
+        out_frame = self.render_data.get("out_frame")
+        if out_frame is not None and out_frame <= in_frame:
+            raise ValueError(f'Out point {out_frame} is not after the in point {in_frame}')
+        return in_frame, out_frame
+
+    def video_writer(self, path: Path, scratch_dir: Path, **kwargs) -> FFmpegVideoWriter:
+        """
+        Encoder of the rendered frames into path, kwargs go to FFmpegVideoWriter. It takes render size frames
+        and scales them up to container_wh
+        """
+        return FFmpegVideoWriter(
+            path=path,
+            width=self.config.get("render_wh")[0],
+            height=self.config.get("render_wh")[1],
+            scale=2 if self.config.get("upscale_2x") else 1,
+            fps=self.render_data["input_video"]["orig_fps"],
+            scratch_dir=scratch_dir,
+            pix_fmt=YUV_PIX_FMT if self.config.get("yuv_pipeline") else 'bgr24',
+            lossless=self.config.get("lossless"),
+            **kwargs,
+        )
 
-            aud_ff_fx = final_audio.filter("volume",self.audio_sat_beforevol).filter("alimiter",limit="0.5").filter("volume",0.8)
-            aud_ff_fx = aud_ff_fx.filter("firequalizer",gain=f'if(lt(f,{self.audio_lowpass}), 0, -INF)')
+    def open_checkpoint(self) -> Checkpoint:
+        """
+        Checkpoint of this render, render_data["checkpoint_dir"] or next to the target file. It resumes the
+        checkpoint of an earlier render of the same source with the same settings and clears any other.
+        The head switching point drifts with every preview, a resumed render goes on from the point it started at
+        """
+        nt = self.render_data["nt"]
+        source = self.render_data["input_video"]["path"].resolve()
+        stat = source.stat()
+        rng = {"generator": type(nt.random).__name__}
+        rng.update({name: int(getattr(nt.random, name)) for name in ('seed', 'seed1', 'seed2')
+                    if hasattr(nt.random, name)})
+        state = {"rng": rng, "head_switching_point": float(nt._vhs_head_switching_point)}
+        key = {
+            "renderer": type(self).__name__,
+            "source": [str(source), stat.st_size, stat.st_mtime_ns],
+            "main_effect": self.mainEffect,
+            "config": {name: self.config.get(name) for name in (
+                "render_wh", "container_wh", "upscale_2x", "lossless", "yuv_pipeline", "next_frame_context",
+            )},
+            "video_args": video_args(PIECE_SUFFIX, self.config.get("lossless")),
+            "nt": effect_parameters(nt),
+            "rng": rng,
+            "range": self.frame_range(),
+        }
+        target = self.render_data["target_file"].resolve()
+        directory = Path(self.render_data.get("checkpoint_dir") or target.with_name(f'{target.name}.parts'))
+        checkpoint = Checkpoint.open(directory, config_hash(key), state, PIECE_SUFFIX, *self.frame_range())
+        nt._vhs_head_switching_point = checkpoint.state["head_switching_point"]
+        return checkpoint
+
+    def piece_writer(self, checkpoint: Checkpoint, scratch_dir: Path, start: int) -> PieceWriter:
+        return PieceWriter(checkpoint, lambda path: self.video_writer(path, scratch_dir), start)
+
+    def workers(self) -> int:
+        """
+        Processes rendering segments: render_data["workers"], opt-in. 1 renders in process, as it must with the
+        live preview on, which shows frames and slider changes of this process only
+        """
+        if self.liveView:
+            return 1
+        return self.render_data.get("workers", 1)
+
+    def plan_segments(self) -> List[Segment]:
+        """
+        Segments of frame_range() rendered by separate processes, workers() of them at most
+        """
+        in_frame, out_frame = self.frame_range()
+        workers = self.workers()
+        if workers <= 1:
+            return [Segment(0, in_frame, out_frame)]
+        path = self.render_data["input_video"]["path"]
+        segments = plan_segments(self.render_data["input_video"]["frames_count"], workers, keyframes(path),
+                                 in_frame, out_frame)
+        logger.debug(f'Segments: {segments}')
+        return segments
+
+    def render_pieces(self, checkpoint: Checkpoint, scratch_dir: Path):
+        """
+        Renders the frames missing in checkpoint, on worker processes when there are several segments to do
+        """
+        segments = []
+        for segment in self.plan_segments():
+            start = checkpoint.resume_frame(segment.start, segment.end)
+            if start is not None:
+                segments.append(segment._replace(start=start))
+        done = checkpoint.chain(checkpoint.start)[1] - checkpoint.start
+        if done:
+            self.sendStatus.emit(f'Resuming the render from {checkpoint.directory}, {done} frames were done')
+
+        if len(segments) > 1 and self.workers() > 1:
+            self.render_segments(segments, checkpoint, scratch_dir)
+            return
+        for segment in segments:
+            encoder = self.piece_writer(checkpoint, scratch_dir, segment.start)
+            encoder.on_piece = lambda piece: checkpoint.save()
+            self.render_frames(encoder, segment.start, segment.end)
+            if not self.running:
+                break
+            checkpoint.segment_done(segment.start, segment.end, encoder.frames_written)
+        checkpoint.save()
 
-            aud_ff_mix = ffmpeg.filter([aud_ff_fx, aud_ff_noise], 'amix').filter("firequalizer",gain='if(lt(f,13301), 0, -INF)')
+    def render_segments(self, segments: List[Segment], checkpoint: Checkpoint, scratch_dir: Path):
+        """
+        Renders every segment into pieces of checkpoint on a pool of worker processes
+        """
+        self.renderStateChanged.emit(True)
+        render_data = dict(self.render_data)
+        render_data["input_video"] = {k: v for k, v in render_data["input_video"].items() if k != "cap"}
+        pool = SegmentPool(min(len(segments), self.workers()))
+        try:
+            futures = [
+                pool.submit(SegmentJob(
+                    renderer_class=type(self),
+                    render_data=render_data,
+                    main_effect=self.mainEffect,
+                    lossless=self.lossless,
+                    segment=segment,
+                    checkpoint=checkpoint,
+                    scratch_dir=scratch_dir,
+                ))
+                for segment in segments
+            ]
+            rendered = 0
+            while not all(future.done() for future in futures):
+                for _ in pool.frames_done(timeout=0.3):
+                    rendered += 1
+                    self.increment_progress.emit()
+                if not self.running:
+                    pool.stop.set()
+                if self.pause:
+                    pool.pause.set()
+                else:
+                    pool.pause.clear()
+                checkpoint.save()
+                self.sendStatus.emit('[CV2] Render progress: {rendered}/{total} in {segments} segments{paused}'.format(
+                    rendered=rendered,
+                    total=(checkpoint.end or self.render_data["input_video"]["frames_count"]) - checkpoint.start,
+                    segments=len(segments),
+                    paused=' [P]' if self.pause else '',
+                ))
+                failed = next((future for future in futures if future.done() and future.exception()), None)
+                if failed is not None:
+                    pool.stop.set()
+                    failed.result()
+            for segment, future in zip(segments, futures):
+                frames, completed = future.result()
+                if completed:
+                    checkpoint.segment_done(segment.start, segment.end, frames)
+        finally:
+            pool.close()
+            checkpoint.save()
+        logger.debug(f'Rendered {rendered} frames in {len(segments)} segments')
+
+    def render_frames(self, encoder: FFmpegVideoWriter, start: int = 0, end: Optional[int] = None):
+        """
+        Renders frames start to end (excluded, None for the end of the video) into encoder. Every frame is
+        rendered from its index (see Ntsc.begin_frame), frames come out the same from any start
+        """
+        self.current_frame_index = start - 1
+        self.buffer = defaultdict(lambda: None)  # frames of the previous render belong to its stream's buffer pool
+        self.renderStateChanged.emit(True)
+        self.cap = open_video_stream(
+            path=self.render_data["input_video"]["path"],
+            width=self.config.get("render_wh")[0],
+            height=self.config.get("render_wh")[1],
+            # half a frame early, frame `start` is the first at or after the seek point
+            start=max(0.0, (start - 0.5) / self.render_data["input_video"]["orig_fps"]) if start else 0.0,
+            budget=self.config.get("decode_queue_bytes"),
+            pix_fmt=YUV_PIX_FMT if self.config.get("yuv_pipeline") else 'bgr24',
+        ).start()
+        encoder.open()
+        writer = QueuedWriter(encoder.write, self.config.get("encode_queue_bytes"))
+
+        # noise of the next frames is drawn on a background thread while the current one is filtered
+        nt = self.render_data["nt"]
+        rng_prefetch = PrefetchRandom(nt.random, frames_ahead=2 if (os.cpu_count() or 1) > 1 else 0)
+        nt.random = rng_prefetch
+        finished = False
+        try:
+            while self.cap.more() and (end is None or self.current_frame_index + 1 < end):
+                if self.pause:
+                    self.sendStatus.emit(f"{status_string} [P]")
+                    time.sleep(0.3)
+                    continue
+
+                self.current_frame_index += 1
+                self.update_buffer()
+                nt.begin_frame(self.current_frame_index)
+                frame = self.produce_frame()
+                rng_prefetch.frame_done()
+
+                status_string = '[CV2] Render progress: {current_frame_index}/{total} | queued: {decode}, {encode}'.format(
+                    current_frame_index=self.current_frame_index,
+                    total=self.render_data["input_video"]["frames_count"] if end is None else end,
+                    decode=self.cap.queue.stats(),
+                    encode=writer.queue.stats(),
+                )
+                if frame is False:
+                    logger.info(f"Video end or render error {status_string}")
+                    break
+
+                self.sendStatus.emit(status_string)
+                writer.write(frame)
+            finished = True
+        finally:
+            nt.random = rng_prefetch.close()
+            nt.begin_frame(None)
+            self.cap.stop()
+            logger.debug(self.cap.queue.summary())
+            try:
+                writer.close()
+            finally:
+                if finished:
+                    encoder.close()
+                else:
+                    encoder.abort()
+        logger.debug(f'Encoded {encoder.frames_written} frames')
 
-            aud_ff_command = aud_ff_mix.output(tmp_audio,acodec='pcm_s24le',shortest=None)
+    def start_audio_filter(self, orig_path: Path, scratch: Path) -> FFmpegJob:
+        """
+        Starts rendering the degraded audio track of orig_path into a WAV in scratch
+        """
+        self.sendStatus.emit(f'[FFMPEG] Preparing audio filtering')
 
-            self.sendStatus.emit(f'[FFMPEG] Prepared audio filtering')
-            logger.debug(aud_ff_command)
-            logger.debug(' '.join(aud_ff_command.compile()))
+        tmp_audio = scratch / f'tmp_audio_{self.render_data["target_file"].stem}.wav'
 
-            self.sendStatus.emit(f'[FFMPEG] Starting audio filtering into {tmp_audio}')
-            aud_ff_command.overwrite_output().global_args('-v', 'verbose').run()
+        aud_ff_probe = ffmpeg.probe(str(orig_path))
 
-            final_audio = ffmpeg.input(tmp_audio)
-            final_audio = final_audio.audio
+        aud_ff_duration = aud_ff_probe["format"]["duration"]
 
-            self.sendStatus.emit(f'[FFMPEG] Finished audio filtering')
-        else:
-            self.sendStatus.emit(f'[FFMPEG] Copying audio to {result_path}')
+        aud_ff_audio_stream = next((stream for stream in aud_ff_probe['streams'] if stream['codec_type'] == 'audio'), None)
+        aud_ff_srate = aud_ff_audio_stream['sample_rate']
+        aud_ff_clayout = aud_ff_audio_stream['channel_layout']
 
-        temp_video_stream = ffmpeg.input(str(tmp_output.resolve()))
-        # render_streams.append(temp_video_stream.video)
+        aud_ff_noise = ffmpeg.input(f'aevalsrc=-2+random(0):sample_rate={aud_ff_srate}:channel_layout=mono',f="lavfi",t=aud_ff_duration)
+        aud_ff_noise = ffmpeg.filter((aud_ff_noise, aud_ff_noise), 'join', inputs=2, channel_layout='stereo')
+        aud_ff_noise = aud_ff_noise.filter('volume', self.audio_noise_volume)
 
-        if self.audio_process:
-            acodec = 'flac' if target_suffix == '.mkv' else 'copy'
-            ff_command = ffmpeg.output(temp_video_stream.video, final_audio, result_path, shortest=None, vcodec='copy', acodec=acodec)
-        else:
-            ff_command = ffmpeg.output(temp_video_stream.video, final_audio, result_path, shortest=None, vcodec='copy', acodec='copy')
+        aud_ff_fx = ffmpeg.input(str(orig_path)).audio.filter("volume",self.audio_sat_beforevol).filter("alimiter",limit="0.5").filter("volume",0.8)
+        aud_ff_fx = aud_ff_fx.filter("firequalizer",gain=f'if(lt(f,{self.audio_lowpass}), 0, -INF)')
 
-        logger.debug(ff_command)
-        logger.debug(' '.join(ff_command.compile()))
-        try:
-            ff_command.overwrite_output().run()
-        except ffmpeg.Error as e:
-            if orig_suffix == '.gif':
-                ff_command = ffmpeg.output(temp_video_stream.video, result_path, shortest=None)
-            else:
-                ff_command = ffmpeg.output(temp_video_stream.video, result_path, shortest=None, vcodec='copy')
-            ff_command.overwrite_output().run()
+        aud_ff_mix = ffmpeg.filter([aud_ff_fx, aud_ff_noise], 'amix').filter("firequalizer",gain='if(lt(f,13301), 0, -INF)')
 
-        self.sendStatus.emit('[FFMPEG] Audio copy done')
+        aud_ff_command = aud_ff_mix.output(str(tmp_audio),acodec='pcm_s24le',shortest=None)
 
-        tmp_output.unlink()
-        if self.audio_process:
-            if os.path.exists(tmp_audio):
-                os.remove(tmp_audio)
+        self.sendStatus.emit(f'[FFMPEG] Prepared audio filtering')
+        logger.debug(aud_ff_command)
+        logger.debug(' '.join(aud_ff_command.compile()))
 
-        self.renderStateChanged.emit(False)
-        self.sendStatus.emit('[DONE] Render done')
+        self.sendStatus.emit(f'[FFMPEG] Starting audio filtering into {tmp_audio}')
+        return FFmpegJob(aud_ff_command.overwrite_output().global_args('-v', 'verbose'), tmp_audio, scratch).start()
 
     def stop(self):
         self.running = False
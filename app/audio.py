@@ -0,0 +1,230 @@
+import os
+import subprocess
+import threading
+from pathlib import Path
+from typing import Optional
+
+import ffmpeg
+import numpy
+import scipy.signal
+
+from app.funcs import start_ffmpeg
+from app.logs import logger
+
+# the engine works on float32 PCM in this format, decoded and resampled by ffmpeg
+AUDIO_RATE = 48000
+AUDIO_CHANNELS = 2
+AUDIO_FORMAT = 'f32le'
+
+# samples per channel read from the decoder at a time, memory stays at a few blocks whatever the length
+BLOCK_SAMPLES = 16384
+
+# FIR taps of the lowpass filters, firequalizer's brickwall in a linear phase filter of odd length
+LOWPASS_TAPS = 511
+
+# what the ffmpeg chain did after mixing: firequalizer=gain='if(lt(f,13301), 0, -INF)'
+OUTPUT_LOWPASS = 13301
+
+# the limiter gain is constant over blocks this long (seconds), alimiter's default release
+LIMITER_BLOCK = 0.001
+LIMITER_RELEASE = 0.05
+
+
+def pcm_pipes_supported() -> bool:
+    """
+    The encoder reads the PCM from an inherited file descriptor, which needs pass_fds
+    """
+    return os.name == 'posix'
+
+
+class FIRFilter:
+    """
+    Linear phase FIR filter over a stream of blocks, the output is realigned with the input (the group delay
+    is dropped from the head and flushed at the end)
+    """
+
+    def __init__(self, taps: numpy.ndarray, channels: int):
+        self.taps = taps
+        self.delay = (len(taps) - 1) // 2
+        self._state = numpy.zeros((len(taps) - 1, channels), dtype=numpy.float64)
+        self._skip = self.delay
+
+    def __call__(self, block: numpy.ndarray) -> numpy.ndarray:
+        out, self._state = scipy.signal.lfilter(self.taps, [1.0], block, axis=0, zi=self._state)
+        if self._skip:
+            drop = min(self._skip, len(out))
+            self._skip -= drop
+            out = out[drop:]
+        return out
+
+    def flush(self) -> numpy.ndarray:
+        return self(numpy.zeros((self.delay, self._state.shape[1])))
+
+
+def lowpass_taps(hz: float, rate: int = AUDIO_RATE) -> numpy.ndarray:
+    return scipy.signal.firwin(LOWPASS_TAPS, min(hz, rate / 2 * 0.99), fs=rate)
+
+
+class Limiter:
+    """
+    Peak limiter: gain drops instantly where a short block would exceed `limit` and recovers with the release
+    time constant, then alimiter's auto level scales the limit back to full scale
+    """
+
+    def __init__(self, limit: float, rate: int = AUDIO_RATE):
+        self.limit = limit
+        self.block = max(1, int(rate * LIMITER_BLOCK))
+        self.recover = 1.0 - numpy.exp(-self.block / (rate * LIMITER_RELEASE))
+        self._gain = 1.0
+        self._pending = None
+
+    def __call__(self, block: numpy.ndarray) -> numpy.ndarray:
+        if self._pending is not None:
+            block = numpy.concatenate([self._pending, block])
+        usable = len(block) // self.block * self.block
+        self._pending = block[usable:]
+        return self._apply(block[:usable])
+
+    def flush(self) -> numpy.ndarray:
+        block, self._pending = self._pending, None
+        return self._apply(block) if block is not None and len(block) else block
+
+    def _apply(self, block: numpy.ndarray) -> numpy.ndarray:
+        if not len(block):
+            return block
+        peaks = numpy.abs(block).reshape(-1, min(self.block, len(block)), block.shape[1]).max(axis=(1, 2))
+        targets = numpy.minimum(1.0, self.limit / numpy.maximum(peaks, 1e-9))
+        gains = numpy.empty_like(targets)
+        gain = self._gain
+        for i, target in enumerate(targets):
+            gain = min(target, gain + (1.0 - gain) * self.recover)
+            gains[i] = gain
+        self._gain = gain
+        return block * numpy.repeat(gains, len(block) // len(gains))[:, None] / self.limit
+
+
+class AudioChain:
+    """
+    The degradation of the ffmpeg filter graph on blocks of PCM:
+    volume(saturation) -> alimiter(0.5) -> volume(0.8) -> lowpass -> amix with hiss -> lowpass 13301 Hz.
+    The hiss is aevalsrc=-2+random(0) (uniform in [-2, -1)) scaled by noise_volume on every channel, amix
+    halves both inputs.
+    """
+
+    def __init__(self, saturation: float, lowpass: float, noise_volume: float,
+                 rate: int = AUDIO_RATE, channels: int = AUDIO_CHANNELS, seed: Optional[int] = None):
+        self.saturation = saturation
+        self.noise_volume = noise_volume
+        self.limiter = Limiter(0.5, rate)
+        self.lowpass = FIRFilter(lowpass_taps(lowpass, rate), channels)
+        self.output_lowpass = FIRFilter(lowpass_taps(OUTPUT_LOWPASS, rate), channels)
+        self.random = numpy.random.default_rng(seed)
+
+    def __call__(self, block: numpy.ndarray) -> numpy.ndarray:
+        return self._mix(self.lowpass(self.limiter(block * self.saturation) * 0.8))
+
+    def flush(self) -> numpy.ndarray:
+        tail = self.limiter.flush()
+        if tail is not None and len(tail):
+            out = [self._mix(self.lowpass(tail * 0.8))]
+        else:
+            out = []
+        out.append(self._mix(self.lowpass.flush()))
+        out.append(self.output_lowpass.flush())
+        return numpy.concatenate(out)
+
+    def _mix(self, block: numpy.ndarray) -> numpy.ndarray:
+        hiss = (self.random.random((len(block), 1)) - 2.0) * self.noise_volume
+        return self.output_lowpass((block + hiss) / 2)
+
+
+class AudioStream:
+    """
+    Decodes the audio of `path` through an ffmpeg pipe, runs it through `chain` block by block on a thread
+    and writes the result as AUDIO_FORMAT PCM to a file descriptor, the encoder reads the other end.
+    """
+
+    def __init__(self, path: Path, chain: AudioChain, start: float = 0.0):
+        self.path = path
+        self.chain = chain
+        self.start_time = start
+        self.samples_written = 0
+        self._process: Optional[subprocess.Popen] = None
+        self._thread: Optional[threading.Thread] = None
+        self._first: Optional[numpy.ndarray] = None
+        self._stopped = threading.Event()
+        self._error: Optional[BaseException] = None
+
+    def open(self) -> bool:
+        """
+        Starts decoding, False when the source has no audio
+        """
+        input_args = {'ss': self.start_time} if self.start_time > 0 else {}
+        command = (
+            ffmpeg
+            .input(str(self.path), **input_args)
+            .audio
+            .output('pipe:', format=AUDIO_FORMAT, ac=AUDIO_CHANNELS, ar=AUDIO_RATE)
+            .global_args('-loglevel', 'error', '-nostdin')
+        )
+        logger.debug(' '.join(command.compile()))
+        self._process = start_ffmpeg(command.compile(), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        self._first = self._read()
+        if self._first is None:
+            self._process.wait()
+            logger.debug(f'No audio in {self.path}: {self._process.stderr.read().decode(errors="replace").strip()}')
+            return False
+        threading.Thread(target=self._process.stderr.read, daemon=True).start()  # keep stderr drained
+        return True
+
+    def input_args(self) -> dict:
+        return {'format': AUDIO_FORMAT, 'ac': AUDIO_CHANNELS, 'ar': AUDIO_RATE}
+
+    def start(self, fd: int):
+        """
+        Streams the processed audio into fd and closes it at the end
+        """
+        self._thread = threading.Thread(target=self._run, args=(fd,), daemon=True)
+        self._thread.start()
+
+    def _read(self) -> Optional[numpy.ndarray]:
+        data = self._process.stdout.read(BLOCK_SAMPLES * AUDIO_CHANNELS * 4)
+        if not data:
+            return None
+        usable = len(data) // (AUDIO_CHANNELS * 4) * AUDIO_CHANNELS * 4
+        return numpy.frombuffer(data[:usable], dtype=numpy.float32).reshape(-1, AUDIO_CHANNELS)
+
+    def _run(self, fd: int):
+        try:
+            with open(fd, 'wb') as out:
+                block = self._first
+                while block is not None and not self._stopped.is_set():
+                    self._write(out, self.chain(block))
+                    block = self._read()
+                if not self._stopped.is_set():
+                    self._write(out, self.chain.flush())
+        except BrokenPipeError:
+            logger.debug('Encoder closed the audio pipe')
+        except BaseException as e:
+            self._error = e
+        finally:
+            self._process.kill()
+            self._process.wait()
+
+    def _write(self, out, block: numpy.ndarray):
+        pcm = numpy.ascontiguousarray(block, dtype=numpy.float32)
+        out.write(memoryview(pcm).cast('B'))
+        self.samples_written += len(pcm)
+
+    def join(self):
+        if self._thread is not None:
+            self._thread.join()
+        if self._error is not None:
+            raise self._error
+
+    def stop(self):
+        self._stopped.set()
+        if self._process is not None and self._process.poll() is None:
+            self._process.kill()
+        if self._thread is not None:
+            self._thread.join()
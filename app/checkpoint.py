@@ -0,0 +1,200 @@
+import hashlib
+import json
+import os
+import re
+import shutil
+from pathlib import Path
+from typing import Callable, List, NamedTuple, Optional, Tuple
+
+from app.logs import logger
+
+MANIFEST_VERSION = 1
+
+# a closed piece is at most this many frames, what a crash can cost
+CHECKPOINT_FRAMES = 1500
+
+_PIECE_RE = re.compile(r'^frames_(\d+)_(\d+)(\.\w+)$')
+
+
+def config_hash(key: dict) -> str:
+    return hashlib.sha256(json.dumps(key, sort_keys=True, default=str).encode()).hexdigest()
+
+
+class Piece(NamedTuple):
+    start: int
+    end: int  # frame after the last one
+    path: Path
+
+
+class Checkpoint:
+    """
+    Directory with the closed pieces of a render and manifest.json. A piece is encoded under a temporary name
+    and renamed to frames_<start>_<end> once ffmpeg finished it, the names are the record of the finished
+    frames. The manifest holds the hash of the settings the frames depend on, the state they are rendered from
+    (the generator seeds and the head switching point, with the frame index they give the state of any frame)
+    and the last frame rendered in one go from `start`. The render covers frames start..end, end None for
+    the end of the video.
+    A resumed checkpoint keeps the state of its manifest, pieces of a render with another hash are deleted
+    when the checkpoint is opened.
+    """
+
+    def __init__(self, directory: Path, key_hash: str, state: dict, suffix: str, start: int = 0,
+                 end: Optional[int] = None):
+        self.directory = directory
+        self.hash = key_hash
+        self.state = state
+        self.suffix = suffix
+        self.start = start
+        self.end = end
+        self.manifest_path = directory / 'manifest.json'
+        self.end_of_stream: Optional[int] = None
+        self._saved = None
+
+    @classmethod
+    def open(cls, directory: Path, key_hash: str, state: dict, suffix: str, start: int = 0,
+             end: Optional[int] = None) -> 'Checkpoint':
+        checkpoint = cls(directory, key_hash, state, suffix, start, end)
+        directory.mkdir(parents=True, exist_ok=True)
+        manifest = checkpoint.read_manifest()
+        if manifest is not None and manifest.get("config_hash") == key_hash \
+                and manifest.get("version") == MANIFEST_VERSION:
+            checkpoint.state = manifest.get("state", state)
+            checkpoint.end_of_stream = manifest.get("end_of_stream")
+            logger.debug(f'Checkpoint {directory}: frames up to {manifest.get("last_frame")} done')
+        else:
+            if manifest is not None:
+                logger.debug(f'Checkpoint {directory} is from other settings, starting over')
+            for path in directory.iterdir():
+                if path.name.startswith(('frames_', 'partial_')):
+                    path.unlink()
+        checkpoint.save()
+        return checkpoint
+
+    def read_manifest(self) -> Optional[dict]:
+        try:
+            return json.loads(self.manifest_path.read_text())
+        except (OSError, ValueError):
+            return None
+
+    def save(self):
+        manifest = {
+            "version": MANIFEST_VERSION,
+            "config_hash": self.hash,
+            "state": self.state,
+            "last_frame": self.chain(self.start)[1] - 1,
+            "end_of_stream": self.end_of_stream,
+        }
+        if manifest == self._saved:
+            return
+        tmp = self.manifest_path.with_suffix('.tmp')
+        tmp.write_text(json.dumps(manifest, indent=2))
+        os.replace(tmp, self.manifest_path)
+        self._saved = manifest
+
+    def pieces(self) -> List[Piece]:
+        found = []
+        for path in self.directory.iterdir():
+            match = _PIECE_RE.match(path.name)
+            if match and match.group(3) == self.suffix:
+                found.append(Piece(int(match.group(1)), int(match.group(2)), path))
+        return sorted(found)
+
+    def chain(self, start: int) -> Tuple[List[Piece], int]:
+        """
+        Pieces covering the frames from start without a gap and the frame after them. Pieces of renders split
+        differently can overlap, the chain is the one reaching furthest
+        """
+        # furthest frame reachable from every piece boundary, walking back from the end
+        furthest = {}
+        step = {}
+        for piece in sorted(self.pieces(), key=lambda piece: piece.start, reverse=True):
+            reach = furthest.get(piece.end, piece.end)
+            if reach > furthest.get(piece.start, piece.start):
+                furthest[piece.start] = reach
+                step[piece.start] = piece
+        chain = []
+        position = start
+        while position in step:
+            chain.append(step[position])
+            position = step[position].end
+        return chain, position
+
+    def resume_frame(self, start: int, end: Optional[int]) -> Optional[int]:
+        """
+        First frame of start..end to render, None when all of them are
+        """
+        if self.end_of_stream is not None:
+            end = self.end_of_stream if end is None else min(end, self.end_of_stream)
+        position = self.chain(start)[1]
+        return None if end is not None and position >= end else position
+
+    def segment_done(self, start: int, end: Optional[int], frames: int):
+        """
+        Frames start..end were rendered to the end, `frames` of them: fewer than asked means the video ended
+        """
+        if end is None or start + frames < end:
+            self.end_of_stream = start + frames
+
+    def complete(self) -> bool:
+        return self.resume_frame(self.start, self.end) is None
+
+    def piece_path(self, start: int, end: int) -> Path:
+        return self.directory / f'frames_{start:07d}_{end:07d}{self.suffix}'
+
+    def partial_path(self, start: int) -> Path:
+        return self.directory / f'partial_{start:07d}{self.suffix}'
+
+    def remove(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+class PieceWriter:
+    """
+    Encoder interface writing into pieces of a Checkpoint, each of at most `frames` frames. make_writer(path)
+    gives the encoder of a piece. A piece is closed and renamed into the checkpoint when it is full and on
+    close(), so a stopped render keeps every frame it wrote. abort() drops the piece being written
+    """
+
+    def __init__(self, checkpoint: Checkpoint, make_writer: Callable, start: int, frames: int = CHECKPOINT_FRAMES,
+                 on_piece: Optional[Callable[[Piece], None]] = None):
+        self.checkpoint = checkpoint
+        self.make_writer = make_writer
+        self.frames = frames
+        self.on_piece = on_piece
+        self.path = checkpoint.directory
+        self.frames_written = 0
+        self._start = start
+        self._writer = None
+
+    def open(self):
+        return self
+
+    def write(self, frame):
+        if self._writer is None:
+            self._writer = self.make_writer(self.checkpoint.partial_path(self._start)).open()
+        self._writer.write(frame)
+        self.frames_written += 1
+        if self._writer.frames_written == self.frames:
+            self._close_piece()
+
+    def _close_piece(self):
+        writer, self._writer = self._writer, None
+        writer.close()
+        end = self._start + writer.frames_written
+        piece = Piece(self._start, end, self.checkpoint.piece_path(self._start, end))
+        os.replace(writer.path, piece.path)
+        self._start = end
+        if self.on_piece is not None:
+            self.on_piece(piece)
+
+    def close(self):
+        if self._writer is not None and self._writer.frames_written:
+            self._close_piece()
+        elif self._writer is not None:
+            self.abort()
+
+    def abort(self):
+        if self._writer is not None:
+            self._writer.abort()
+            self._writer.path.unlink(missing_ok=True)
+            self._writer = None
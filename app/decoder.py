@@ -0,0 +1,225 @@
+import queue
+import shutil
+import subprocess
+import tempfile
+import threading
+from fractions import Fraction
+from functools import partial
+from pathlib import Path
+from typing import Optional, Tuple
+
+import cv2
+import ffmpeg
+import numpy
+from imutils.video import FileVideoStream
+
+from app.frame_queue import DEFAULT_QUEUE_BUDGET, FrameQueue, queue_frames
+from app.funcs import start_ffmpeg
+from app.logs import logger
+from app.ntsc import bgr2yuv
+
+# planar full range BT.601 YCbCr, see app.ntsc.yuv2yiq
+YUV_PIX_FMT = 'yuv444p'
+
+
+class DecoderError(RuntimeError):
+    pass
+
+
+def probe_video(path: Path) -> Optional[dict]:
+    """
+    Size, frame rate and exact frame count of the first video stream. The count comes from the packets of
+    the stream, not from the container header cv2 estimates it from. None without a working ffprobe
+    """
+    if shutil.which('ffprobe') is None:
+        return None
+    try:
+        info = ffmpeg.probe(str(path), select_streams='v:0', count_packets=None)
+    except ffmpeg.Error as e:
+        logger.debug(f'ffprobe failed: {e.stderr}')
+        return None
+    if not info['streams']:
+        return None
+    stream = info['streams'][0]
+    return {
+        "width": int(stream['width']),
+        "height": int(stream['height']),
+        "frames_count": int(stream.get('nb_read_packets', 0)),
+        "orig_fps": float(Fraction(stream.get('avg_frame_rate', '0/1'))) or float(Fraction(stream['r_frame_rate'])),
+    }
+
+
+class FFmpegVideoStream:
+    """
+    Drop-in for imutils FileVideoStream: ffmpeg decodes and scales to width x height bgr24 rawvideo on a pipe
+    and a reader thread readinto()s every frame into a buffer of a pool. read() hands a buffer out, release()
+    gives it back for reuse, so decoding allocates nothing per frame once the pool is warm. The pool grows up to
+    as many frames as fit in `budget` bytes (queued and held by the consumer together), the reader blocks until
+    a buffer is released after that.
+    read() raises DecoderError at the end of the stream when ffmpeg failed, or whatever stopped the reader.
+
+    pix_fmt 'bgr24' gives interleaved (h, w, 3) frames, YUV_PIX_FMT planar (3, h, w) ones.
+    """
+
+    def __init__(self, path: Path, width: int, height: int, start: float = 0.0,
+                 budget: int = DEFAULT_QUEUE_BUDGET // 2, pix_fmt: str = 'bgr24'):
+        self.path = path
+        self.width = width
+        self.height = height
+        self.pix_fmt = pix_fmt
+        self.shape = (3, height, width) if pix_fmt == YUV_PIX_FMT else (height, width, 3)
+        self.start_time = start
+        self.frames_read = 0
+        self.buffers = queue_frames(budget, (width, height))
+        self._allocated = 0
+        self._free: queue.Queue = queue.Queue()
+        self.queue = FrameQueue(budget, 'decode')
+        self._process: Optional[subprocess.Popen] = None
+        self._thread: Optional[threading.Thread] = None
+        self._ended = False
+        self._error: Optional[BaseException] = None
+        self._log = None
+        self._stopped = threading.Event()
+
+    def start(self):
+        input_args = {'ss': self.start_time} if self.start_time > 0 else {}
+        # bilinear is what cv2.resize did in prepare_frame
+        scale_args = {'flags': 'bilinear'}
+        if self.pix_fmt == YUV_PIX_FMT:
+            scale_args.update(out_color_matrix='bt601', out_range='full')
+        command = (
+            ffmpeg
+            .input(str(self.path), **input_args)
+            .video
+            .filter('scale', self.width, self.height, **scale_args)
+            # one frame out per decoded frame: a seek lands between timestamps and a constant rate output would
+            # fill the gap with a duplicate
+            .output('pipe:', format='rawvideo', pix_fmt=self.pix_fmt, vsync='passthrough')
+            .global_args('-loglevel', 'error', '-nostdin')
+        )
+        self._log = tempfile.TemporaryFile()
+        self._process = start_ffmpeg(command.compile(), stdout=subprocess.PIPE, stderr=self._log)
+        self._thread = threading.Thread(target=self._update, daemon=True)
+        self._thread.start()
+        return self
+
+    def _update(self):
+        stdout = self._process.stdout
+        try:
+            while not self._stopped.is_set():
+                frame = self._buffer()
+                if frame is None:  # stop() while waiting for a buffer
+                    break
+                view = memoryview(frame).cast('B')
+                filled = 0
+                while filled < len(view):
+                    count = stdout.readinto(view[filled:])
+                    if not count:
+                        break
+                    filled += count
+                if filled < len(view):
+                    if filled and not self._stopped.is_set():
+                        logger.warning(f'Truncated last frame ({filled} of {len(view)} bytes) in {self.path}')
+                    break
+                self.queue.put(frame)
+            if not self._stopped.is_set():
+                code = self._process.wait()
+                if code != 0:
+                    self._error = DecoderError(f'ffmpeg exited with {code} while decoding {self.path}: '
+                                               f'{self.error_log()}')
+        except BaseException as e:
+            self._error = e
+        finally:
+            # read() must see the end even when the reader failed
+            self.queue.put(None)
+
+    def error_log(self) -> str:
+        self._log.seek(0)
+        return self._log.read().decode(errors='replace').strip()
+
+    def _buffer(self) -> Optional[numpy.ndarray]:
+        try:
+            return self._free.get_nowait()
+        except queue.Empty:
+            pass
+        if self._allocated < self.buffers:
+            self._allocated += 1
+            return numpy.empty(self.shape, dtype=numpy.uint8)
+        return self._free.get()
+
+    def read(self) -> Optional[numpy.ndarray]:
+        """
+        Next frame, None at the end of the stream
+        """
+        if self._ended:
+            return None
+        frame = self.queue.get()
+        if frame is None:
+            self._ended = True
+            if self._error is not None:
+                raise self._error
+        else:
+            self.frames_read += 1
+        return frame
+
+    def release(self, frame: Optional[numpy.ndarray]):
+        if frame is not None:
+            self._free.put(frame)
+
+    def more(self) -> bool:
+        return not self._ended
+
+    def running(self) -> bool:
+        return self.more()
+
+    def stop(self):
+        self._stopped.set()
+        self._free.put(None)
+        if self._process is not None:
+            self._process.kill()  # the reader sees end of stream
+            self._process.wait()
+        if self._thread is not None:
+            self._thread.join()
+        if self._process is not None:
+            self._process.stdout.close()
+            self._log.close()
+
+
+def resize_frame(frame: Optional[numpy.ndarray], size: Tuple[int, int], yuv: bool = False) -> Optional[numpy.ndarray]:
+    if frame is None:
+        return frame
+    if (frame.shape[1], frame.shape[0]) != size:
+        frame = cv2.resize(frame, size)
+    return bgr2yuv(frame) if yuv else frame
+
+
+class CV2VideoStream(FileVideoStream):
+    """
+    FileVideoStream with the FFmpegVideoStream interface, frames are allocated by cv2 and never recycled.
+    Frames are resized to width x height on the reader thread before they are queued, the queue holds at most
+    `budget` bytes of them. With YUV_PIX_FMT the frames are converted to planar YUV there too
+    """
+
+    def __init__(self, path: Path, width: int, height: int, budget: int = DEFAULT_QUEUE_BUDGET // 2,
+                 pix_fmt: str = 'bgr24'):
+        transform = partial(resize_frame, size=(width, height), yuv=pix_fmt == YUV_PIX_FMT)
+        super().__init__(path=str(path), transform=transform)
+        self.queue = self.Q = FrameQueue(budget, 'decode')
+
+    def release(self, frame: Optional[numpy.ndarray]):
+        pass
+
+
+def open_video_stream(path: Path, width: int, height: int, start: float = 0.0,
+                      budget: int = DEFAULT_QUEUE_BUDGET // 2, pix_fmt: str = 'bgr24'):
+    """
+    Stream of pix_fmt frames scaled to width x height, reading ahead at most `budget` bytes: FFmpegVideoStream
+    when an ffmpeg executable is on PATH, FileVideoStream (cv2) otherwise. Not started
+    """
+    if shutil.which('ffmpeg') is not None:
+        return FFmpegVideoStream(path, width, height, start=start, budget=budget, pix_fmt=pix_fmt)
+    logger.debug('ffmpeg not found, decoding with cv2')
+    stream = CV2VideoStream(path, width, height, budget=budget, pix_fmt=pix_fmt)
+    if start > 0:
+        stream.stream.set(cv2.CAP_PROP_POS_MSEC, start * 1000)
+    return stream
@@ -0,0 +1,241 @@
+import os
+import subprocess
+from pathlib import Path
+from typing import List, Optional
+
+import ffmpeg
+import numpy
+
+from app.audio import AudioStream
+from app.decoder import YUV_PIX_FMT
+from app.funcs import start_ffmpeg
+from app.logs import logger
+
+VIDEO_CODEC = 'libx264'
+VIDEO_CRF = 18
+LOSSLESS_VIDEO_CODEC = 'ffv1'
+# strength of the GIF dithering pattern, 0 (strong) to 5 (faint)
+GIF_BAYER_SCALE = 3
+
+
+class EncoderError(RuntimeError):
+    pass
+
+
+def video_args(suffix: str, lossless: bool) -> dict:
+    if suffix == '.gif':
+        return {}
+    if lossless:
+        return {'vcodec': LOSSLESS_VIDEO_CODEC}
+    return {'vcodec': VIDEO_CODEC, 'crf': VIDEO_CRF, 'pix_fmt': 'yuv420p'}
+
+
+def gif_palette(video):
+    """
+    A palette for every frame from its own colours (palettegen stats_mode=single, paletteuse new=1) instead of
+    the fixed one of the gif encoder. ffmpeg holds a frame at a time for it, however long the GIF is.
+    Ordered dithering stays put from frame to frame, the GIF comes out smaller than with error diffusion
+    """
+    split = video.filter_multi_output('split')
+    palette = split[0].filter('palettegen', stats_mode='single', reserve_transparent=0)
+    return ffmpeg.filter([split[1], palette], 'paletteuse', new=1, dither='bayer', bayer_scale=GIF_BAYER_SCALE)
+
+
+def audio_args(suffix: str, copy: bool) -> dict:
+    if suffix == '.gif':
+        return {'an': None}
+    if copy:
+        return {'acodec': 'copy'}
+    return {'acodec': 'flac' if suffix == '.mkv' else 'aac'}
+
+
+class FFmpegVideoWriter:
+    """
+    Encodes raw frames streamed into an ffmpeg process and muxes the audio of `audio` (the source video or a
+    processed track, the first audio stream if it has one) in the same pass, straight into `path`.
+    Frames are width x height in pix_fmt, bgr24 interleaved or YUV_PIX_FMT planar, and are written to the pipe
+    without copies. ffmpeg upscales them `scale` times with nearest neighbour, so only render size frames
+    cross the pipe. ffmpeg logs to a file in scratch_dir. The audio starts audio_start seconds into `audio`.
+
+    With an opened audio_stream the audio comes from it instead, as PCM through a second pipe that ffmpeg
+    inherits as file descriptor (posix only).
+    """
+
+    def __init__(self, path: Path, width: int, height: int, fps: float, scratch_dir: Path,
+                 pix_fmt: str = 'bgr24', audio: Optional[Path] = None, copy_audio: bool = True,
+                 lossless: bool = False, audio_stream: Optional[AudioStream] = None, audio_start: float = 0.0,
+                 scale: int = 1):
+        self.path = path
+        self.width = width
+        self.height = height
+        self.fps = fps
+        self.pix_fmt = pix_fmt
+        self.audio = audio
+        self.copy_audio = copy_audio
+        self.lossless = lossless
+        self.audio_stream = audio_stream
+        self.audio_start = audio_start
+        self.scale = scale
+        self.log_path = scratch_dir / f'ffmpeg_{path.stem}.log'
+        self.frames_written = 0
+        self._log = None
+        self._process: Optional[subprocess.Popen] = None
+
+    def video_input(self):
+        video = ffmpeg.input(
+            'pipe:', format='rawvideo', pix_fmt=self.pix_fmt, s=f'{self.width}x{self.height}', framerate=self.fps,
+        ).video
+        if self.scale != 1:
+            video = video.filter('scale', w=f'iw*{self.scale}', h=f'ih*{self.scale}', flags='neighbor')
+        if self.pix_fmt == YUV_PIX_FMT:
+            # the decoder hands out full range BT.601, encoders expect limited range
+            video = video.filter('scale', in_range='full', out_range='limited',
+                                 in_color_matrix='bt601', out_color_matrix='bt601')
+        return video
+
+    def video_args(self) -> dict:
+        return video_args(self.path.suffix.lower(), self.lossless)
+
+    def command(self, audio_fd: Optional[int] = None):
+        suffix = self.path.suffix.lower()
+        streams = [gif_palette(self.video_input()) if suffix == '.gif' else self.video_input()]
+        copy_audio = self.copy_audio
+        if audio_fd is not None:
+            streams.append(ffmpeg.input(f'pipe:{audio_fd}', **self.audio_stream.input_args()).audio)
+            copy_audio = False
+        elif self.audio is not None and suffix != '.gif':
+            input_args = {'ss': self.audio_start} if self.audio_start > 0 else {}
+            streams.append(ffmpeg.input(str(self.audio), **input_args)['a?'])
+        return ffmpeg.output(
+            *streams, str(self.path), shortest=None,
+            **self.video_args(), **audio_args(suffix, copy_audio),
+        ).overwrite_output().global_args('-loglevel', 'error', '-nostats')
+
+    def open(self):
+        read_fd = write_fd = None
+        if self.audio_stream is not None and self.path.suffix.lower() != '.gif':
+            read_fd, write_fd = os.pipe()
+        args = self.command(read_fd).compile()
+        logger.debug(' '.join(args))
+        self._log = open(self.log_path, 'wb')
+        self._process = start_ffmpeg(args, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=self._log,
+                                     pass_fds=() if read_fd is None else (read_fd,))
+        if read_fd is not None:
+            os.close(read_fd)
+            self.audio_stream.start(write_fd)
+        return self
+
+    def write(self, frame: numpy.ndarray):
+        try:
+            self._process.stdin.write(memoryview(numpy.ascontiguousarray(frame)).cast('B'))
+        except BrokenPipeError:
+            self._process.wait()
+            raise EncoderError(f'ffmpeg exited while encoding {self.path}: {self.error_log()}')
+        self.frames_written += 1
+
+    def close(self):
+        """
+        Finishes the file, raises EncoderError when ffmpeg failed
+        """
+        try:
+            self._process.stdin.close()
+        except BrokenPipeError:
+            pass
+        code = self._process.wait()
+        self._log.close()
+        if self.audio_stream is not None:
+            self.audio_stream.join()
+        if code != 0:
+            raise EncoderError(f'ffmpeg exited with {code} while encoding {self.path}: {self.error_log()}')
+
+    def abort(self):
+        if self._process is not None and self._process.poll() is None:
+            self._process.kill()
+            self._process.wait()
+        if self.audio_stream is not None:
+            self.audio_stream.stop()
+        if self._log is not None:
+            self._log.close()
+
+    def error_log(self) -> str:
+        return read_log(self.log_path)
+
+
+def read_log(log_path: Path) -> str:
+    if not log_path.exists():
+        return ''
+    return log_path.read_text(errors='replace').strip()[-2000:]
+
+
+class FFmpegConcat(FFmpegVideoWriter):
+    """
+    Joins encoded pieces of one video end to end into `path` with the concat demuxer, copying the video stream,
+    and adds the audio the same way FFmpegVideoWriter does. The pieces must share codec and parameters
+    """
+
+    def __init__(self, path: Path, pieces: List[Path], scratch_dir: Path, **kwargs):
+        super().__init__(path, width=0, height=0, fps=0, scratch_dir=scratch_dir, **kwargs)
+        self.pieces = pieces
+        self.list_path = scratch_dir / f'concat_{path.stem}.txt'
+        self.list_path.write_text(''.join(f"file '{concat_escape(piece.resolve())}'\n" for piece in pieces))
+
+    def video_input(self):
+        return ffmpeg.input(str(self.list_path), format='concat', safe=0).video
+
+    def video_args(self) -> dict:
+        return {'vcodec': 'copy'}
+
+    def run(self):
+        self.open()
+        self.close()
+
+
+def concat_escape(path: Path) -> str:
+    return str(path).replace("'", "'\\''")
+
+
+class FFmpegJob:
+    """
+    ffmpeg command producing `output` in a background process, logging to a file in scratch_dir
+    """
+
+    def __init__(self, command, output: Path, scratch_dir: Path):
+        self.command = command
+        self.output = output
+        self.log_path = scratch_dir / f'ffmpeg_{output.stem}.log'
+        self._process: Optional[subprocess.Popen] = None
+
+    def start(self):
+        args = self.command.compile()
+        logger.debug(' '.join(args))
+        with open(self.log_path, 'wb') as log:
+            self._process = start_ffmpeg(args, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=log)
+        return self
+
+    def wait(self) -> Path:
+        code = self._process.wait()
+        if code != 0:
+            raise EncoderError(f'ffmpeg exited with {code} while writing {self.output}: {read_log(self.log_path)}')
+        return self.output
+
+    def abort(self):
+        if self._process.poll() is None:
+            self._process.kill()
+            self._process.wait()
+
+
+def mux(video: Path, audio: Path, dst: Path, audio_start: float = 0.0):
+    """
+    Copies the video stream of `video` into dst and adds the audio of `audio` from audio_start seconds on,
+    encoded for dst's container
+    """
+    input_args = {'ss': audio_start} if audio_start > 0 else {}
+    command = ffmpeg.output(
+        ffmpeg.input(str(video)).video, ffmpeg.input(str(audio), **input_args).audio, str(dst), shortest=None,
+        vcodec='copy', **audio_args(dst.suffix.lower(), copy=False),
+    ).overwrite_output().global_args('-loglevel', 'error')
+    logger.debug(' '.join(command.compile()))
+    try:
+        command.run(capture_stderr=True)
+    except ffmpeg.Error as e:
+        raise EncoderError(f'ffmpeg failed to mux {dst}: {e.stderr.decode(errors="replace")}')
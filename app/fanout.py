@@ -0,0 +1,151 @@
+import tempfile
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import List, NamedTuple, Optional
+
+from app.audio import AudioChain, AudioStream, pcm_pipes_supported
+from app.decoder import YUV_PIX_FMT, open_video_stream
+from app.frame_queue import QueuedWriter
+from app.kernels import start_threads
+from app.logs import logger
+from app.ntsc import Ntsc
+
+
+class Target(NamedTuple):
+    nt: Ntsc
+    target_file: Path
+    height: Optional[int] = None  # render height, input_heigth of the render when None
+
+
+def variant(renderer, target: Target):
+    """
+    Renderer of one target: the settings of `renderer` with the effect, output and height of the target
+    """
+    child = type(renderer)()
+    child.render_data = {
+        **renderer.render_data,
+        "nt": target.nt,
+        "target_file": target.target_file,
+        "input_heigth": target.height or renderer.render_data["input_heigth"],
+    }
+    child.mainEffect = renderer.mainEffect
+    child.lossless = renderer.lossless
+    child.set_up()
+    child.running = True
+    return child
+
+
+def render_targets(renderer, targets: List[Target]):
+    """
+    Renders one source into every target with a single decode. Frames are decoded once at the largest render
+    size, each variant scales them down to its own and runs its effect on a pool of threads (the effect spends
+    most of its time in numpy and OpenCV, which let other threads run), and every variant has its own encoder.
+    Frames of a target rendered at the largest size are the same as from a render of its own.
+    No checkpoints or segments, the variants are what runs in parallel.
+    """
+    variants = [variant(renderer, target) for target in targets]
+    lead = max(variants, key=lambda child: child.config.get("render_wh")[1])
+    in_frame, out_frame = renderer.frame_range()
+    input_video = renderer.render_data["input_video"]
+    orig_path = input_video["path"].resolve()
+    audio_start = in_frame / input_video["orig_fps"]
+    if renderer.audio_process and not pcm_pipes_supported():
+        logger.warning('Audio processing of several targets needs PCM pipes, copying the source audio instead')
+
+    with tempfile.TemporaryDirectory(prefix='ntscqt-', dir=renderer.render_data.get("scratch_dir")) as scratch:
+        scratch = Path(scratch)
+        encoders = []
+        for child in variants:
+            audio_stream = None
+            if renderer.audio_process and pcm_pipes_supported():
+                audio_stream = AudioStream(orig_path, AudioChain(
+                    saturation=renderer.audio_sat_beforevol,
+                    lowpass=renderer.audio_lowpass,
+                    noise_volume=renderer.audio_noise_volume,
+                ), start=audio_start)
+                if not audio_stream.open():
+                    audio_stream = None
+            target_file = child.render_data["target_file"]
+            encoders.append(child.video_writer(
+                path=target_file.resolve(),
+                scratch_dir=scratch,
+                audio=orig_path,
+                copy_audio=target_file.suffix in (input_video["suffix"], '.mkv'),
+                audio_stream=audio_stream,
+                audio_start=audio_start,
+            ))
+            logger.debug(f'Target {target_file}: {child.config.get("render_wh")}')
+
+        renderer.renderStateChanged.emit(True)
+        cap = open_video_stream(
+            path=input_video["path"],
+            width=lead.config.get("render_wh")[0],
+            height=lead.config.get("render_wh")[1],
+            start=max(0.0, (in_frame - 0.5) / input_video["orig_fps"]) if in_frame else 0.0,
+            budget=lead.config.get("decode_queue_bytes"),
+            pix_fmt=YUV_PIX_FMT if lead.config.get("yuv_pipeline") else 'bgr24',
+        ).start()
+        # the variants read the frames of one buffer, filled by the lead
+        buffer = defaultdict(lambda: None)
+        for child in variants:
+            child.cap = cap
+            child.buffer = buffer
+        writers = []
+        finished = False
+
+        def render_variant(child, index: int):
+            child.current_frame_index = index
+            nt = child.render_data["nt"]
+            nt.begin_frame(index)
+            return child.produce_frame()
+
+        workers = min(len(variants), renderer.workers())
+        start_threads()
+        try:
+            for child, encoder in zip(variants, encoders):
+                encoder.open()
+                writers.append(QueuedWriter(encoder.write, child.config.get("encode_queue_bytes")))
+            with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='variant') as pool:
+                index = in_frame - 1
+                while cap.more() and (out_frame is None or index + 1 < out_frame) and renderer.running:
+                    if renderer.pause:
+                        time.sleep(0.3)
+                        continue
+                    index += 1
+                    lead.current_frame_index = index
+                    lead.update_buffer()
+                    if buffer[index] is None:
+                        break
+                    # every variant is done with the frames before the lead moves on and releases them
+                    frames = list(pool.map(render_variant, variants, [index] * len(variants)))
+                    if any(frame is False for frame in frames):
+                        break
+                    for writer, frame in zip(writers, frames):
+                        writer.write(frame)
+                    renderer.increment_progress.emit()
+                    renderer.sendStatus.emit(
+                        f'[CV2] Render progress: {index}/{out_frame or input_video["frames_count"]} '
+                        f'into {len(variants)} targets'
+                    )
+            finished = renderer.running
+        finally:
+            for child in variants:
+                child.render_data["nt"].begin_frame(None)
+            cap.stop()
+            try:
+                for writer in writers:
+                    writer.close()
+            finally:
+                for encoder in encoders:
+                    if finished:
+                        encoder.close()
+                    else:
+                        encoder.abort()
+
+    renderer.renderStateChanged.emit(False)
+    if not finished:
+        renderer.sendStatus.emit('Render stopped')
+        return
+    renderer.sendStatus.emit(f'[DONE] Rendered {len(variants)} targets')
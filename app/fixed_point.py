@@ -0,0 +1,30 @@
+import numpy
+
+from app import kernels
+from app.kernels import INT32_MAX, INT32_MIN
+
+# fractional bits of the filter coefficients and gains (Q12)
+SHIFT = 12
+
+
+def coefficient(value: float) -> int:
+    return int(round(value * (1 << SHIFT)))
+
+
+def saturate(values: numpy.ndarray) -> numpy.ndarray:
+    return numpy.clip(values, INT32_MIN, INT32_MAX).astype(numpy.int32)
+
+
+def fixed_lowpass(rows: numpy.ndarray, alpha: float, passes: int, reset: float = 0.0) -> numpy.ndarray:
+    """
+    `passes` chained LowpassFilter(value=reset) over every row with a Q12 coefficient, int32 in and out
+    """
+    return kernels.active.lowpass_cascade_fixed(rows, coefficient(alpha), SHIFT, passes, int(reset))
+
+
+def fixed_emphasis(rows: numpy.ndarray, lowpassed: numpy.ndarray, gain: float) -> numpy.ndarray:
+    """
+    `rows + (rows - lowpassed) * gain` with a Q12 gain, saturated to int32
+    """
+    highpassed = rows.astype(numpy.int64) - lowpassed
+    return saturate(rows + ((highpassed * coefficient(gain) + (1 << (SHIFT - 1))) >> SHIFT))
@@ -0,0 +1,136 @@
+import threading
+import time
+from collections import deque
+from typing import Callable, Optional
+
+import numpy
+
+from app.logs import logger
+
+# memory the frames waiting between the pipeline stages may take, split between decode and encode
+DEFAULT_QUEUE_BUDGET = 512 * 1024 * 1024
+
+# the effect stage holds the current and the next frame while the decoder fills a third one
+MIN_QUEUE_FRAMES = 3
+
+MB = 1024 * 1024
+
+
+def frame_bytes(wh, channels: int = 3) -> int:
+    return wh[0] * wh[1] * channels
+
+
+def queue_frames(budget: int, wh) -> int:
+    """
+    How many frames of size wh fit in budget, never less than MIN_QUEUE_FRAMES
+    """
+    return max(MIN_QUEUE_FRAMES, budget // max(frame_bytes(wh), 1))
+
+
+class FrameQueue:
+    """
+    FIFO of frames bounded by the bytes they hold instead of their count. put() blocks while the queued frames
+    plus the new one would go over the budget, one frame is always admitted so a frame larger than the whole
+    budget cannot deadlock. None (end of stream) costs nothing.
+
+    Also a drop-in for the queue.Queue of imutils FileVideoStream (full/put/get/qsize).
+    """
+
+    def __init__(self, budget: int, name: str = ''):
+        self.budget = budget
+        self.name = name
+        self._items = deque()
+        self._bytes = 0
+        self._last_bytes = 0
+        self._cond = threading.Condition()
+        self.peak_bytes = 0
+        self.put_wait = 0.0  # seconds the producer spent blocked on a full queue
+        self.get_wait = 0.0  # seconds the consumer spent waiting on an empty one
+
+    @staticmethod
+    def _size(frame) -> int:
+        return frame.nbytes if isinstance(frame, numpy.ndarray) else 0
+
+    def put(self, frame, block: bool = True, timeout: Optional[float] = None):
+        size = self._size(frame)
+        with self._cond:
+            start = time.perf_counter()
+            while self._items and self._bytes + size > self.budget:
+                if not block or not self._cond.wait(timeout):
+                    raise TimeoutError(f'{self.name} queue is full')
+            self.put_wait += time.perf_counter() - start
+            self._items.append(frame)
+            self._bytes += size
+            self._last_bytes = size
+            self.peak_bytes = max(self.peak_bytes, self._bytes)
+            self._cond.notify_all()
+
+    def get(self, block: bool = True, timeout: Optional[float] = None):
+        with self._cond:
+            start = time.perf_counter()
+            while not self._items:
+                if not block or not self._cond.wait(timeout):
+                    raise TimeoutError(f'{self.name} queue is empty')
+            self.get_wait += time.perf_counter() - start
+            frame = self._items.popleft()
+            self._bytes -= self._size(frame)
+            self._cond.notify_all()
+            return frame
+
+    def full(self) -> bool:
+        with self._cond:
+            return bool(self._items) and self._bytes + self._last_bytes > self.budget
+
+    def qsize(self) -> int:
+        return len(self._items)
+
+    def nbytes(self) -> int:
+        return self._bytes
+
+    def stats(self) -> str:
+        return f'{self.name} {self.qsize()} ({self._bytes / MB:.1f}/{self.budget / MB:.1f} MB)'
+
+    def summary(self) -> str:
+        return (f'{self.name} queue: peak {self.peak_bytes / MB:.1f} of {self.budget / MB:.1f} MB, '
+                f'producer blocked {self.put_wait:.1f}s, consumer waited {self.get_wait:.1f}s')
+
+
+class QueuedWriter:
+    """
+    Calls write(frame) on a background thread, fed through a FrameQueue. The renderer only blocks when the
+    encoder falls a whole budget behind. Frames must not be modified after they are queued.
+    """
+
+    def __init__(self, write: Callable[[numpy.ndarray], None], budget: int, name: str = 'encode'):
+        self._write = write
+        self.queue = FrameQueue(budget, name)
+        self._error: Optional[BaseException] = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            frame = self.queue.get()
+            if frame is None:
+                break
+            if self._error is not None:
+                continue  # drain so the renderer never blocks on a dead writer
+            try:
+                self._write(frame)
+            except BaseException as e:
+                self._error = e
+
+    def write(self, frame: numpy.ndarray):
+        if self._error is not None:
+            raise self._error
+        self.queue.put(frame)
+
+    def close(self):
+        """
+        Waits until every queued frame is written
+        """
+        self.queue.put(None)
+        self._thread.join()
+        logger.debug(self.queue.summary())
+        if self._error is not None:
+            raise self._error
@@ -0,0 +1,68 @@
+from typing import Callable, List
+
+import numpy
+import scipy.fft
+
+# stage responses are evaluated on the rfft angular frequencies (radians per sample) of the padded scanline
+Response = Callable[[numpy.ndarray], numpy.ndarray]
+
+
+def lowpass_response(omega: numpy.ndarray, alpha: float, passes: int = 1) -> numpy.ndarray:
+    """
+    Frequency response of `passes` cascaded LowpassFilter.lowpass_array with the given alpha
+    """
+    return (alpha / (1.0 - (1.0 - alpha) * numpy.exp(-1j * omega))) ** passes
+
+
+def emphasis_response(omega: numpy.ndarray, alpha: float, gain: float, passes: int = 1) -> numpy.ndarray:
+    """
+    Frequency response of `samples + (samples - lowpassed) * gain`, where lowpassed went through `passes`
+    cascaded lowpass filters (a single pass is LowpassFilter.highpass_array)
+    """
+    return 1.0 + gain * (1.0 - lowpass_response(omega, alpha, passes))
+
+
+def advance_response(omega: numpy.ndarray, samples: int) -> numpy.ndarray:
+    """
+    Frequency response of reading a scanline `samples` ahead, i.e. `row[:-samples] = row[samples:]`
+    """
+    return numpy.exp(1j * omega * samples)
+
+
+def spectrum_mask_response(omega: numpy.ndarray, mask: numpy.ndarray) -> numpy.ndarray:
+    """
+    Frequency response of multiplying an fftshift-ed spectrum of len(mask) bins by mask
+    """
+    cols = mask.shape[0]
+    return numpy.interp(omega / (2 * numpy.pi) * cols + cols // 2, numpy.arange(cols), mask)
+
+
+def lowpass_settle(alpha: float, passes: int = 1, eps: float = 1e-4) -> int:
+    """
+    Number of samples after which the impulse response of the lowpass cascade is below eps
+    """
+    return passes * int(numpy.ceil(numpy.log(eps) / numpy.log(1.0 - alpha)))
+
+
+class FrequencyChain:
+    """
+    Consecutive linear per-scanline stages folded into one precomputed response, applied with a single
+    rfft multiply per row. Scanlines are edge padded by `margin` samples on both sides so the circular
+    convolution does not wrap the end of the line into its start. Not bit-exact with the stage by stage
+    integer pipeline, intermediate int32 truncation and filter reset values are not modelled.
+    """
+
+    def __init__(self, width: int, stages: List[Response], margin: int):
+        self.width = width
+        self.margin = min(margin, width)
+        self.size = scipy.fft.next_fast_len(width + 2 * self.margin, real=True)
+        omega = 2 * numpy.pi * numpy.fft.rfftfreq(self.size)
+        self.response = numpy.ones(omega.shape, dtype=numpy.complex128)
+        for stage in stages:
+            self.response *= stage(omega)
+
+    def apply(self, rows: numpy.ndarray):
+        padded = numpy.pad(rows, ((0, 0), (self.margin, self.size - self.width - self.margin)), mode='edge')
+        spectrum = scipy.fft.rfft(padded.astype(numpy.float32), axis=1)
+        spectrum *= self.response.astype(numpy.complex64)
+        rows[:] = scipy.fft.irfft(spectrum, n=self.size, axis=1)[:, self.margin:self.margin + self.width]
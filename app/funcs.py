@@ -1,3 +1,4 @@
+import subprocess
 from pathlib import Path
 
 import numpy
@@ -6,6 +7,14 @@ from PyQt5.QtWidgets import QFileDialog
 from app.logs import logger
 
 
+def start_ffmpeg(args, **kwargs) -> subprocess.Popen:
+    """
+    Popen for ffmpeg processes of a render. They run in a session of their own: a Ctrl+C in the terminal only
+    reaches the renderer, which then finishes what the processes write
+    """
+    return subprocess.Popen(args, start_new_session=True, **kwargs)
+
+
 def resize_to_height(wh, target_h):
     w, h = wh
     k = target_h / h
@@ -26,33 +35,6 @@ def pick_save_file(self, title='Render As', pre_path='', suffix: str = None) ->
     return path
 
 
-def trim_to_4width(img: numpy.ndarray) -> numpy.ndarray:
-    """
-    Workaround crash if image not divided by 4
-    """
-    height, width, channels = img.shape
-    logger.debug(f"┃ Image wh: {width}x{height} w%4={width % 4}")
-    if width % 4 != 0:
-        img = img[:, :width % 4 * -1]
-        height, width, channels = img.shape
-        logger.debug(f"┗FIX to wh: {width}x{height} w%4={width % 4}")
-    return img
-
-
-def expand_to_4width(img: numpy.ndarray) -> numpy.ndarray:
-    """
-    Workaround crash if image not divided by 4
-    """
-    height, width, channels = img.shape
-    logger.debug(f"┃ Image wh: {width}x{height} w%4={width % 4}")
-    d = width % 4
-    if d != 0:
-        img = numpy.concatenate((img, img[:, -1:(d + 1) * -1:-1]), axis=1)
-        height, width, channels = img.shape
-        logger.debug(f"┗FIX to wh: {width}x{height} w%4={width % 4}")
-    return img
-
-
 def set_ui_element(element, value):
     element.blockSignals(True)
     if isinstance(value, bool):
@@ -0,0 +1,176 @@
+"""
+Renders a video without the GUI. Rendering the same input into the same output with the same settings again
+resumes an interrupted or stopped (Ctrl+C) render from its checkpoint. Images (.png, .jpg, .jpeg, .webp) are
+rendered at their own resolution, band by band through the disk
+
+usage: python -m app.headless input output [--height H] [--seed N] [--template NAME] [--workers N]
+                              [--lossless] [--upscale-2x] [--no-effect] [--in FRAME] [--out FRAME]
+                              [--variant OUTPUT SEED_OR_TEMPLATE ...]
+
+With --variant the input is decoded once and rendered into every output, each with its own effect settings
+"""
+import argparse
+import json
+import signal
+import sys
+from pathlib import Path
+
+import cv2
+
+from app.Renderer import DefaultRenderer
+from app.decoder import probe_video
+from app.fanout import Target
+from app.logs import logger
+from app.ntsc import Ntsc, NumpyRandom, random_ntsc, set_parameters
+from app.segments import default_workers
+from app.tiled import IMAGE_SUFFIXES, render_image_file
+
+TEMPLATES_FILE = Path(__file__).absolute().parent.parent / 'builtin_templates.json'
+
+
+def input_video(path: Path) -> dict:
+    """
+    What NtscApp.open_video finds out about a video, without keeping the capture
+    """
+    cap = cv2.VideoCapture(str(path))
+    if not cap.isOpened():
+        raise FileNotFoundError(f'Cannot open {path}')
+    video = {
+        "width": int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)),
+        "height": int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)),
+        "frames_count": int(cap.get(cv2.CAP_PROP_FRAME_COUNT)),
+        "orig_fps": cap.get(cv2.CAP_PROP_FPS),
+        "path": path,
+        "suffix": path.suffix.lower(),
+    }
+    cap.release()
+    probe = probe_video(path)
+    if probe is not None:
+        video["frames_count"] = probe["frames_count"] or video["frames_count"]
+    return video
+
+
+def template_ntsc(name: str, seed: int = 0) -> Ntsc:
+    """
+    The default settings with the values of template `name`, set as NtscApp.nt_set_config does. Noise comes
+    from a generator seeded with `seed`
+    """
+    templates = json.loads(TEMPLATES_FILE.read_text())
+    if name not in templates:
+        raise KeyError(f'No template {name}, there are: {", ".join(templates)}')
+    nt = Ntsc(random=NumpyRandom(seed))
+    set_parameters(nt, templates[name])
+    return nt
+
+
+def seed_ntsc(seed: int) -> Ntsc:
+    # what NtscApp.update_seed does
+    nt = random_ntsc(seed)
+    nt._enable_ringing2 = True
+    return nt
+
+
+def effect_ntsc(spec: str) -> Ntsc:
+    """
+    A seed when spec is a number, a template name otherwise
+    """
+    return seed_ntsc(int(spec)) if spec.lstrip('-').isdigit() else template_ntsc(spec)
+
+
+def render(input_path: Path, output_path: Path, nt: Ntsc, height: int = None, workers: int = None,
+           lossless: bool = False, upscale_2x: bool = False, main_effect: bool = True,
+           in_frame: int = None, out_frame: int = None, renderer: DefaultRenderer = None,
+           **render_data) -> DefaultRenderer:
+    """
+    Renders input_path into output_path like the GUI does, frames in_frame..out_frame (out_frame excluded,
+    None for the start and the end of the video). Extra render_data keys go to the renderer as they are
+    (queue_budget, yuv_pipeline, scratch_dir,
+    checkpoint_dir, targets: a list of fanout.Target rendered from one decode instead of output_path). Returns the renderer, its running flag is
+    False when the render was stopped
+    """
+    video = input_video(input_path)
+    renderer = renderer or DefaultRenderer()
+    renderer.mainEffect = main_effect
+    renderer.lossless = lossless
+    renderer.audio_process = False
+    renderer.render_data = {
+        "target_file": output_path,
+        "nt": nt,
+        "input_video": video,
+        "input_heigth": height or video["height"],
+        "upscale_2x": upscale_2x,
+        "workers": workers or default_workers(),
+        "in_frame": in_frame,
+        "out_frame": out_frame,
+        **render_data,
+    }
+    renderer.run()
+    return renderer
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Render a video with the NTSC/VHS effect without the GUI')
+    parser.add_argument('input', type=Path)
+    parser.add_argument('output', type=Path)
+    parser.add_argument('--height', type=int, help='render height, the height of the input by default')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='seed of the random effect settings, or of the noise with --template')
+    parser.add_argument('--template', help='a template of builtin_templates.json')
+    parser.add_argument('--workers', type=int, help=f'processes rendering segments (default {default_workers()})')
+    parser.add_argument('--lossless', action='store_true', help='encode with a lossless codec, for .mkv outputs')
+    parser.add_argument('--upscale-2x', action='store_true', help='nearest neighbour 2x upscale of the output')
+    parser.add_argument('--no-effect', action='store_true', help='only scale and reencode')
+    parser.add_argument('--in', type=int, dest='in_frame', help='first frame to render')
+    parser.add_argument('--out', type=int, dest='out_frame', help='frame to stop at, not rendered')
+    parser.add_argument('--variant', nargs=2, action='append', default=[], metavar=('OUTPUT', 'SEED_OR_TEMPLATE'),
+                        help='render another output from the same decode, can be repeated')
+    args = parser.parse_args()
+    if args.lossless:
+        # ffv1 only goes into matroska, the GUI saves lossless renders as .mkv for the same reason
+        for output in [args.output] + [Path(output) for output, _ in args.variant]:
+            if output.suffix.lower() != '.mkv':
+                parser.error(f'--lossless needs .mkv outputs, not {output}')
+
+    nt = template_ntsc(args.template, args.seed) if args.template else seed_ntsc(args.seed)
+    if args.input.suffix.lower() in IMAGE_SUFFIXES:
+        try:
+            render_image_file(nt, args.input, args.output,
+                              progress=lambda done, total: print(f'Band {done}/{total}', end='\r', flush=True))
+        except Exception as e:
+            logger.exception(e)
+            sys.exit(1)
+        print(f'\nSaved {args.output}')
+        return
+
+    render_data = {}
+    if args.variant:
+        render_data["targets"] = [Target(nt, args.output)] + [
+            Target(effect_ntsc(spec), Path(output)) for output, spec in args.variant
+        ]
+    renderer = DefaultRenderer()
+
+    def show(status: str):
+        progress = status.startswith('[CV2] Render progress')
+        print(status, end='\r' if progress else '\n', flush=True)
+
+    def stop(signum, frame):
+        # the pieces done so far stay, the next run resumes from them. A second Ctrl+C ends the process
+        print('\nStopping...', flush=True)
+        renderer.stop()
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+
+    renderer.sendStatus.connect(show)
+    signal.signal(signal.SIGINT, stop)
+    try:
+        render(args.input, args.output, nt, height=args.height, workers=args.workers, lossless=args.lossless,
+               upscale_2x=args.upscale_2x, main_effect=not args.no_effect, in_frame=args.in_frame,
+               out_frame=args.out_frame, renderer=renderer, **render_data)
+    except Exception as e:
+        logger.exception(e)
+        sys.exit(1)
+    if not renderer.running:
+        sys.exit(130)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,209 @@
+import os
+from typing import Dict, Optional, Type
+
+import numpy
+import scipy.signal
+from scipy.signal import lfilter
+
+from app.logs import logger
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+INT32_MIN = -2 ** 31
+INT32_MAX = 2 ** 31 - 1
+
+
+class NumpyKernels:
+    """
+    Scanline recursions written with scipy/numpy, the reference every other backend has to match bit for bit
+    """
+    name = 'numpy'
+
+    @staticmethod
+    def lowpass_cascade(rows: numpy.ndarray, alpha: float, passes: int, reset: float = 0.0) -> numpy.ndarray:
+        """
+        `passes` chained LowpassFilter(value=reset).lowpass_array over every row, returns float64 rows
+        """
+        b, a = [alpha], [1, -(1.0 - alpha)]
+        out = rows
+        for _ in range(passes):
+            if reset == 0.0:
+                out = lfilter(b, a, out, axis=1)
+            else:
+                zi = numpy.full((out.shape[0], 1), scipy.signal.lfiltic(b, a, [reset])[0])
+                out = lfilter(b, a, out, axis=1, zi=zi)[0]
+        return out
+
+    @staticmethod
+    def lowpass_cascade_fixed(rows: numpy.ndarray, alpha: int, shift: int, passes: int,
+                              reset: int = 0) -> numpy.ndarray:
+        """
+        lowpass_cascade in integer arithmetic: alpha is a fixed-point coefficient with `shift` fractional bits,
+        every step is `y += (alpha * (x - y) + half) >> shift` with the product taken in int64 and the state
+        saturated to int32. Returns int32 rows
+        """
+        out = numpy.array(rows, dtype=numpy.int32)
+        half = 1 << (shift - 1)
+        for _ in range(passes):
+            y = numpy.full(out.shape[0], reset, dtype=numpy.int64)
+            for x in range(out.shape[1]):
+                y += (alpha * (out[:, x] - y) + half) >> shift
+                numpy.clip(y, INT32_MIN, INT32_MAX, out=y)
+                out[:, x] = y
+        return out
+
+    @staticmethod
+    def noise_recurrence(rows: numpy.ndarray, rnds: numpy.ndarray, noise: int = 0) -> int:
+        """
+        Adds `noise` to each sample, then `noise = int((noise + rnd) / 2)`, running across the rows in order.
+        Returns the noise left after the last sample
+        """
+        for row, rnd in zip(rows, rnds):
+            for x in range(row.shape[0]):
+                row[x] += noise
+                noise += int(rnd[x])
+                noise = int(noise / 2)
+        return noise
+
+    @staticmethod
+    def head_switch_shift(rows: numpy.ndarray, starts: numpy.ndarray, shifts: numpy.ndarray, twidth: int):
+        """
+        From column starts[i] on, row i is read `shifts[i]` samples further along a blank line of `twidth` samples
+        that wraps around
+        """
+        width = rows.shape[1]
+        for row, tx, shif in zip(rows, starts, shifts):
+            if shif == 0:
+                continue
+            tmp = numpy.zeros(twidth)
+            tmp[:width] = row
+            row[tx:] = tmp[(tx + twidth + shif + numpy.arange(width - tx)) % twidth]
+
+
+if numba is not None:
+    # cache=True keeps the compiled machine code next to this file, later runs skip the warm-up
+    @numba.njit(parallel=True, cache=True)
+    def _numba_lowpass_cascade(rows, alpha, passes, reset):
+        h, w = rows.shape
+        c = 1.0 - alpha
+        out = numpy.empty((h, w), dtype=numpy.float64)
+        for i in numba.prange(h):
+            for x in range(w):
+                out[i, x] = rows[i, x]
+            for _ in range(passes):
+                z = c * reset
+                for x in range(w):
+                    y = z + alpha * out[i, x]
+                    out[i, x] = y
+                    z = c * y
+        return out
+
+    @numba.njit(parallel=True, cache=True)
+    def _numba_lowpass_cascade_fixed(rows, alpha, shift, passes, reset):
+        h, w = rows.shape
+        half = 1 << (shift - 1)
+        out = numpy.empty((h, w), dtype=numpy.int32)
+        for i in numba.prange(h):
+            for x in range(w):
+                out[i, x] = rows[i, x]
+            for _ in range(passes):
+                y = numpy.int64(reset)
+                for x in range(w):
+                    y += (alpha * (numpy.int64(out[i, x]) - y) + half) >> shift
+                    y = min(max(y, INT32_MIN), INT32_MAX)
+                    out[i, x] = y
+        return out
+
+    @numba.njit(cache=True)
+    def _numba_noise_recurrence(rows, rnds, noise):
+        h, w = rows.shape
+        for i in range(h):
+            for x in range(w):
+                rows[i, x] += noise
+                noise += rnds[i, x]
+                noise = int(noise / 2)
+        return noise
+
+    @numba.njit(parallel=True, cache=True)
+    def _numba_head_switch_shift(rows, starts, shifts, twidth):
+        h, width = rows.shape
+        for i in numba.prange(h):
+            shif = shifts[i]
+            if shif == 0:
+                continue
+            tmp = numpy.zeros(twidth, dtype=rows.dtype)
+            tmp[:width] = rows[i]
+            x2 = (starts[i] + twidth + shif) % twidth
+            for x in range(starts[i], width):
+                rows[i, x] = tmp[x2]
+                x2 += 1
+                if x2 == twidth:
+                    x2 = 0
+
+
+class NumbaKernels:
+    """
+    JIT-compiled kernels, rows are processed in parallel where the recursion allows it
+    """
+    name = 'numba'
+
+    @staticmethod
+    def lowpass_cascade(rows: numpy.ndarray, alpha: float, passes: int, reset: float = 0.0) -> numpy.ndarray:
+        rows = numpy.ascontiguousarray(rows, dtype=numpy.float64)
+        return _numba_lowpass_cascade(rows, float(alpha), int(passes), float(reset))
+
+    @staticmethod
+    def lowpass_cascade_fixed(rows: numpy.ndarray, alpha: int, shift: int, passes: int,
+                              reset: int = 0) -> numpy.ndarray:
+        return _numba_lowpass_cascade_fixed(rows, numpy.int64(alpha), numpy.int64(shift), int(passes),
+                                            numpy.int64(reset))
+
+    @staticmethod
+    def noise_recurrence(rows: numpy.ndarray, rnds: numpy.ndarray, noise: int = 0) -> int:
+        rnds = numpy.ascontiguousarray(rnds, dtype=numpy.int64)
+        return int(_numba_noise_recurrence(rows, rnds, numpy.int64(noise)))
+
+    @staticmethod
+    def head_switch_shift(rows: numpy.ndarray, starts: numpy.ndarray, shifts: numpy.ndarray, twidth: int):
+        _numba_head_switch_shift(rows, numpy.asarray(starts, dtype=numpy.int64),
+                                 numpy.asarray(shifts, dtype=numpy.int64), int(twidth))
+
+
+BACKENDS: Dict[str, Type] = {NumpyKernels.name: NumpyKernels}
+if numba is not None:
+    BACKENDS[NumbaKernels.name] = NumbaKernels
+
+
+def select_backend(name: Optional[str] = None) -> Type:
+    """
+    Backend by name, by the NTSC_KERNELS environment variable, or numba whenever it is importable
+    """
+    name = name or os.environ.get('NTSC_KERNELS')
+    if name is None:
+        return NumbaKernels if numba is not None else NumpyKernels
+    if name not in BACKENDS:
+        logger.warning(f'Kernel backend {name} is not available, using numpy')
+        return NumpyKernels
+    return BACKENDS[name]
+
+
+active = select_backend()
+logger.debug(f'Scanline kernels: {active.name}')
+
+
+def use_backend(name: Optional[str] = None):
+    global active
+    active = select_backend(name)
+
+
+def start_threads():
+    """
+    Starts the threads numba runs parallel kernels on, from the calling thread, by running a tiny parallel kernel
+    on it. Left to the first kernel, they belong to whatever thread runs it, and when that is a pool worker which
+    ends before the interpreter does, numba's workqueue layer hangs the exit
+    """
+    if active is NumbaKernels:
+        NumbaKernels.lowpass_cascade(numpy.zeros((1, 8)), 0.5, 1)
@@ -1,6 +1,8 @@
+import multiprocessing
 import sys
 
 from loguru import logger
 
-logger.add("ntscqt_last_debug_log.log", enqueue=True, mode='w')
+# render worker processes log into the file of the app that started them
+logger.add("ntscqt_last_debug_log.log", enqueue=True, mode='w' if multiprocessing.parent_process() is None else 'a')
 
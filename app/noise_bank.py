@@ -0,0 +1,42 @@
+from typing import Callable, Tuple
+
+import numpy
+from scipy.signal import lfilter
+
+
+def filtered_noise(rnds: numpy.ndarray) -> numpy.ndarray:
+    """
+    The video noise recurrence of the fast path: lowpass with alpha 0.5, delayed by one sample
+    """
+    filtered = lfilter([0.5], [1, -0.5], rnds).astype(numpy.int32)
+    noise = numpy.zeros_like(filtered)
+    noise[1:] = filtered[:-1]
+    return noise
+
+
+class NoiseBank:
+    """
+    Filtered noise generated once for a field shape and amplitude, `scale` times larger than the field in each
+    direction. Every take() is a view at a random offset, randomly flipped upside down, so no noise has to be
+    generated or filtered per frame. Never mirrored left to right: the lowpass trails each sample to the right
+    as it does in a synchronous render.
+    """
+
+    def __init__(self, shape: Tuple[int, int], amplitude: int, seed: int, scale: int = 2):
+        self.shape = shape
+        fh, fw = shape
+        bh, bw = fh * scale, fw * scale
+        rnd = numpy.random.RandomState(seed)
+        rnds = rnd.randint(0, 2147483647, bh * bw, dtype=numpy.int32) % (amplitude * 2 + 1) - amplitude
+        self.bank = filtered_noise(rnds).reshape((bh, bw))
+
+    def take(self, rand: Callable[[], int]) -> numpy.ndarray:
+        fh, fw = self.shape
+        bh, bw = self.bank.shape
+        y = rand() % (bh - fh + 1)
+        x = rand() % (bw - fw + 1)
+        flip = rand() % 2
+        noise = self.bank[y:y + fh, x:x + fw]
+        if flip:
+            noise = noise[::-1]
+        return noise
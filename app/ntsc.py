@@ -1,18 +1,26 @@
 import math
 import random
 import sys
+import zlib
 from enum import Enum
+from functools import partial
 from pathlib import Path
-from typing import List
+from typing import Callable, Dict, List, Optional, Tuple
 
 import numpy
 import scipy
 from scipy.signal import lfilter
-from scipy.ndimage.interpolation import shift
 
 import numpy as np
 import cv2
 
+from app import kernels
+from app.fixed_point import fixed_emphasis, fixed_lowpass
+from app.freq_chain import FrequencyChain, Response, lowpass_response, emphasis_response, advance_response, \
+    spectrum_mask_response, lowpass_settle
+from app.noise_bank import NoiseBank, filtered_noise
+from app.stage_graph import StageGraph, shared_pool
+
 M_PI = math.pi
 
 Int_MIN_VALUE = -2147483648
@@ -26,20 +34,23 @@ ring_pattern_path = Path(ring_pattern_real_path)
 RingPattern = np.load(str(ring_pattern_path.resolve()))
 
 
-def ringing(img2d, alpha=0.5, noiseSize=0, noiseValue=2, clip=True, seed=None):
+def ringing(img2d, alpha=0.5, noiseSize=0, noiseValue=2, clip=True, seed=None, step=1, mask_rows=None):
     """
     https://bavc.github.io/avaa/artifacts/ringing.html
     :param img2d: 2d image
     :param alpha: float, reconstruction quality (0-1) optimal values for tv ringing modeling is 0.3-0.99
     :param noiseSize: float, noise size  (0-1) optimal values  is 0.5-0.99 if noiseSize=0 - no noise
     :param noiseValue: float, noise amplitude  (0-5) optimal values  is 0.5-2
+    :param step: int, columns of img2d are every step-th one of the full width, the noise band stays where
+                 it is in the full width spectrum
+    :param mask_rows: int, rows the mask width is derived from, the rows of img2d when None
     :return: 2d image
     """
     dft = cv2.dft(np.float32(img2d), flags=cv2.DFT_COMPLEX_OUTPUT)
     dft_shift = np.fft.fftshift(dft)
 
     rows, cols = img2d.shape
-    crow, ccol = int(rows / 2), int(cols / 2)
+    crow, ccol = int((mask_rows or rows) / 2), int(cols / 2)
     mask = np.zeros((rows, cols, 2), np.uint8)
 
     maskH = min(crow, int(1 + alpha * crow))
@@ -47,8 +58,8 @@ def ringing(img2d, alpha=0.5, noiseSize=0, noiseValue=2, clip=True, seed=None):
 
     if noiseSize > 0:
         noise = np.ones((mask.shape[0], mask.shape[1], mask.shape[2])) * noiseValue - noiseValue / 2.
-        start = int(ccol - ((1 - noiseSize) * ccol))
-        stop = int(ccol + ((1 - noiseSize) * ccol))
+        start = max(0, int(ccol - ((1 - noiseSize) * ccol * step)))
+        stop = int(ccol + ((1 - noiseSize) * ccol * step))
         noise[:, start:stop, :] = 0
         rnd = np.random.RandomState(seed)
         mask = mask.astype(np.float) + rnd.rand(mask.shape[0], mask.shape[1], mask.shape[2]) * noise - noise / 2.
@@ -61,11 +72,12 @@ def ringing(img2d, alpha=0.5, noiseSize=0, noiseValue=2, clip=True, seed=None):
         return img_back[:, :, 0]
 
 
-def ringing2(img2d, power=4, shift=0, clip=True):
+def ringing2(img2d, power=4, shift=0, clip=True, step=1):
     """
     https://bavc.github.io/avaa/artifacts/ringing.html
     :param img2d: 2d image
     :param power: int, ringing parrern poser (optimal 2 - 6)
+    :param step: int, columns of img2d are every step-th one of the full width (see ringing2_mask)
     :return: 2d image
     """
     dft = cv2.dft(np.float32(img2d), flags=cv2.DFT_COMPLEX_OUTPUT)
@@ -73,11 +85,7 @@ def ringing2(img2d, power=4, shift=0, clip=True):
 
     rows, cols = img2d.shape
 
-    scalecols = int(cols * (1 + shift))
-    mask = cv2.resize(RingPattern[np.newaxis, :], (scalecols, 1), interpolation=cv2.INTER_LINEAR)[0]
-
-    mask = mask[(scalecols // 2) - (cols // 2):(scalecols // 2) + (cols // 2)]
-    mask = mask ** power
+    mask = ringing2_mask(cols, power, shift, step)
     img_back = cv2.idft(np.fft.ifftshift(dft_shift * mask[None, :, None]), flags=cv2.DFT_SCALE)
     if clip:
         _min, _max = img2d.min(), img2d.max()
@@ -86,6 +94,19 @@ def ringing2(img2d, power=4, shift=0, clip=True):
         return img_back[:, :, 0]
 
 
+def ringing2_mask(cols: int, power=4, shift=0, step=1) -> numpy.ndarray:
+    """
+    ringing2 mask over an fftshift-ed spectrum of cols bins. For a row subsampled `step` times it is the middle
+    of the mask of the full width: a bin is the same absolute frequency in both, the response stays the same
+    """
+    scalecols = int(cols * step * (1 + shift))
+    mask = cv2.resize(RingPattern[np.newaxis, :], (scalecols, 1), interpolation=cv2.INTER_LINEAR)[0]
+
+    start = scalecols // 2 - cols // 2  # centre bin of the fftshift-ed spectrum, odd cols included
+    mask = mask[start:start + cols]
+    return mask ** power
+
+
 def fmod(x: float, y: float) -> float:
     return x % y
 
@@ -93,6 +114,7 @@ def fmod(x: float, y: float) -> float:
 class NumpyRandom:
     def __init__(self, seed=None):
         self.rnd = numpy.random.RandomState(seed)
+        self.seed = seed if seed is not None else int(numpy.random.randint(0, Int_MAX_VALUE))
 
     def nextInt(self, _from: int = Int_MIN_VALUE, until: int = Int_MAX_VALUE) -> int:
         return self.rnd.randint(_from, until)
@@ -100,9 +122,26 @@ class NumpyRandom:
     def nextIntArray(self, size: int, _from: int = Int_MIN_VALUE, until: int = Int_MAX_VALUE) -> numpy.ndarray:
         return self.rnd.randint(_from, until, size, dtype=numpy.int32)
 
+    def get_state(self):
+        return self.rnd.get_state()
+
+    def set_state(self, state):
+        self.rnd.set_state(state)
+
+    def reseed(self, index: int):
+        """
+        Restarts at the stream of frame `index`, it only depends on the seed and the index
+        """
+        self.rnd = numpy.random.RandomState([self.seed, index])
+
 
 class XorWowRandom:
     def __init__(self, seed1: int, seed2: int):
+        self.seed1 = seed1
+        self.seed2 = seed2
+        self._seed(seed1, seed2)
+
+    def _seed(self, seed1: int, seed2: int):
         self.x: int = numpy.int32(seed1)
         self.y: int = numpy.int32(seed2)
         self.z: int = numpy.int32(0)
@@ -150,6 +189,18 @@ class XorWowRandom:
             zeros[i] = self.nextInt(_from=_from, until=until)
         return zeros
 
+    def get_state(self):
+        return self.x, self.y, self.z, self.w, self.v, self.addend
+
+    def set_state(self, state):
+        self.x, self.y, self.z, self.w, self.v, self.addend = state
+
+    def reseed(self, index: int):
+        """
+        Restarts at the stream of frame `index`, it only depends on the seeds and the index
+        """
+        self._seed(self.seed1, (self.seed2 + index * 0x9E3779B1) & Int_MAX_VALUE)
+
 
 # interleaved uint8 HWC BGR to -> planar int32 CHW YIQ
 def bgr2yiq(bgrimg: numpy.ndarray) -> numpy.ndarray:
@@ -163,6 +214,21 @@ def bgr2yiq(bgrimg: numpy.ndarray) -> numpy.ndarray:
     return numpy.stack([Y, I, Q], axis=0).astype(numpy.int32)
 
 
+# luma of bgr2yiq with I and Q left at zero, exactly what bgr2yiq gives for a gray image
+def bgr2y(bgrimg: numpy.ndarray) -> numpy.ndarray:
+    h, w, _ = bgrimg.shape
+    b, g, r = numpy.transpose(bgrimg, (2, 0, 1))
+    dY = 0.30 * r + 0.59 * g + 0.11 * b
+
+    yiq = numpy.zeros((3, h, w), dtype=numpy.int32)
+    yiq[0] = dY * 256
+    return yiq
+
+
+def is_monochrome(bgrimg: numpy.ndarray) -> bool:
+    return numpy.array_equal(bgrimg[:, :, 0], bgrimg[:, :, 1]) and numpy.array_equal(bgrimg[:, :, 1], bgrimg[:, :, 2])
+
+
 # one field of planar int32 CHW YIQ -> one field of interleaved uint8 HWC BGR to
 def yiq2bgr(yiq: numpy.ndarray, dst_bgr: numpy.ndarray = None, field: int = 0) -> numpy.ndarray:
     c, h, w = yiq.shape
@@ -188,6 +254,95 @@ def yiq2bgr(yiq: numpy.ndarray, dst_bgr: numpy.ndarray = None, field: int = 0) -
     return dst_bgr
 
 
+# yiq2bgr for a field whose I and Q are all zero, the three channels are the same
+def y2bgr(yiq: numpy.ndarray, dst_bgr: numpy.ndarray = None, field: int = 0) -> numpy.ndarray:
+    c, h, w = yiq.shape
+    dst_bgr = dst_bgr if dst_bgr is not None else numpy.zeros((h, w, c))
+    Y = yiq[0, field % 2::2]
+    gray = numpy.clip((Y / 256).astype(numpy.int32), 0, 255)
+    dst_bgr[field % 2::2] = gray[:, :, None]
+    return dst_bgr
+
+
+# planar YUV frames are full range BT.601 YCbCr, (3, h, w) uint8 in Y, U (Cb), V (Cr) order, the same
+# YCbCr cv2 converts BGR to. B - Y = 1.772 U', R - Y = 1.402 V' with U', V' the chroma around 128
+_YUV_TO_IQ = numpy.float32(numpy.array([
+    [-0.27 * 1.772, 0.74 * 1.402],
+    [0.41 * 1.772, 0.48 * 1.402],
+]) * 256)
+_RGB_TO_YUV = numpy.float32([
+    [0.299, 0.587, 0.114],
+    [-0.299 / 1.772, -0.587 / 1.772, 0.886 / 1.772],
+    [0.701 / 1.402, -0.587 / 1.402, -0.114 / 1.402],
+])
+_YIQ_TO_RGB = numpy.float32([
+    [1.000, 0.956, 0.621],
+    [1.000, -0.272, -0.647],
+    [1.000, -1.106, 1.703],
+])
+
+
+# planar uint8 YUV -> planar int32 CHW YIQ with one matrix, the bgr2yiq of the YUV pipeline
+def yuv2yiq(yuv: numpy.ndarray) -> numpy.ndarray:
+    _, h, w = yuv.shape
+    yiq = numpy.empty((3, h, w), dtype=numpy.int32)
+    yiq[0] = yuv[0].astype(numpy.int32) << 8
+    u = yuv[1] - numpy.float32(128)
+    v = yuv[2] - numpy.float32(128)
+    for p, (cu, cv) in enumerate(_YUV_TO_IQ, start=1):
+        yiq[p] = cu * u + cv * v
+    return yiq
+
+
+def yuv2y(yuv: numpy.ndarray) -> numpy.ndarray:
+    _, h, w = yuv.shape
+    yiq = numpy.zeros((3, h, w), dtype=numpy.int32)
+    yiq[0] = yuv[0].astype(numpy.int32) << 8
+    return yiq
+
+
+def is_monochrome_yuv(yuv: numpy.ndarray) -> bool:
+    return not numpy.any(yuv[1:] != 128)
+
+
+def black_yuv(h: int, w: int) -> numpy.ndarray:
+    yuv = numpy.zeros((3, h, w), dtype=numpy.uint8)
+    yuv[1:] = 128
+    return yuv
+
+
+# one field of planar int32 CHW YIQ -> one field of planar uint8 YUV, the other field is left as it was in dst.
+# Colors are clipped to the RGB cube on the way like yiq2bgr does, strong chroma noise leaves it easily
+def yiq2yuv(yiq: numpy.ndarray, dst_yuv: numpy.ndarray = None, field: int = 0) -> numpy.ndarray:
+    _, h, w = yiq.shape
+    dst_yuv = dst_yuv if dst_yuv is not None else black_yuv(h, w)
+    Y, I, Q = yiq[:, field % 2::2] / numpy.float32(256)
+    rgb = [numpy.clip(cy * Y + ci * I + cq * Q, 0, 255) for cy, ci, cq in _YIQ_TO_RGB]
+    for p, (cr, cg, cb) in enumerate(_RGB_TO_YUV):
+        dst_yuv[p, field % 2::2] = numpy.clip(cr * rgb[0] + cg * rgb[1] + cb * rgb[2] + (0.5 if p == 0 else 128.5), 0, 255)
+    return dst_yuv
+
+
+def y2yuv(yiq: numpy.ndarray, dst_yuv: numpy.ndarray = None, field: int = 0) -> numpy.ndarray:
+    _, h, w = yiq.shape
+    dst_yuv = dst_yuv if dst_yuv is not None else black_yuv(h, w)
+    dst_yuv[0, field % 2::2] = numpy.clip(yiq[0, field % 2::2] >> 8, 0, 255)
+    return dst_yuv
+
+
+def bgr2yuv(bgrimg: numpy.ndarray) -> numpy.ndarray:
+    ycrcb = cv2.cvtColor(bgrimg, cv2.COLOR_BGR2YCrCb)
+    return numpy.ascontiguousarray(numpy.transpose(ycrcb, (2, 0, 1))[[0, 2, 1]])
+
+
+def yuv2bgr(yuv: numpy.ndarray) -> numpy.ndarray:
+    return cv2.cvtColor(cv2.merge([yuv[0], yuv[2], yuv[1]]), cv2.COLOR_YCrCb2BGR)
+
+
+def resize_planar(planes: numpy.ndarray, wh: Tuple[int, int], interpolation: int = cv2.INTER_LINEAR) -> numpy.ndarray:
+    return numpy.stack([cv2.resize(plane, wh, interpolation=interpolation) for plane in planes])
+
+
 class LowpassFilter:
     def __init__(self, rate: float, hz: float, value: float = 0.0):
         self.timeInterval: float = 1.0 / rate
@@ -229,46 +384,74 @@ def cut_black_line_border(image: numpy.ndarray, bordersize: int = None) -> None:
     image[:, -1*line_width:] = 0  # 0 set to black
 
 
-def composite_lowpass(yiq: numpy.ndarray, field: int, fieldno: int):
-    _, height, width = yiq.shape
+def chroma_downsample(yiq: numpy.ndarray, field: int):
+    """
+    Average chroma sample pairs into the even columns of the field, the odd columns are left stale
+    until chroma_upsample
+    """
+    fY, fI, fQ = yiq
+    for P in (fI[field::2], fQ[field::2]):
+        width = P.shape[1]
+        P[:, 0:width - 1:2] = (P[:, 0:width - 1:2] + P[:, 1::2]) >> 1
+
+
+def chroma_upsample(yiq: numpy.ndarray, field: int):
+    """
+    Rebuild the odd chroma columns of the field from their even neighbours
+    """
     fY, fI, fQ = yiq
-    for p in range(1, 3):
+    for P in (fI[field::2], fQ[field::2]):
+        even = P[:, ::2]
+        odd = P[:, 1::2]
+        k = even.shape[1] - 1  # odd columns that have an even neighbour on both sides
+        odd[:, :k] = (even[:, :k] + even[:, 1:k + 1]) >> 1
+        odd[:, k:] = even[:, k:odd.shape[1]]
+
+
+def composite_lowpass(yiq: numpy.ndarray, field: int, fieldno: int, step: int = 1, planes=(1, 2),
+                      fixed_point: bool = False):
+    fY, fI, fQ = yiq
+    for p in planes:
         cutoff = 1300000.0 if p == 1 else 600000.0
-        delay = 2 if (p == 1) else 4
+        delay = (2 if (p == 1) else 4) // step
         P = fI if (p == 1) else fQ
-        P = P[field::2]
-        lp = lowpassFilters(cutoff, reset=0.0)
-        for i, f in enumerate(P):
-            f = lp[0].lowpass_array(f)
-            f = lp[1].lowpass_array(f)
-            f = lp[2].lowpass_array(f)
-            P[i, 0:width - delay] = f.astype(numpy.int32)[delay:]
+        P = P[field::2, ::step]
+        width = P.shape[1]
+        lp = LowpassFilter(Ntsc.NTSC_RATE / step, cutoff)
+        if fixed_point:
+            f = fixed_lowpass(P, lp.alpha, 3)
+        else:
+            f = kernels.active.lowpass_cascade(P, lp.alpha, 3).astype(numpy.int32)
+        P[:, 0:width - delay] = f[:, delay:]
 
 
 # lighter-weight filtering, probably what your old CRT does to reduce color fringes a bit
-def composite_lowpass_tv(yiq: numpy.ndarray, field: int, fieldno: int):
-    _, height, width = yiq.shape
+def composite_lowpass_tv(yiq: numpy.ndarray, field: int, fieldno: int, step: int = 1, planes=(1, 2),
+                         fixed_point: bool = False):
     fY, fI, fQ = yiq
-    for p in range(1, 3):
-        delay = 1
+    for p in planes:
+        delay = 1 // step
         P = fI if (p == 1) else fQ
-        P = P[field::2]
-        lp = lowpassFilters(2600000.0, reset=0.0)
-        for i, f in enumerate(P):
-            f = lp[0].lowpass_array(f)
-            f = lp[1].lowpass_array(f)
-            f = lp[2].lowpass_array(f)
-            P[i, 0:width - delay] = f.astype(numpy.int32)[delay:]
+        P = P[field::2, ::step]
+        width = P.shape[1]
+        lp = LowpassFilter(Ntsc.NTSC_RATE / step, 2600000.0)
+        if fixed_point:
+            f = fixed_lowpass(P, lp.alpha, 3)
+        else:
+            f = kernels.active.lowpass_cascade(P, lp.alpha, 3).astype(numpy.int32)
+        P[:, 0:width - delay] = f[:, delay:]
 
 
 def composite_preemphasis(yiq: numpy.ndarray, field: int, composite_preemphasis: float,
-                          composite_preemphasis_cut: float):
+                          composite_preemphasis_cut: float, fixed_point: bool = False):
     fY, fI, fQ = yiq
     pre = LowpassFilter(Ntsc.NTSC_RATE, composite_preemphasis_cut, 16.0)
     fields = fY[field::2]
-    for i, samples in enumerate(fields):
-        filtered = samples + pre.highpass_array(samples) * composite_preemphasis
-        fields[i] = filtered.astype(numpy.int32)
+    if fixed_point:
+        fields[:] = fixed_emphasis(fields, fixed_lowpass(fields, pre.alpha, 1, reset=pre.prev), composite_preemphasis)
+        return
+    highpassed = fields - kernels.active.lowpass_cascade(fields, pre.alpha, 1, reset=pre.prev)
+    fields[:] = (fields + highpassed * composite_preemphasis).astype(numpy.int32)
 
 
 class VHSSpeed(Enum):
@@ -285,6 +468,7 @@ class VHSSpeed(Enum):
 class Ntsc:
     # https://en.wikipedia.org/wiki/NTSC
     NTSC_RATE = 315000000.00 / 88 * 4  # 315/88 Mhz rate * 4
+    NTSC_ACTIVE_WIDTH = 768  # active samples per scanline at NTSC_RATE (SMPTE 244M)
 
     def __init__(self, precise=False, random=None):
         self.precise = precise
@@ -334,6 +518,70 @@ class Ntsc:
 
         self._black_line_cut = False  # Add black line glitch (credits to @rgm89git)
 
+        # process scanlines at the true 4fsc active width whatever the frame width is, so filter cutoffs match
+        # NTSC_RATE and the cost per line is bounded; the result is scaled back to the frame width
+        self._native_4fsc = False
+
+        # keep I/Q at half horizontal resolution (even columns only) through the chroma stages, every one of them
+        # sits behind a lowpass far below the luma bandwidth anyway
+        self._chroma_subsample = False
+
+        # draft quality: fold consecutive linear scanline filters into one precomputed frequency response each,
+        # close to the exact output but not bit-exact
+        self._draft_quality = False
+        self._frequency_chains: Dict[tuple, FrequencyChain] = {}
+
+        # take video noise and chroma noise from a bank of pre-filtered noise instead of generating it every field
+        self._noise_bank = False
+        self._noise_banks: Dict[tuple, NoiseBank] = {}
+
+        # treat the source as black and white: only luma is converted and the chroma stages ahead of the
+        # subcarrier are skipped. Gray sources (B == G == R) are detected and take the same path
+        self._monochrome = False
+
+        # run the scanline IIR filters in int32 with Q12 coefficients and saturation instead of float64 lfilter,
+        # the way the original composite simulator computed them. Draft quality takes precedence
+        self._fixed_point = False
+
+        # index of the video frame being rendered and the generator of its head switching phase noise (the random
+        # module when None), see begin_frame
+        self._frame_index: Optional[int] = None
+        self._phase_random = None
+
+        # height of the whole image while composite_layer renders a band of it (see app.tiled), classic ringing
+        # sizes its mask from the field of the whole image. None when the layers are whole images
+        self._frame_height: Optional[int] = None
+
+    def begin_frame(self, index: Optional[int]):
+        """
+        What follows is frame `index` of a video. Every piece of state that changes from frame to frame is then
+        derived from the index: the noise generators restart at a stream of the frame's own and the head
+        switching point is where `index` frames of drift take it. A frame comes out the same whether the render
+        started at frame 0 or anywhere else (segments, resumed renders, in points).
+        None goes back to one running stream, as for previews and stills.
+        """
+        self._frame_index = index
+        if index is None:
+            self._phase_random = None
+            return
+        self.random.reseed(index)
+        self._phase_random = random.Random(index)
+
+    def _chroma_step(self) -> int:
+        return 2 if self._chroma_subsample else 1
+
+    def _banked_noise(self, shape: Tuple[int, int], amplitude: int) -> numpy.ndarray:
+        key = (shape, amplitude)
+        bank = self._noise_banks.get(key)
+        if bank is None:
+            if len(self._noise_banks) >= 4:  # amplitude sliders would leave a bank behind for every value
+                del self._noise_banks[next(iter(self._noise_banks))]
+            # banks outlive frames, in a video their content must not depend on the frame that built them
+            seed = self.rand() if self._frame_index is None else zlib.crc32(repr(key).encode())
+            bank = NoiseBank(shape, amplitude, seed=seed)
+            self._noise_banks[key] = bank
+        return bank.take(self.rand)
+
     def rand(self) -> numpy.int32:
         return self.random.nextInt(_from=0)
 
@@ -347,19 +595,14 @@ class Ntsc:
         fields = fY[field::2]
         fh, fw = fields.shape
         if not self.precise:  # this one works FAST
-            lp = LowpassFilter(1, 1, 0)
-            lp.alpha = 0.5
-            rnds = self.rand_array(fw * fh) % noise_mod - video_noise
-            noises = shift(lp.lowpass_array(rnds).astype(numpy.int32), 1)
-            fields += noises.reshape(fields.shape)
+            if self._noise_bank:
+                fields += self._banked_noise(fields.shape, video_noise)
+            else:
+                rnds = self.rand_array(fw * fh) % noise_mod - video_noise
+                fields += filtered_noise(rnds).reshape(fields.shape)
         else:  # this one works EXACTLY like original code
-            noise = 0
-            for field1 in fields:
-                rnds = self.rand_array(fw) % noise_mod - video_noise
-                for x in range(0, fw):
-                    field1[x] += noise
-                    noise += rnds[x]
-                    noise = int(noise / 2)
+            rnds = numpy.stack([self.rand_array(fw) % noise_mod - video_noise for _ in range(fh)])
+            kernels.active.noise_recurrence(fields, rnds)
 
     # https://bavc.github.io/avaa/artifacts/chrominance_noise.html
     def video_chroma_noise(self, yiq: numpy.ndarray, field: int, video_chroma_noise: int):
@@ -367,39 +610,37 @@ class Ntsc:
         fY, fI, fQ = yiq
 
         noise_mod = video_chroma_noise * 2 + 1
-        U = fI[field::2]
-        V = fQ[field::2]
+        step = self._chroma_step()
+        U = fI[field::2, ::step]
+        V = fQ[field::2, ::step]
         fh, fw = U.shape
         if not self.precise:
-            lp = LowpassFilter(1, 1, 0)
-            lp.alpha = 0.5
-            rndsU = self.rand_array(fw * fh) % noise_mod - video_chroma_noise
-            noisesU = shift(lp.lowpass_array(rndsU).astype(numpy.int32), 1)
+            if self._noise_bank:
+                U += self._banked_noise(U.shape, video_chroma_noise)
+                V += self._banked_noise(V.shape, video_chroma_noise)
+            else:
+                rndsU = self.rand_array(fw * fh) % noise_mod - video_chroma_noise
+                noisesU = filtered_noise(rndsU)
 
-            rndsV = self.rand_array(fw * fh) % noise_mod - video_chroma_noise
-            noisesV = shift(lp.lowpass_array(rndsV).astype(numpy.int32), 1)
+                rndsV = self.rand_array(fw * fh) % noise_mod - video_chroma_noise
+                noisesV = filtered_noise(rndsV)
 
-            U += noisesU.reshape(U.shape)
-            V += noisesV.reshape(V.shape)
+                U += noisesU.reshape(U.shape)
+                V += noisesV.reshape(V.shape)
         else:
-            noiseU = 0
-            noiseV = 0
-            for y in range(0, fh):
-                for x in range(0, fw):
-                    U[y][x] += noiseU
-                    noiseU += self.rand() % noise_mod - video_chroma_noise
-                    noiseU = int(noiseU / 2)
-
-                    V[y][x] += noiseV
-                    noiseV += self.rand() % noise_mod - video_chroma_noise
-                    noiseV = int(noiseV / 2)
+            # U and V draws alternate sample by sample
+            rnds = numpy.array([self.rand() for _ in range(fh * fw * 2)], dtype=numpy.int64)
+            rnds = (rnds % noise_mod - video_chroma_noise).reshape((fh, fw, 2))
+            kernels.active.noise_recurrence(U, rnds[:, :, 0])
+            kernels.active.noise_recurrence(V, rnds[:, :, 1])
 
     def video_chroma_phase_noise(self, yiq: numpy.ndarray, field: int, video_chroma_phase_noise: int):
         _, height, width = yiq.shape
         fY, fI, fQ = yiq
         noise_mod = video_chroma_phase_noise * 2 + 1
-        U = fI[field::2]
-        V = fQ[field::2]
+        step = self._chroma_step()
+        U = fI[field::2, ::step]
+        V = fQ[field::2, ::step]
         fh, fw = U.shape
         noise = 0
         for y in range(0, fh):
@@ -420,13 +661,17 @@ class Ntsc:
         shy = 0
         noise = 0.0
         if self._vhs_head_switching_phase_noise != 0.0:
-            x = numpy.int32(random.randint(1, 2000000000))
+            x = numpy.int32((self._phase_random or random).randint(1, 2000000000))
             noise = x / 1000000000.0 - 1.0
             noise *= self._vhs_head_switching_phase_noise
 
         t = twidth * (262.5 if self._output_ntsc else 312.5)
-        p = int(fmod(self._vhs_head_switching_point + noise, 1.0) * t)
-        self._vhs_head_switching_point += self._head_switching_speed/1000
+        if self._frame_index is None:
+            point = self._vhs_head_switching_point
+            self._vhs_head_switching_point += self._head_switching_speed/1000
+        else:
+            point = self._vhs_head_switching_point + self._frame_index * self._head_switching_speed / 1000
+        p = int(fmod(point + noise, 1.0) * t)
         y = int(p // twidth * 2) + field
         p = int(fmod(self._vhs_head_switching_phase + noise, 1.0) * t)
         x = p % twidth
@@ -434,27 +679,24 @@ class Ntsc:
         tx = x
         ishif = x - twidth if x >= twidth // 2 else x
         shif = 0
+        first = None
+        starts = []
+        shifts = []
         while y < height:
             if y >= 0:
-                Y = fY[y]
-                if shif != 0:
-                    tmp = numpy.zeros(twidth)
-                    x2 = (tx + twidth + shif) % twidth
-                    tmp[:width] = Y
-
-                    x = tx
-                    while x < width:
-                        Y[x] = tmp[x2]
-                        x2 += 1
-                        if x2 == twidth:
-                            x2 = 0
-                        x += 1
+                if first is None:
+                    first = y
+                starts.append(tx)
+                shifts.append(shif)
 
             shif = ishif if shy == 0 else int(shif * 7 / 8)
             tx = 0
             y += 2
             shy += 1
 
+        if first is not None:
+            kernels.active.head_switch_shift(fY[first::2], numpy.array(starts), numpy.array(shifts), twidth)
+
     _Umult = numpy.array([1, 0, -1, 0], dtype=numpy.int32)
     _Vmult = numpy.array([0, 1, 0, -1], dtype=numpy.int32)
 
@@ -472,8 +714,8 @@ class Ntsc:
         _, height, width = yiq.shape
         fY, fI, fQ = yiq
         y = field
-        umult = numpy.tile(Ntsc._Umult, int((width / 4) + 1))
-        vmult = numpy.tile(Ntsc._Vmult, int((width / 4) + 1))
+        umult = numpy.tile(Ntsc._Umult, width // 4 + 2)  # covers [xi:xi + width] for any xi and width
+        vmult = numpy.tile(Ntsc._Vmult, width // 4 + 2)
         while y < height:
             Y = fY[y]
             I = fI[y]
@@ -490,69 +732,86 @@ class Ntsc:
     def chroma_from_luma(self, yiq: numpy.ndarray, field: int, fieldno: int, subcarrier_amplitude: int):
         _, height, width = yiq.shape
         fY, fI, fQ = yiq
-        chroma = numpy.zeros(width, dtype=numpy.int32)
+        for y in range(field, height, 2):
+            xi = self._chroma_luma_xi(fieldno, y)
+            self._demodulate_row(fY[y], fY[y], fI[y], fQ[y], xi, subcarrier_amplitude)
+
+    # chroma_into_luma immediately followed by chroma_from_luma (VHS composite out): the modulated scanline only
+    # lives in a temporary, Y/I/Q are written once by the demodulation
+    def chroma_luma_roundtrip(self, yiq: numpy.ndarray, field: int, fieldno: int, subcarrier_amplitude: int):
+        _, height, width = yiq.shape
+        fY, fI, fQ = yiq
+        umult = numpy.tile(Ntsc._Umult, width // 4 + 2)  # covers [xi:xi + width] for any xi and width
+        vmult = numpy.tile(Ntsc._Vmult, width // 4 + 2)
         for y in range(field, height, 2):
             Y = fY[y]
             I = fI[y]
             Q = fQ[y]
-            sum: int = Y[0] + Y[1]
-            y2 = numpy.pad(Y[2:], (0, 2))
-            yd4 = numpy.pad(Y[:-2], (2, 0))
-            sums = y2 - yd4
-            sums0 = numpy.concatenate([numpy.array([sum], dtype=numpy.int32), sums])
-            acc = numpy.add.accumulate(sums0, dtype=numpy.int32)[1:]
-            acc4 = acc // 4
-            chroma = y2 - acc4
-            Y[:] = acc4
-
             xi = self._chroma_luma_xi(fieldno, y)
 
-            x = 4 - xi & 3
-            # // flip the part of the sine wave that would correspond to negative U and V values
-            chroma[x + 2::4] = -chroma[x + 2::4]
-            chroma[x + 3::4] = -chroma[x + 3::4]
-
-            chroma = (chroma * 50 / subcarrier_amplitude)
-
-            # decode the color right back out from the subcarrier we generated
-            cxi = -chroma[xi::2]
-            cxi1 = -chroma[xi + 1::2]
-            I[::2] = numpy.pad(cxi, (0, width // 2 - cxi.shape[0]))
-            Q[::2] = numpy.pad(cxi1, (0, width // 2 - cxi1.shape[0]))
-
-            I[1:width - 2:2] = (I[:width - 2:2] + I[2::2]) >> 1
-            Q[1:width - 2:2] = (Q[:width - 2:2] + Q[2::2]) >> 1
-            I[width - 2:] = 0
-            Q[width - 2:] = 0
+            chroma = I * subcarrier_amplitude * umult[xi:xi + width]
+            chroma += Q * subcarrier_amplitude * vmult[xi:xi + width]
+            composite = Y + chroma.astype(numpy.int32) // 50
+            self._demodulate_row(composite, Y, I, Q, xi, subcarrier_amplitude)
+
+    # composite may be Y itself, it is fully read before Y is written
+    @staticmethod
+    def _demodulate_row(composite: numpy.ndarray, Y: numpy.ndarray, I: numpy.ndarray, Q: numpy.ndarray,
+                        xi: int, subcarrier_amplitude: int):
+        width = composite.shape[0]
+        sum: int = composite[0] + composite[1]
+        y2 = numpy.pad(composite[2:], (0, 2))
+        yd4 = numpy.pad(composite[:-2], (2, 0))
+        sums = y2 - yd4
+        sums0 = numpy.concatenate([numpy.array([sum], dtype=numpy.int32), sums])
+        acc = numpy.add.accumulate(sums0, dtype=numpy.int32)[1:]
+        acc4 = acc // 4
+        chroma = y2 - acc4
+        Y[:] = acc4
+
+        x = 4 - xi & 3
+        # // flip the part of the sine wave that would correspond to negative U and V values
+        chroma[x + 2::4] = -chroma[x + 2::4]
+        chroma[x + 3::4] = -chroma[x + 3::4]
+
+        chroma = (chroma * 50 / subcarrier_amplitude)
+
+        # decode the color right back out from the subcarrier we generated
+        cxi = -chroma[xi::2]
+        cxi1 = -chroma[xi + 1::2]
+        evens = I[::2].shape[0]
+        I[::2] = numpy.pad(cxi, (0, evens - cxi.shape[0]))
+        Q[::2] = numpy.pad(cxi1, (0, evens - cxi1.shape[0]))
+
+        I[1:width - 1:2] = (I[:width - 2:2] + I[2::2]) >> 1
+        Q[1:width - 1:2] = (Q[:width - 2:2] + Q[2::2]) >> 1
+        I[width - 2:] = 0
+        Q[width - 2:] = 0
 
     def vhs_luma_lowpass(self, yiq: numpy.ndarray, field: int, luma_cut: float):
         _, height, width = yiq.shape
         fY, fI, fQ = yiq
-        for Y in fY[field::2]:
-            pre = LowpassFilter(Ntsc.NTSC_RATE, luma_cut, 16.0)
-            lp = lowpassFilters(cutoff=luma_cut, reset=16.0)
-            f0 = lp[0].lowpass_array(Y)
-            f1 = lp[1].lowpass_array(f0)
-            f2 = lp[2].lowpass_array(f1)
-            f3 = f2 + pre.highpass_array(f2) * 1.6
-            Y[:] = f3
-
-    def vhs_chroma_lowpass(self, yiq: numpy.ndarray, field: int, chroma_cut: float, chroma_delay: int):
-        _, height, width = yiq.shape
-        fY, fI, fQ = yiq
-        for U in fI[field::2]:
-            lpU = lowpassFilters(cutoff=chroma_cut, reset=0.0)
-            f0 = lpU[0].lowpass_array(U)
-            f1 = lpU[1].lowpass_array(f0)
-            f2 = lpU[2].lowpass_array(f1)
-            U[:width - chroma_delay] = f2[chroma_delay:]
-
-        for V in fQ[field::2]:
-            lpV = lowpassFilters(cutoff=chroma_cut, reset=0.0)
-            f0 = lpV[0].lowpass_array(V)
-            f1 = lpV[1].lowpass_array(f0)
-            f2 = lpV[2].lowpass_array(f1)
-            V[:width - chroma_delay] = f2[chroma_delay:]
+        rows = fY[field::2]
+        pre = LowpassFilter(Ntsc.NTSC_RATE, luma_cut, 16.0)
+        if self._fixed_point:
+            f2 = fixed_lowpass(rows, pre.alpha, 3, reset=16.0)
+            rows[:] = fixed_emphasis(f2, fixed_lowpass(f2, pre.alpha, 1, reset=16.0), 1.6)
+            return
+        f2 = kernels.active.lowpass_cascade(rows, pre.alpha, 3, reset=16.0)
+        f3 = f2 + (f2 - kernels.active.lowpass_cascade(f2, pre.alpha, 1, reset=16.0)) * 1.6
+        rows[:] = f3
+
+    def vhs_chroma_lowpass(self, yiq: numpy.ndarray, field: int, chroma_cut: float, chroma_delay: int,
+                           planes=(1, 2)):
+        step = self._chroma_step()
+        rate = Ntsc.NTSC_RATE / step
+        chroma_delay = chroma_delay // step
+        alpha = LowpassFilter(rate, chroma_cut).alpha
+        for p in planes:
+            P = yiq[p, field::2, ::step]
+            width = P.shape[1]
+            f2 = fixed_lowpass(P, alpha, 3) if self._fixed_point else kernels.active.lowpass_cascade(P, alpha, 3)
+            P[:, :max(width - chroma_delay, 0)] = f2[:, chroma_delay:]
 
     # VHS decks also vertically smear the chroma subcarrier using a delay line
     # to add the previous line's color subcarrier to the current line's color subcarrier.
@@ -562,37 +821,40 @@ class Ntsc:
     def vhs_chroma_vert_blend(self, yiq: numpy.ndarray, field: int):
         _, height, width = yiq.shape
         fY, fI, fQ = yiq
-        U2 = fI[field + 2::2, ]
-        V2 = fQ[field + 2::2, ]
+        step = self._chroma_step()
+        U2 = fI[field + 2::2, ::step]
+        V2 = fQ[field + 2::2, ::step]
         delayU = numpy.pad(U2[:-1, ], [[1, 0], [0, 0]])
         delayV = numpy.pad(V2[:-1, ], [[1, 0], [0, 0]])
-        fI[field + 2::2, ] = (delayU + U2 + 1) >> 1
-        fQ[field + 2::2, ] = (delayV + V2 + 1) >> 1
+        fI[field + 2::2, ::step] = (delayU + U2 + 1) >> 1
+        fQ[field + 2::2, ::step] = (delayV + V2 + 1) >> 1
 
     def vhs_sharpen(self, yiq: numpy.ndarray, field: int, luma_cut: float):
         _, height, width = yiq.shape
         fY, fI, fQ = yiq
-        for Y in fY[field::2]:
-            lp = lowpassFilters(cutoff=luma_cut * 4, reset=0.0)
-            s = Y
-            ts = lp[0].lowpass_array(Y)
-            ts = lp[1].lowpass_array(ts)
-            ts = lp[2].lowpass_array(ts)
-            Y[:] = (s + (s - ts) * self._vhs_out_sharpen * 2.0)
+        rows = fY[field::2]
+        alpha = LowpassFilter(Ntsc.NTSC_RATE, luma_cut * 4).alpha
+        if self._fixed_point:
+            rows[:] = fixed_emphasis(rows, fixed_lowpass(rows, alpha, 3), self._vhs_out_sharpen * 2.0)
+            return
+        ts = kernels.active.lowpass_cascade(rows, alpha, 3)
+        rows[:] = (rows + (rows - ts) * self._vhs_out_sharpen * 2.0)
 
     # http://www.michaeldvd.com.au/Articles/VideoArtefacts/VideoArtefactsColourBleeding.html
     # https://bavc.github.io/avaa/artifacts/yc_delay_error.html
     def color_bleed(self, yiq: numpy.ndarray, field: int):
         _, height, width = yiq.shape
         fY, fI, fQ = yiq
+        step = self._chroma_step()
+        horiz = self._color_bleed_horiz // step
 
-        field_ = fI[field::2]
+        field_ = fI[field::2, ::step]
         h, w = field_.shape
-        fI[field::2] = numpy.pad(field_, ((self._color_bleed_vert, 0), (self._color_bleed_horiz, 0)))[0:h, 0:w]
+        fI[field::2, ::step] = numpy.pad(field_, ((self._color_bleed_vert, 0), (horiz, 0)))[0:h, 0:w]
 
-        field_ = fQ[field::2]
+        field_ = fQ[field::2, ::step]
         h, w = field_.shape
-        fQ[field::2] = numpy.pad(field_, ((self._color_bleed_vert, 0), (self._color_bleed_horiz, 0)))[0:h, 0:w]
+        fQ[field::2, ::step] = numpy.pad(field_, ((self._color_bleed_vert, 0), (horiz, 0)))[0:h, 0:w]
 
     def vhs_edge_wave(self, yiq: numpy.ndarray, field: int):
         _, height, width = yiq.shape
@@ -606,13 +868,14 @@ class Ntsc:
             if rnds[y] != 0:
                 shift = rnds[y]
                 Y[:] = numpy.pad(Y, (shift, 0))[:-shift]
-        for y, I in enumerate(fI[field::2]):
-            if rnds[y] != 0:
-                shift = rnds[y]
+        step = self._chroma_step()
+        for y, I in enumerate(fI[field::2, ::step]):
+            if rnds[y] // step != 0:
+                shift = rnds[y] // step
                 I[:] = numpy.pad(I, (shift, 0))[:-shift]
-        for y, Q in enumerate(fQ[field::2]):
-            if rnds[y] != 0:
-                shift = rnds[y]
+        for y, Q in enumerate(fQ[field::2, ::step]):
+            if rnds[y] // step != 0:
+                shift = rnds[y] // step
                 Q[:] = numpy.pad(Q, (shift, 0))[:-shift]
 
     def vhs_chroma_loss(self, yiq: numpy.ndarray, field: int, video_chroma_loss: int):
@@ -626,104 +889,361 @@ class Ntsc:
                 V[:] = 0
 
     def emulate_vhs(self, yiq: numpy.ndarray, field: int, fieldno: int):
+        graph = StageGraph()
+        self._add_vhs_stages(graph, yiq, field, fieldno)
+        graph.run()
+
+    def _add_vhs_stages(self, graph: StageGraph, yiq: numpy.ndarray, field: int, fieldno: int,
+                        chroma_free: bool = False):
         vhs_speed = self._output_vhs_tape_speed
         if self._vhs_edge_wave != 0:
-            self.vhs_edge_wave(yiq, field)
+            graph.add(partial(self.vhs_edge_wave, yiq, field), 'Y', 'I', 'Q', 'rng')
 
-        self.vhs_luma_lowpass(yiq, field, vhs_speed.luma_cut)
+        if self._draft_quality:
+            for p, plane in enumerate('Y' if chroma_free else 'YIQ'):
+                graph.add(partial(self.draft_vhs_lowpass, yiq, field, planes=(p,)), plane)
+        else:
+            graph.add(partial(self.vhs_luma_lowpass, yiq, field, vhs_speed.luma_cut), 'Y')
 
-        self.vhs_chroma_lowpass(yiq, field, vhs_speed.chroma_cut, vhs_speed.chroma_delay)
+            for p, plane in () if chroma_free else ((1, 'I'), (2, 'Q')):
+                graph.add(partial(self.vhs_chroma_lowpass, yiq, field, vhs_speed.chroma_cut, vhs_speed.chroma_delay,
+                                  planes=(p,)), plane)
 
-        if self._vhs_chroma_vert_blend and self._output_ntsc:
-            self.vhs_chroma_vert_blend(yiq, field)
+        if self._vhs_chroma_vert_blend and self._output_ntsc and not chroma_free:
+            graph.add(partial(self.vhs_chroma_vert_blend, yiq, field), 'I', 'Q')
 
-        if True:  # TODO: make option
-            self.vhs_sharpen(yiq, field, vhs_speed.luma_cut)
+        if not self._draft_quality:  # TODO: make option (draft quality folds it into draft_vhs_lowpass)
+            graph.add(partial(self.vhs_sharpen, yiq, field, vhs_speed.luma_cut), 'Y')
 
         if not self._vhs_svideo_out:
-            self.chroma_into_luma(yiq, field, fieldno, self._subcarrier_amplitude)
-            self.chroma_from_luma(yiq, field, fieldno, self._subcarrier_amplitude)
+            if self._chroma_subsample:
+                graph.add(partial(chroma_upsample, yiq, field), 'I', 'Q')
+            graph.add(partial(self.chroma_luma_roundtrip, yiq, field, fieldno, self._subcarrier_amplitude),
+                      'Y', 'I', 'Q')
+
+    # I and Q of a monochrome source stay zero until the subcarrier is decoded, and for good if it never is
+    def _chroma_free(self) -> bool:
+        composite_vhs = self._emulating_vhs and not self._vhs_svideo_out
+        return self._nocolor_subcarrier and self._video_chroma_noise == 0 and not composite_vhs
+
+    def _skip_rand(self, count: int):
+        for _ in range(count):
+            self.rand()
+
+    # stages touching disjoint planes run concurrently, see StageGraph
+    def _add_composite_stages(self, graph: StageGraph, yiq: numpy.ndarray, field: int, fieldno: int,
+                              monochrome: bool = False):
+        step = self._chroma_step()
+        if monochrome:
+            self._add_luma_stages(graph, yiq, field, fieldno)
+            return
+
+        if self._chroma_subsample:
+            graph.add(partial(chroma_downsample, yiq, field), 'I', 'Q')
 
-    def composite_layer(self, dst: numpy.ndarray, src: numpy.ndarray, field: int, fieldno: int):
-        assert dst.shape == src.shape, "dst and src images must be of same shape"
+        if self._color_bleed_before and (self._color_bleed_vert != 0 or self._color_bleed_horiz != 0):
+            graph.add(partial(self.color_bleed, yiq, field), 'I', 'Q')
 
-        if self._black_line_cut:
-            cut_black_line_border(src)
+        if self._draft_quality:
+            for p, plane in enumerate('YIQ'):
+                graph.add(partial(self.draft_composite_in, yiq, field, planes=(p,)), plane)
+        else:
+            if self._composite_in_chroma_lowpass:
+                for p, plane in ((1, 'I'), (2, 'Q')):
+                    graph.add(partial(composite_lowpass, yiq, field, fieldno, step, planes=(p,),
+                                      fixed_point=self._fixed_point), plane)
 
-        yiq = bgr2yiq(src)
-        if self._color_bleed_before and (self._color_bleed_vert != 0 or self._color_bleed_horiz != 0):
-            self.color_bleed(yiq, field)
+            if self._ringing != 1.0:
+                for p, plane in enumerate('YIQ'):
+                    graph.add(partial(self.ringing, yiq, field, planes=(p,)), plane)
+
+        if self._chroma_subsample:
+            graph.add(partial(chroma_upsample, yiq, field), 'I', 'Q')
 
-        if self._composite_in_chroma_lowpass:
-            composite_lowpass(yiq, field, fieldno)
+        graph.add(partial(self.chroma_into_luma, yiq, field, fieldno, self._subcarrier_amplitude), 'Y', 'I', 'Q')
+        self._add_signal_stages(graph, yiq, field, fieldno)
 
-        if self._ringing != 1.0:
-            self.ringing(yiq, field)
+    # a monochrome source: every chroma stage ahead of chroma_from_luma filters, shifts or modulates zeros.
+    # The crosstalk chroma_from_luma decodes out of the luma is emulated by the regular stages after it
+    def _add_luma_stages(self, graph: StageGraph, yiq: numpy.ndarray, field: int, fieldno: int):
+        if self._draft_quality:
+            graph.add(partial(self.draft_composite_in, yiq, field, planes=(0,)), 'Y')
+        elif self._ringing != 1.0:
+            graph.add(partial(self.ringing, yiq, field, planes=(0,)), 'Y')
 
-        self.chroma_into_luma(yiq, field, fieldno, self._subcarrier_amplitude)
+        self._add_signal_stages(graph, yiq, field, fieldno, chroma_free=self._chroma_free())
+
+    def _add_signal_stages(self, graph: StageGraph, yiq: numpy.ndarray, field: int, fieldno: int,
+                           chroma_free: bool = False):
+        step = self._chroma_step()
+        field_rows = len(range(field, yiq.shape[1], 2))
 
         if self._composite_preemphasis != 0.0 and self._composite_preemphasis_cut > 0:
-            composite_preemphasis(yiq, field, self._composite_preemphasis, self._composite_preemphasis_cut)
+            if self._draft_quality:
+                graph.add(partial(self.draft_preemphasis, yiq, field), 'Y')
+            else:
+                graph.add(partial(composite_preemphasis, yiq, field, self._composite_preemphasis,
+                                  self._composite_preemphasis_cut, self._fixed_point), 'Y')
 
         if self._video_noise != 0:
-            self.video_noise(yiq, field, self._video_noise)
+            graph.add(partial(self.video_noise, yiq, field, self._video_noise), 'Y', 'rng')
 
         if self._vhs_head_switching:
-            self.vhs_head_switching(yiq, field)
+            graph.add(partial(self.vhs_head_switching, yiq, field), 'Y', 'rng')
 
         if not self._nocolor_subcarrier:
-            self.chroma_from_luma(yiq, field, fieldno, self._subcarrier_amplitude_back)
+            graph.add(partial(self.chroma_from_luma, yiq, field, fieldno, self._subcarrier_amplitude_back),
+                      'Y', 'I', 'Q')
 
         if self._video_chroma_noise != 0:
-            self.video_chroma_noise(yiq, field, self._video_chroma_noise)
+            graph.add(partial(self.video_chroma_noise, yiq, field, self._video_chroma_noise), 'I', 'Q', 'rng')
+
+        if chroma_free:
+            # the draws still have to be made, they shift the noise of every later stage
+            if self._video_chroma_phase_noise != 0:
+                graph.add(partial(self._skip_rand, field_rows), 'rng')
+            if self._emulating_vhs:
+                self._add_vhs_stages(graph, yiq, field, fieldno, chroma_free=True)
+            if self._video_chroma_loss != 0:
+                graph.add(partial(self._skip_rand, field_rows), 'rng')
+            return
 
         if self._video_chroma_phase_noise != 0:
-            self.video_chroma_phase_noise(yiq, field, self._video_chroma_phase_noise)
+            graph.add(partial(self.video_chroma_phase_noise, yiq, field, self._video_chroma_phase_noise),
+                      'I', 'Q', 'rng')
 
         if self._emulating_vhs:
-            self.emulate_vhs(yiq, field, fieldno)
+            self._add_vhs_stages(graph, yiq, field, fieldno)
 
         if self._video_chroma_loss != 0:
-            self.vhs_chroma_loss(yiq, field, self._video_chroma_loss)
+            graph.add(partial(self.vhs_chroma_loss, yiq, field, self._video_chroma_loss), 'I', 'Q', 'rng')
 
         if self._composite_out_chroma_lowpass:
-            if self._composite_out_chroma_lowpass_lite:
-                composite_lowpass_tv(yiq, field, fieldno)
-            else:
-                composite_lowpass(yiq, field, fieldno)
+            for p, plane in ((1, 'I'), (2, 'Q')):
+                if self._draft_quality:
+                    graph.add(partial(self.draft_composite_out, yiq, field, planes=(p,)), plane)
+                elif self._composite_out_chroma_lowpass_lite:
+                    graph.add(partial(composite_lowpass_tv, yiq, field, fieldno, step, planes=(p,),
+                                      fixed_point=self._fixed_point), plane)
+                else:
+                    graph.add(partial(composite_lowpass, yiq, field, fieldno, step, planes=(p,),
+                                      fixed_point=self._fixed_point), plane)
 
         if not self._color_bleed_before and (self._color_bleed_vert != 0 or self._color_bleed_horiz != 0):
-            self.color_bleed(yiq, field)
+            graph.add(partial(self.color_bleed, yiq, field), 'I', 'Q')
 
         # if self._ringing != 1.0:
         #     self.ringing(yiq, field)
 
-        Y, I, Q = yiq
-
         # simulate 2x less bandwidth for chroma components, just like yuv420
-        I[field::2] = self._blur_chroma(I[field::2])
-        Q[field::2] = self._blur_chroma(Q[field::2])
+        for p, plane in ((1, 'I'), (2, 'Q')):
+            graph.add(partial(self.blur_chroma, yiq, field, p), plane)
+
+    def composite_layer(self, dst: numpy.ndarray, src: numpy.ndarray, field: int, fieldno: int):
+        assert dst.shape == src.shape, "dst and src images must be of same shape"
 
-        return yiq2bgr(yiq)
+        if self._black_line_cut:
+            # src may be shared, with the next frame of the render or other targets of a fan-out
+            src = src.copy()
+            cut_black_line_border(src)
 
-    def _blur_chroma(self, chroma: numpy.ndarray) -> numpy.ndarray:
-        h, w = chroma.shape
-        down2 = cv2.resize(chroma.astype(numpy.float32), (w // 2, h // 2), interpolation=cv2.INTER_LANCZOS4)
-        return cv2.resize(down2, (w, h), interpolation=cv2.INTER_LANCZOS4).astype(numpy.int32)
+        height, width, _ = src.shape
+        if self._native_4fsc and width != Ntsc.NTSC_ACTIVE_WIDTH:
+            src = cv2.resize(src, (Ntsc.NTSC_ACTIVE_WIDTH, height), interpolation=cv2.INTER_AREA)
 
-    def ringing(self, yiq: numpy.ndarray, field: int):
-        Y, I, Q = yiq
+        monochrome = self._monochrome or is_monochrome(src)
+        yiq = bgr2y(src) if monochrome else bgr2yiq(src)
+        self._composite(yiq, field, fieldno, monochrome)
+
+        bgr = y2bgr(yiq) if monochrome and self._chroma_free() else yiq2bgr(yiq)
+        if bgr.shape[1] != width:
+            bgr = cv2.resize(bgr, (width, height), interpolation=cv2.INTER_LINEAR)
+        return bgr
+
+    def composite_layer_yuv(self, dst: numpy.ndarray, src: numpy.ndarray, field: int, fieldno: int):
+        """
+        composite_layer on planar YUV frames, (3, h, w) uint8 in and out. The frame goes to YIQ and back with
+        one matrix each, without the BGR round trip and the interleaved <-> planar transposes
+        """
+        assert dst.shape == src.shape, "dst and src images must be of same shape"
+
+        if self._black_line_cut:
+            src = src.copy()
+            line_width = int(src.shape[2] * 0.017)
+            src[0, :, -line_width:] = 0
+            src[1:, :, -line_width:] = 128
+
+        _, height, width = src.shape
+        if self._native_4fsc and width != Ntsc.NTSC_ACTIVE_WIDTH:
+            src = resize_planar(src, (Ntsc.NTSC_ACTIVE_WIDTH, height), interpolation=cv2.INTER_AREA)
+
+        monochrome = self._monochrome or is_monochrome_yuv(src)
+        yiq = yuv2y(src) if monochrome else yuv2yiq(src)
+        self._composite(yiq, field, fieldno, monochrome)
+
+        yuv = y2yuv(yiq) if monochrome and self._chroma_free() else yiq2yuv(yiq)
+        if yuv.shape[2] != width:
+            yuv = resize_planar(yuv, (width, height))
+        return yuv
+
+    def _composite(self, yiq: numpy.ndarray, field: int, fieldno: int, monochrome: bool):
+        graph = StageGraph()
+        self._add_composite_stages(graph, yiq, field, fieldno, monochrome)
+        graph.run(shared_pool())
+
+    def blur_chroma(self, yiq: numpy.ndarray, field: int, p: int):
+        P = yiq[p]
+        P[field::2] = self._blur_chroma(P[field::2, ::self._chroma_step()], yiq.shape[2])
+
+    def _blur_chroma(self, chroma: numpy.ndarray, width: int) -> numpy.ndarray:
+        h, _ = chroma.shape
+        down2 = cv2.resize(chroma.astype(numpy.float32), (width // 2, h // 2), interpolation=cv2.INTER_LANCZOS4)
+        return cv2.resize(down2, (width, h), interpolation=cv2.INTER_LANCZOS4).astype(numpy.int32)
+
+    def ringing(self, yiq: numpy.ndarray, field: int, planes=(0, 1, 2)):
         sz = self._freq_noise_size
         amp = self._freq_noise_amplitude
         shift = self._ringing_shift
-        if not self._enable_ringing2:
-            Y[field::2] = ringing(Y[field::2], self._ringing, noiseSize=sz, noiseValue=amp, clip=False)
-            I[field::2] = ringing(I[field::2], self._ringing, noiseSize=sz, noiseValue=amp, clip=False)
-            Q[field::2] = ringing(Q[field::2], self._ringing, noiseSize=sz, noiseValue=amp, clip=False)
+        for p in planes:
+            step = 1 if p == 0 else self._chroma_step()
+            P = yiq[p, field::2, ::step]
+            if not self._enable_ringing2:
+                seed = None if self._frame_index is None else (self._frame_index * 6 + field * 3 + p) & Int_MAX_VALUE
+                P[:] = ringing(P, self._ringing, noiseSize=sz, noiseValue=amp, clip=False, seed=seed, step=step,
+                               mask_rows=self._ringing_rows(field, P.shape[0]))
+            else:
+                P[:] = ringing2(P, power=self._ringing_power, shift=shift, clip=False, step=step)
+
+    def _frequency_chain(self, key: tuple, width: int,
+                         build: Callable[[], Tuple[List[Response], int]]) -> FrequencyChain:
+        key = key + (width,)
+        chain = self._frequency_chains.get(key)
+        if chain is None:
+            stages, margin = build()
+            chain = FrequencyChain(width, stages, margin)
+            self._frequency_chains[key] = chain
+        return chain
+
+    def _ringing_rows(self, field: int, rows: int) -> int:
+        """
+        Field rows the classic ringing mask is sized from, those of the whole image when rendering a band
+        """
+        return rows if self._frame_height is None else (self._frame_height - field + 1) // 2
+
+    def _ringing_response(self, rows: int, cols: int, step: int = 1) -> Response:
+        if self._enable_ringing2:
+            mask = ringing2_mask(cols, self._ringing_power, self._ringing_shift, step)
+        else:
+            crow, ccol = int(rows / 2), int(cols / 2)
+            maskH = min(crow, int(1 + self._ringing * crow))
+            mask = numpy.zeros(cols)
+            mask[ccol - maskH:ccol + maskH] = 1
+        return partial(spectrum_mask_response, mask=mask)
+
+    # draft counterpart of composite_lowpass + ringing, ringing with frequency noise is random and stays exact
+    def draft_composite_in(self, yiq: numpy.ndarray, field: int, planes=(0, 1, 2)):
+        Y, I, Q = yiq
+        step = self._chroma_step()
+        ringing_enabled = self._ringing != 1.0
+        exact_ringing = ringing_enabled and not self._enable_ringing2 and self._freq_noise_size > 0
+        draft_ringing = ringing_enabled and not exact_ringing
+        ringing_key = ('ringing', self._enable_ringing2, self._ringing, self._ringing_power, self._ringing_shift)
+
+        if draft_ringing and 0 in planes:
+            rows = Y[field::2]
+            h, w = rows.shape
+            h = self._ringing_rows(field, h)
+            self._frequency_chain(ringing_key + (h,), w, lambda: ([self._ringing_response(h, w)], 16)).apply(rows)
+
+        for p, cutoff, delay in ((1, 1300000.0, 2), (2, 600000.0, 4)):
+            if p not in planes:
+                continue
+            rows = yiq[p, field::2, ::step]
+            h, w = rows.shape
+            h = self._ringing_rows(field, h)
+
+            def build():
+                stages, margin = [], 16
+                if self._composite_in_chroma_lowpass:
+                    alpha = LowpassFilter(Ntsc.NTSC_RATE / step, cutoff).alpha
+                    stages += [partial(lowpass_response, alpha=alpha, passes=3),
+                               partial(advance_response, samples=delay // step)]
+                    margin = lowpass_settle(alpha, 3)
+                if draft_ringing:
+                    stages.append(self._ringing_response(h, w, step))
+                return stages, margin
+
+            if self._composite_in_chroma_lowpass or draft_ringing:
+                key = ('composite_in', cutoff, step, self._composite_in_chroma_lowpass, draft_ringing) + ringing_key
+                self._frequency_chain(key + (h,), w, build).apply(rows)
+
+        if exact_ringing:
+            self.ringing(yiq, field, planes)
+
+    # draft counterpart of composite_preemphasis
+    def draft_preemphasis(self, yiq: numpy.ndarray, field: int):
+        rows = yiq[0, field::2]
+
+        def build():
+            alpha = LowpassFilter(Ntsc.NTSC_RATE, self._composite_preemphasis_cut).alpha
+            return [partial(emphasis_response, alpha=alpha, gain=self._composite_preemphasis)], lowpass_settle(alpha)
+
+        key = ('preemphasis', self._composite_preemphasis, self._composite_preemphasis_cut)
+        self._frequency_chain(key, rows.shape[1], build).apply(rows)
+
+    # draft counterpart of vhs_luma_lowpass + vhs_sharpen on Y and vhs_chroma_lowpass on I/Q
+    def draft_vhs_lowpass(self, yiq: numpy.ndarray, field: int, planes=(0, 1, 2)):
+        vhs_speed = self._output_vhs_tape_speed
+        step = self._chroma_step()
+
+        def build_luma():
+            alpha = LowpassFilter(Ntsc.NTSC_RATE, vhs_speed.luma_cut).alpha
+            sharpen_alpha = LowpassFilter(Ntsc.NTSC_RATE, vhs_speed.luma_cut * 4).alpha
+            return [
+                partial(lowpass_response, alpha=alpha, passes=3),
+                partial(emphasis_response, alpha=alpha, gain=1.6),
+                partial(emphasis_response, alpha=sharpen_alpha, gain=self._vhs_out_sharpen * 2.0, passes=3),
+            ], lowpass_settle(alpha, 4)
+
+        if 0 in planes:
+            rows = yiq[0, field::2]
+            key = ('vhs_luma', vhs_speed, self._vhs_out_sharpen)
+            self._frequency_chain(key, rows.shape[1], build_luma).apply(rows)
+
+        def build_chroma():
+            alpha = LowpassFilter(Ntsc.NTSC_RATE / step, vhs_speed.chroma_cut).alpha
+            return [
+                partial(lowpass_response, alpha=alpha, passes=3),
+                partial(advance_response, samples=vhs_speed.chroma_delay // step),
+            ], lowpass_settle(alpha, 3)
+
+        for p in planes:
+            if p == 0:
+                continue
+            rows = yiq[p, field::2, ::step]
+            self._frequency_chain(('vhs_chroma', vhs_speed, step), rows.shape[1], build_chroma).apply(rows)
+
+    # draft counterpart of composite_lowpass_tv / composite_lowpass on the way out
+    def draft_composite_out(self, yiq: numpy.ndarray, field: int, planes=(1, 2)):
+        step = self._chroma_step()
+        if self._composite_out_chroma_lowpass_lite:
+            filters = ((1, 2600000.0, 1), (2, 2600000.0, 1))
         else:
-            Y[field::2] = ringing2(Y[field::2], power=self._ringing_power, shift=shift, clip=False)
-            I[field::2] = ringing2(I[field::2], power=self._ringing_power, shift=shift, clip=False)
-            Q[field::2] = ringing2(Q[field::2], power=self._ringing_power, shift=shift, clip=False)
+            filters = ((1, 1300000.0, 2), (2, 600000.0, 4))
+
+        for p, cutoff, delay in filters:
+            if p not in planes:
+                continue
+            rows = yiq[p, field::2, ::step]
+
+            def build():
+                alpha = LowpassFilter(Ntsc.NTSC_RATE / step, cutoff).alpha
+                return [
+                    partial(lowpass_response, alpha=alpha, passes=3),
+                    partial(advance_response, samples=delay // step),
+                ], lowpass_settle(alpha, 3)
+
+            self._frequency_chain(('composite_out', cutoff, delay, step), rows.shape[1], build).apply(rows)
 
 
 def random_ntsc(seed=None) -> Ntsc:
@@ -758,5 +1278,56 @@ def random_ntsc(seed=None) -> Ntsc:
     return ntsc
 
 
+# the settings of an Ntsc that shape its output. The rest of its attributes is state (the head switching point,
+# frame index, generators) or caches
+EFFECT_PARAMETERS = (
+    'precise',
+    '_composite_preemphasis_cut', '_composite_preemphasis', '_vhs_out_sharpen', '_vhs_edge_wave',
+    '_vhs_head_switching', '_head_switching_speed', '_vhs_head_switching_phase', '_vhs_head_switching_phase_noise',
+    '_color_bleed_before', '_color_bleed_horiz', '_color_bleed_vert',
+    '_ringing', '_enable_ringing2', '_ringing_power', '_ringing_shift', '_freq_noise_size', '_freq_noise_amplitude',
+    '_composite_in_chroma_lowpass', '_composite_out_chroma_lowpass', '_composite_out_chroma_lowpass_lite',
+    '_video_chroma_noise', '_video_chroma_phase_noise', '_video_chroma_loss', '_video_noise',
+    '_subcarrier_amplitude', '_subcarrier_amplitude_back', '_emulating_vhs', '_nocolor_subcarrier',
+    '_vhs_chroma_vert_blend', '_vhs_svideo_out', '_output_ntsc',
+    '_video_scanline_phase_shift', '_video_scanline_phase_shift_offset', '_output_vhs_tape_speed',
+    '_black_line_cut', '_native_4fsc', '_chroma_subsample', '_draft_quality', '_noise_bank', '_monochrome',
+    '_fixed_point',
+)
+
+
+def effect_parameters(nt: Ntsc) -> dict:
+    """
+    EFFECT_PARAMETERS of nt as plain values, VHSSpeed by name
+    """
+    values = {}
+    for name in EFFECT_PARAMETERS:
+        value = getattr(nt, name)
+        values[name] = value.name if isinstance(value, Enum) else value
+    return values
+
+
+def set_parameters(nt: Ntsc, values: dict):
+    """
+    Sets the parameters of a template or an exported config, VHSSpeed parameters from the name of the speed
+    """
+    for name, value in values.items():
+        if isinstance(getattr(nt, name, None), VHSSpeed) and isinstance(value, str):
+            value = VHSSpeed[value]
+        setattr(nt, name, value)
+
+
+def settings_copy(nt: Ntsc, into: Optional[Ntsc] = None) -> Ntsc:
+    """
+    `into` (a new Ntsc by default) with the EFFECT_PARAMETERS and the head switching point of nt. It keeps a
+    generator and caches of its own, so it can run on one thread while nt renders on another
+    """
+    if into is None:
+        into = Ntsc(random=NumpyRandom())
+    set_parameters(into, effect_parameters(nt))
+    into._vhs_head_switching_point = nt._vhs_head_switching_point
+    return into
+
+
 def lowpassFilters(cutoff: float, reset: float, rate: float = Ntsc.NTSC_RATE) -> List[LowpassFilter]:
     return [LowpassFilter(rate, cutoff, reset) for x in range(0, 3)]
\ No newline at end of file
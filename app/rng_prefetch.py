@@ -0,0 +1,135 @@
+import queue
+import threading
+from typing import Any, List, Optional, Tuple
+
+import numpy
+
+from app.logs import logger
+
+
+class PrefetchRandom:
+    """
+    Wraps NumpyRandom/XorWowRandom and generates the draws of the next frames on a background thread.
+
+    The calls made during the first frame (until frame_done()) are recorded as the plan, the producer then
+    replays the whole plan per frame into a bounded queue, together with the generator state the frame started
+    from. As soon as a call does not match the plan (the config or the frame shape changed) the generator is
+    rewound to the position of that call, the draw is made synchronously and a new plan is recorded. The
+    sequence of values is therefore exactly the one a synchronous render would consume.
+
+    frames_ahead=0 keeps every draw synchronous, a single core machine has nothing to overlap it with.
+
+    Once reseed() is called (Ntsc.begin_frame with a frame index) every frame starts from a reseeded generator:
+    the producer reseeds it with the indices that follow before prefetching a frame, and a reseed to any other
+    index than the one prefetched next falls back like a plan mismatch.
+    """
+
+    def __init__(self, source, frames_ahead: int = 2):
+        self.source = source
+        self.frames_ahead = frames_ahead
+        self._recording: List[Tuple[str, tuple]] = []
+        self._plan: List[Tuple[str, tuple]] = []
+        self._frame: Optional[Tuple[Any, list]] = None
+        self._index = 0
+        self._next_index: Optional[int] = None
+        self._queue: Optional[queue.Queue] = None
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+
+    def nextInt(self, _from: int, until: int = None) -> numpy.int32:
+        if until is None:
+            return self._call('nextInt', (_from,))
+        return self._call('nextInt', (_from, until))
+
+    def nextIntArray(self, size: int, _from: int, until: int) -> numpy.ndarray:
+        return self._call('nextIntArray', (size, _from, until))
+
+    def reseed(self, index: int):
+        self._next_index = index + 1
+        if self._thread is not None:
+            if self._frame is None or self._index == len(self._plan):
+                self._frame = self._queue.get()
+                self._index = 0
+                if self._frame[2] == index:
+                    return
+            logger.debug(f'RNG prefetch reseed to frame {index} while frame {self._frame[2]} was expected')
+            self._halt()
+        self._recording = []
+        self.source.reseed(index)
+
+    def frame_done(self):
+        if self.frames_ahead == 0:
+            self._recording.clear()
+        elif self._thread is None and self._recording:
+            self._start(self._recording)
+            self._recording = []
+
+    def close(self):
+        """
+        Stops prefetching, leaves the wrapped generator at the position of the first unconsumed draw and returns it
+        """
+        if self._thread is not None:
+            self._halt()
+        return self.source
+
+    def _call(self, name: str, args: tuple) -> Any:
+        if self._thread is not None:
+            if self._frame is None or self._index == len(self._plan):
+                if self._next_index is not None:  # reseeded frames only start in reseed()
+                    self._index = len(self._plan)
+                    self._halt()
+                    self._recording.append((name, args))
+                    return getattr(self.source, name)(*args)
+                self._frame = self._queue.get()
+                self._index = 0
+            if self._plan[self._index] == (name, args):
+                self._index += 1
+                return self._frame[1][self._index - 1]
+            logger.debug(f'RNG prefetch plan mismatch on {name}{args}, expected {self._plan[self._index]}')
+            self._halt()
+
+        self._recording.append((name, args))
+        return getattr(self.source, name)(*args)
+
+    def _start(self, plan: List[Tuple[str, tuple]]):
+        self._plan = plan
+        self._frame = None
+        self._index = 0
+        self._stop.clear()
+        self._queue = queue.Queue(maxsize=self.frames_ahead)
+        self._thread = threading.Thread(target=self._produce, daemon=True)
+        self._thread.start()
+
+    def _halt(self):
+        # after join the generator sits right after the last frame that was put into the queue
+        self._stop.set()
+        self._thread.join()
+        if self._frame is not None:
+            self.source.set_state(self._frame[0])
+            for name, args in self._plan[:self._index]:
+                getattr(self.source, name)(*args)
+        elif not self._queue.empty():
+            self.source.set_state(self._queue.get_nowait()[0])
+        self._thread = None
+        self._queue = None
+        self._frame = None
+
+    def _produce(self):
+        index = self._next_index
+        while not self._stop.is_set():
+            if index is not None:
+                self.source.reseed(index)
+            state = self.source.get_state()
+            results = [getattr(self.source, name)(*args) for name, args in self._plan]
+            while True:
+                if self._stop.is_set():
+                    # the frame never reached the consumer
+                    self.source.set_state(state)
+                    return
+                try:
+                    self._queue.put((state, results, index), timeout=0.1)
+                    if index is not None:
+                        index += 1
+                    break
+                except queue.Full:
+                    continue
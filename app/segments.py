@@ -0,0 +1,167 @@
+import multiprocessing
+import os
+import queue
+import shutil
+import signal
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor
+from pathlib import Path
+from typing import List, NamedTuple, Optional, Tuple
+
+import ffmpeg
+
+from app.checkpoint import Checkpoint
+from app.logs import logger
+
+# a segment pays for a process, a seek and an encoder warm up, shorter ones are not worth it
+MIN_SEGMENT_FRAMES = 250
+
+# extension of the encoded pieces, matroska takes both the lossy and the lossless codec
+PIECE_SUFFIX = '.mkv'
+
+
+def default_workers() -> int:
+    """
+    Processes rendering segments at once in headless renders, the GUI renders in process. Each one also drives an
+    ffmpeg decoder and encoder, half of the cores leaves them room
+    """
+    return max(1, (os.cpu_count() or 1) // 2)
+
+
+class Segment(NamedTuple):
+    index: int
+    start: int  # first frame
+    end: Optional[int]  # frame after the last one, None renders to the end of the stream
+
+
+def keyframes(path: Path) -> Optional[List[int]]:
+    """
+    Numbers of the keyframes of the first video stream, from the packet data ffprobe reads without decoding.
+    None without a working ffprobe
+    """
+    if shutil.which('ffprobe') is None:
+        return None
+    try:
+        info = ffmpeg.probe(str(path), select_streams='v:0', show_entries='packet=pts_time,flags')
+    except ffmpeg.Error as e:
+        logger.debug(f'ffprobe failed: {e.stderr}')
+        return None
+    packets = [packet for packet in info.get('packets', []) if packet.get('pts_time', 'N/A') != 'N/A']
+    # packets come in decoding order, frames are numbered in presentation order
+    order = sorted(range(len(packets)), key=lambda i: float(packets[i]['pts_time']))
+    return [frame for frame, i in enumerate(order) if 'K' in packets[i].get('flags', '')]
+
+
+def plan_segments(frames_count: int, workers: int, keys: Optional[List[int]] = None, start: int = 0,
+                  end: Optional[int] = None) -> List[Segment]:
+    """
+    Splits frames start..end (end None for the last of frames_count) into up to `workers` contiguous segments
+    of about the same length. A cut moves to the nearest keyframe in keys when one is within half a segment,
+    seeking there decodes nothing in vain. Without an end the last segment runs to the end of the stream
+    whatever the frame count says
+    """
+    last = frames_count if end is None else end
+    count = max(1, min(workers, (last - start) // MIN_SEGMENT_FRAMES))
+    length = (last - start) // count
+    cuts = set()
+    for i in range(1, count):
+        cut = start + length * i
+        if keys:
+            nearest = min(keys, key=lambda key: abs(key - cut))
+            if abs(nearest - cut) <= length // 2:
+                cut = nearest
+        if start < cut < last:
+            cuts.add(cut)
+    starts = [start] + sorted(cuts)
+    ends = starts[1:] + [end]
+    return [Segment(i, start, end) for i, (start, end) in enumerate(zip(starts, ends))]
+
+
+class SegmentJob(NamedTuple):
+    renderer_class: type
+    render_data: dict  # picklable, without the cv2 capture
+    main_effect: bool
+    lossless: bool
+    segment: Segment
+    checkpoint: Checkpoint
+    scratch_dir: Path
+
+
+# set in every worker process by _init_worker
+_progress: Optional[multiprocessing.Queue] = None
+_stop: Optional[multiprocessing.Event] = None
+_pause: Optional[multiprocessing.Event] = None
+
+
+def _init_worker(progress, stop, pause):
+    global _progress, _stop, _pause
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # the parent stops the workers through `stop`
+    _progress, _stop, _pause = progress, stop, pause
+
+
+def render_segment(job: SegmentJob) -> Tuple[int, bool]:
+    """
+    Renders the frames of job.segment into pieces of job.checkpoint, video only. Runs in a worker process.
+    Returns the number of frames rendered and False when the render was stopped
+    """
+    renderer = job.renderer_class()
+    renderer.render_data = job.render_data
+    renderer.mainEffect = job.main_effect
+    renderer.lossless = job.lossless
+    renderer.set_up()
+    renderer.running = True
+    renderer.increment_progress.connect(lambda: _progress.put(job.segment.index))
+
+    done = threading.Event()
+
+    def follow_controls():
+        while not done.wait(0.1):
+            renderer.pause = _pause.is_set()
+            if _stop.is_set():
+                renderer.running = False
+
+    threading.Thread(target=follow_controls, daemon=True).start()
+    encoder = renderer.piece_writer(job.checkpoint, job.scratch_dir, job.segment.start)
+    try:
+        renderer.render_frames(encoder, job.segment.start, job.segment.end)
+    finally:
+        done.set()
+    return encoder.frames_written, renderer.running
+
+
+class SegmentPool:
+    """
+    Worker processes rendering SegmentJobs. Started with spawn: the parent runs Qt and threads, which fork
+    would copy in whatever state they are in
+    """
+
+    def __init__(self, workers: int):
+        context = multiprocessing.get_context('spawn')
+        self.progress = context.Queue()
+        self.stop = context.Event()
+        self.pause = context.Event()
+        self._executor = ProcessPoolExecutor(
+            max_workers=workers, mp_context=context,
+            initializer=_init_worker, initargs=(self.progress, self.stop, self.pause),
+        )
+
+    def submit(self, job: SegmentJob) -> Future:
+        return self._executor.submit(render_segment, job)
+
+    def frames_done(self, timeout: float) -> List[int]:
+        """
+        Segment indices of the frames finished since the last call, waits up to timeout for the first one
+        """
+        done = []
+        try:
+            done.append(self.progress.get(timeout=timeout))
+            while True:
+                done.append(self.progress.get_nowait())
+        except queue.Empty:
+            pass
+        return done
+
+    def close(self):
+        self.stop.set()
+        self._executor.shutdown(wait=True, cancel_futures=True)
+        self.progress.close()
@@ -0,0 +1,89 @@
+import os
+import queue
+from collections import deque
+from concurrent.futures import Executor, ThreadPoolExecutor
+from typing import Callable, List, Optional, Tuple, FrozenSet
+
+_pool: Optional[ThreadPoolExecutor] = None
+
+
+def shared_pool() -> Optional[Executor]:
+    """
+    Thread pool shared by every StageGraph, None on single core machines
+    """
+    global _pool
+    cpus = os.cpu_count() or 1
+    if cpus == 1:
+        return None
+    if _pool is None:
+        _pool = ThreadPoolExecutor(max_workers=min(cpus, 4), thread_name_prefix='ntsc-stage')
+    return _pool
+
+
+class StageGraph:
+    """
+    Stages of one composite_layer call, each with the resources it touches: the 'Y', 'I', 'Q' planes and
+    'rng' for stages drawing random numbers. A stage runs after every earlier stage sharing a resource with it,
+    so stages on disjoint planes run concurrently while the order of everything touching the same plane
+    (and of all random draws) stays the order the stages were added in.
+    """
+
+    def __init__(self):
+        self._stages: List[Tuple[Callable[[], None], FrozenSet[str]]] = []
+
+    def add(self, stage: Callable[[], None], *resources: str):
+        self._stages.append((stage, frozenset(resources)))
+
+    def run(self, pool: Optional[Executor] = None):
+        if pool is None:
+            for stage, _ in self._stages:
+                stage()
+            return
+
+        count = len(self._stages)
+        dependents: List[List[int]] = [[] for _ in range(count)]
+        waiting = [0] * count
+        last = {}
+        for i, (_, resources) in enumerate(self._stages):
+            deps = {last[r] for r in resources if r in last}
+            for d in deps:
+                dependents[d].append(i)
+            waiting[i] = len(deps)
+            for r in resources:
+                last[r] = i
+
+        ready = deque(i for i in range(count) if waiting[i] == 0)
+        done = queue.SimpleQueue()
+        running = 0
+        finished = 0
+
+        def complete(i):
+            nonlocal finished
+            finished += 1
+            for d in dependents[i]:
+                waiting[d] -= 1
+                if waiting[d] == 0:
+                    ready.append(d)
+
+        # the calling thread runs one ready stage itself and hands the others to the pool, so the graph
+        # always makes progress even when every pool worker is busy
+        while finished < count:
+            while len(ready) > 1:
+                i = ready.popleft()
+                running += 1
+                future = pool.submit(self._stages[i][0])
+                future.add_done_callback(lambda f, i=i: done.put((i, f)))
+            if ready:
+                i = ready.popleft()
+                self._stages[i][0]()
+                complete(i)
+            elif running:
+                i, future = done.get()
+                running -= 1
+                future.result()
+                complete(i)
+            while running and not done.empty():
+                i, future = done.get()
+                running -= 1
+                future.result()
+                complete(i)
@@ -0,0 +1,108 @@
+import tempfile
+from pathlib import Path
+from typing import Callable, Optional
+
+import cv2
+import numpy
+from numpy.lib.format import open_memmap
+
+from app.Renderer import DefaultRenderer
+from app.logs import logger
+from app.ntsc import Ntsc
+
+# peak bytes allocated per pixel of a band by composite_layer and the interlace blend (measured with tracemalloc)
+BYTES_PER_PIXEL = 100
+DEFAULT_MEMORY_BUDGET = 512 * 1024 * 1024
+
+# band starts are multiples of this so the subcarrier phase ((y >> 1) & 3) and the field row parity of every
+# band match the full image
+ROW_ALIGN = 8
+
+# vhs_head_switching lands at most ~577 lines down (PAL) and its shift decays over ~45 field lines after that
+HEAD_SWITCHING_ROWS = 704
+
+# stills this tall or taller are saved band by band
+TILED_MIN_HEIGHT = 1200
+
+# stills render_image_file reads and writes
+IMAGE_SUFFIXES = ('.png', '.jpg', '.jpeg', '.webp')
+
+
+def _align(rows: int) -> int:
+    return (rows + ROW_ALIGN - 1) // ROW_ALIGN * ROW_ALIGN
+
+
+def band_halo(nt: Ntsc) -> int:
+    """
+    Extra rows rendered above and below every band and thrown away. Covers the vertical reach of the stages:
+    color bleed, the chroma vertical blend, the Lanczos chroma blur (8 taps on the half height field), the
+    settling of the edge wave lowpass and the interlace blend. Ringing needs no overlap: it filters every
+    scanline on its own. The classic ringing mask is sized from the field height, render_bands gives the
+    effect the height of the whole image for it.
+    """
+    return _align(64 + 2 * abs(nt._color_bleed_vert))
+
+
+def band_height(width: int, halo: int, memory_budget: int) -> int:
+    """
+    Output rows per band such that band plus halo fit in memory_budget
+    """
+    rows = memory_budget // (max(width, 1) * BYTES_PER_PIXEL) - 2 * halo
+    return max(ROW_ALIGN, rows // ROW_ALIGN * ROW_ALIGN)
+
+
+def render_bands(nt: Ntsc, src: numpy.ndarray, dst: numpy.ndarray,
+                 memory_budget: int = DEFAULT_MEMORY_BUDGET,
+                 progress: Optional[Callable[[int, int], None]] = None):
+    """
+    Renders the still src into dst band by band, both may be memory mapped files. Noise is drawn per band, so
+    it is a different realisation than a single pass render. Head switching happens at a fixed scanline from the
+    top of the frame, the first band is made tall enough to hold it and is the only one rendering it.
+    """
+    height, width, _ = src.shape
+    halo = band_halo(nt)
+    rows = band_height(width, halo, memory_budget)
+    head_switching = nt._vhs_head_switching
+    nt._frame_height = height
+    first = max(rows, HEAD_SWITCHING_ROWS) if head_switching else rows
+    starts = [0] + list(range(first, height, rows))
+    logger.debug(f'Tiled render {width}x{height}: {len(starts)} bands of {rows} rows, halo {halo}')
+
+    try:
+        for i, start in enumerate(starts):
+            end = min(first if i == 0 else start + rows, height)
+            top = max(start - halo, 0)
+            bottom = min(end + halo, height)
+            nt._vhs_head_switching = head_switching and top == 0
+            band = numpy.array(src[top:bottom])
+            out = DefaultRenderer.apply_main_effect(nt, frame1=band)
+            dst[start:end] = out[start - top:end - top]
+            if progress is not None:
+                progress(i + 1, len(starts))
+    finally:
+        nt._vhs_head_switching = head_switching
+        nt._frame_height = None
+
+
+def render_image_file(nt: Ntsc, src_path: Path, dst_path: Path,
+                      memory_budget: int = DEFAULT_MEMORY_BUDGET,
+                      progress: Optional[Callable[[int, int], None]] = None):
+    """
+    Decodes src_path, renders it at native resolution through disk backed buffers and encodes dst_path.
+    Only the decoded source (3 bytes per pixel, while spilling it to disk) and one band are ever held in memory.
+    """
+    with tempfile.TemporaryDirectory(prefix='ntscqt-tiles-') as scratch:
+        scratch = Path(scratch)
+        image = cv2.imdecode(numpy.fromfile(str(src_path), dtype=numpy.uint8), cv2.IMREAD_COLOR)
+        src = open_memmap(scratch / 'src.npy', mode='w+', dtype=numpy.uint8, shape=image.shape)
+        src[:] = image
+        del image
+        dst = open_memmap(scratch / 'dst.npy', mode='w+', dtype=numpy.uint8, shape=src.shape)
+
+        render_bands(nt, src, dst, memory_budget, progress)
+
+        is_success, buffer = cv2.imencode(dst_path.suffix or '.png', dst)
+        if not is_success:
+            raise RuntimeError(f'Could not encode {dst_path}')
+        buffer.tofile(str(dst_path))
+        del src, dst
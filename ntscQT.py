@@ -1,3 +1,4 @@
+import multiprocessing
 import os
 import sys
 from pathlib import Path
@@ -62,4 +63,6 @@ def main():
 
 
 if __name__ == '__main__':
+    # render worker processes of frozen builds start through this executable
+    multiprocessing.freeze_support()
     main()
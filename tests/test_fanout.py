@@ -0,0 +1,45 @@
+import shutil
+import subprocess
+
+import cv2
+import numpy
+import pytest
+
+from app.fanout import Target
+from app.headless import render, seed_ntsc
+
+pytestmark = pytest.mark.skipif(shutil.which('ffmpeg') is None, reason='needs ffmpeg')
+
+
+def read_frames(path):
+    cap = cv2.VideoCapture(str(path))
+    frames = []
+    ok, frame = cap.read()
+    while ok:
+        frames.append(frame)
+        ok, frame = cap.read()
+    cap.release()
+    return frames
+
+
+@pytest.fixture
+def source(tmp_path):
+    path = tmp_path / 'source.mp4'
+    subprocess.run(['ffmpeg', '-loglevel', 'error', '-f', 'lavfi', '-i', 'testsrc=size=160x120:rate=25',
+                    '-frames:v', '6', '-pix_fmt', 'yuv420p', str(path)], check=True)
+    return path
+
+
+def test_line_cut_of_one_target_stays_out_of_the_others(source, tmp_path):
+    cut = seed_ntsc(1)
+    cut._black_line_cut = True
+    render(source, tmp_path / 'cut.mkv', cut, lossless=True, targets=[
+        Target(cut, tmp_path / 'cut.mkv'),
+        Target(seed_ntsc(1), tmp_path / 'plain.mkv'),
+    ])
+    render(source, tmp_path / 'alone.mkv', seed_ntsc(1), lossless=True)
+
+    plain, alone = read_frames(tmp_path / 'plain.mkv'), read_frames(tmp_path / 'alone.mkv')
+    assert len(plain) == len(alone) == 6
+    for frame, expected in zip(plain, alone):
+        numpy.testing.assert_array_equal(frame, expected)
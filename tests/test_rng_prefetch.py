@@ -0,0 +1,86 @@
+import threading
+
+import numpy
+
+from app.Renderer import DefaultRenderer
+from app.ntsc import NumpyRandom, random_ntsc, settings_copy
+from app.rng_prefetch import PrefetchRandom
+
+SEED = 1234
+
+
+def frame_calls(changed: bool = False):
+    calls = [('nextInt', (0, 100)), ('nextIntArray', (5, 0, 1000)), ('nextInt', (0, 10))]
+    if changed:
+        calls[1] = ('nextIntArray', (7, 0, 1000))
+    return calls
+
+
+def draw(rnd, calls):
+    return [getattr(rnd, name)(*args) for name, args in calls]
+
+
+def assert_same(values, expected):
+    assert len(values) == len(expected)
+    for value, want in zip(values, expected):
+        numpy.testing.assert_array_equal(value, want)
+
+
+def test_prefetched_draws_match_a_synchronous_generator():
+    prefetch = PrefetchRandom(NumpyRandom(SEED), frames_ahead=2)
+    plain = NumpyRandom(SEED)
+    # frame 3 changes its calls half way, frame 7 does not follow frame 4
+    for index in (0, 1, 2, 3, 4, 7, 8, 9):
+        calls = frame_calls(changed=index == 3)
+        prefetch.reseed(index)
+        plain.reseed(index)
+        assert_same(draw(prefetch, calls), draw(plain, calls))
+        prefetch.frame_done()
+    source = prefetch.close()
+    assert_same(draw(source, frame_calls()), draw(plain, frame_calls()))
+
+
+def test_prefetched_running_stream_matches_a_synchronous_generator():
+    prefetch = PrefetchRandom(NumpyRandom(SEED), frames_ahead=2)
+    plain = NumpyRandom(SEED)
+    for index in range(6):
+        calls = frame_calls(changed=index == 2)
+        assert_same(draw(prefetch, calls), draw(plain, calls))
+        prefetch.frame_done()
+    source = prefetch.close()
+    assert_same(draw(source, frame_calls()), draw(plain, frame_calls()))
+
+
+def test_previews_while_paused_leave_the_render_sequence_alone():
+    rnd = numpy.random.RandomState(SEED)
+    frames = [rnd.randint(0, 256, (48, 64, 3), dtype=numpy.uint8) for _ in range(5)]
+
+    def render(nt, preview_during=None):
+        out = []
+        for index, frame in enumerate(frames):
+            previews = []
+            if index == preview_during:
+                # the preview of a pause that has not reached the render loop yet
+                def preview():
+                    for _ in range(3):
+                        copy = settings_copy(nt)
+                        copy.begin_frame(None)
+                        DefaultRenderer.apply_main_effect(copy, frame)
+                previews = [threading.Thread(target=preview)]
+                previews[0].start()
+            nt.begin_frame(index)
+            out.append(DefaultRenderer.apply_main_effect(nt, frame))
+            if isinstance(nt.random, PrefetchRandom):
+                nt.random.frame_done()
+            for thread in previews:
+                thread.join()
+        return out
+
+    expected = render(random_ntsc(SEED))
+    nt = random_ntsc(SEED)
+    nt.random = PrefetchRandom(nt.random, frames_ahead=2)
+    try:
+        rendered = render(nt, preview_during=2)
+    finally:
+        nt.random = nt.random.close()
+    assert_same(rendered, expected)
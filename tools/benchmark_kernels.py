@@ -0,0 +1,60 @@
+"""
+Time every available scanline kernel backend on field sized inputs and check they agree with numpy
+
+usage: python tools/benchmark_kernels.py [width height [repeats]]
+"""
+import sys
+import time
+from pathlib import Path
+
+import numpy
+
+sys.path.insert(0, str(Path(__file__).absolute().parent.parent))
+
+from app.fixed_point import SHIFT, coefficient
+from app.kernels import BACKENDS, NumpyKernels
+from app.ntsc import LowpassFilter, Ntsc
+
+
+def cases(width: int, height: int):
+    rnd = numpy.random.RandomState(0)
+    fields = rnd.randint(0, 200, (height // 2, width), dtype=numpy.int32)
+    rnds = rnd.randint(-50, 51, fields.shape).astype(numpy.int64)
+    starts = numpy.zeros(fields.shape[0], dtype=numpy.int64)
+    shifts = (numpy.arange(fields.shape[0]) % 64 - 32).astype(numpy.int64)
+    alpha = LowpassFilter(Ntsc.NTSC_RATE, 2400000.0).alpha
+
+    yield 'lowpass x3', lambda k: k.lowpass_cascade(fields, alpha, 3)
+    yield 'lowpass x3 reset', lambda k: k.lowpass_cascade(fields, alpha, 3, reset=16.0)
+    yield 'fixed lowpass x3', lambda k: k.lowpass_cascade_fixed(fields, coefficient(alpha), SHIFT, 3, reset=16)
+    yield 'noise recurrence', lambda k: (k.noise_recurrence(f := fields.copy(), rnds), f)[1]
+    yield 'head switching', lambda k: (k.head_switch_shift(f := fields.copy(), starts, shifts, width + width // 10), f)[1]
+
+
+def best_of(fn, repeats: int) -> float:
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def main():
+    width = int(sys.argv[1]) if len(sys.argv) > 1 else 720
+    height = int(sys.argv[2]) if len(sys.argv) > 2 else 480
+    repeats = int(sys.argv[3]) if len(sys.argv) > 3 else 5
+
+    print(f'{"kernel":20}' + ''.join(f'{name:>12}' for name in BACKENDS) + '  identical')
+    for title, run in cases(width, height):
+        reference = run(NumpyKernels)
+        line = f'{title:20}'
+        identical = True
+        for backend in BACKENDS.values():
+            identical &= numpy.array_equal(run(backend), reference)  # first call also compiles
+            line += f'{best_of(lambda: run(backend), repeats) * 1000:10.1f}ms'
+        print(f'{line}  {identical}')
+
+
+if __name__ == '__main__':
+    main()
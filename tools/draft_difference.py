@@ -0,0 +1,48 @@
+"""
+Measure how far the draft quality engine (or another engine option) is from the exact one for every builtin template
+
+usage: python tools/draft_difference.py image.png [render height [option]]
+  option defaults to _draft_quality, e.g. _fixed_point compares the fixed-point filters
+"""
+import json
+import random
+import sys
+from pathlib import Path
+
+import cv2
+import numpy
+
+sys.path.insert(0, str(Path(__file__).absolute().parent.parent))
+
+from app.Renderer import DefaultRenderer
+from app.funcs import resize_to_height
+from app.ntsc import Ntsc, NumpyRandom
+
+
+def render(values: dict, frame: numpy.ndarray, option: str, enabled: bool) -> numpy.ndarray:
+    random.seed(0)  # vhs_head_switching phase noise
+    nt = Ntsc(random=NumpyRandom(0))
+    for parameter_name, value in values.items():
+        setattr(nt, parameter_name, value)
+    setattr(nt, option, enabled)
+    return DefaultRenderer.apply_main_effect(nt, frame).astype(numpy.float64)
+
+
+def main():
+    image = cv2.imread(sys.argv[1], cv2.IMREAD_COLOR)
+    height = int(sys.argv[2]) if len(sys.argv) > 2 else 480
+    option = sys.argv[3] if len(sys.argv) > 3 else '_draft_quality'
+    h, w, _ = image.shape
+    frame = cv2.resize(image, resize_to_height((w, h), height))
+
+    templates = json.loads((Path(__file__).absolute().parent.parent / 'builtin_templates.json').read_text())
+    print(f'{"template":24} {"mean abs":>9} {"max abs":>8} {"PSNR dB":>8}')
+    for name, values in templates.items():
+        diff = render(values, frame, option, enabled=False) - render(values, frame, option, enabled=True)
+        mse = numpy.mean(diff ** 2)
+        psnr = 10 * numpy.log10(255 ** 2 / mse) if mse > 0 else float('inf')
+        print(f'{name:24} {numpy.mean(numpy.abs(diff)):9.3f} {numpy.max(numpy.abs(diff)):8.0f} {psnr:8.2f}')
+
+
+if __name__ == '__main__':
+    main()